@@ -6,10 +6,19 @@ MEMIT algorithm can parse
 """
 
 
-import json
+import os
+import sys
 import pandas as pd
 import re
 
+# result logs (json or parquet) are read as the fact completion scripts read them
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "fact_completion_scripts"
+    )
+)
+from columnar_logs import load_log  # noqa: E402
+
 
 # helper to load dataset
 def load_full_dataset(
@@ -24,7 +33,7 @@ def load_full_dataset(
 # model and runtime log whose outputs we'd like to convert to
 # which can be found in (/src/benchmark_scripts/output_logs/)
 # which takes the format of:
-# [model name]_logged_cka_outputs_[date].json
+# [model name]_logged_cka_outputs_[date].json (or .parquet)
 # the format required by MEMIT (see/notebooks/memit_run_main.ipynb)
 def convert_log_to_memit_format(
     log_filename, prefix="../../src/benchmark_scripts/output_logs/", verbose=False
@@ -32,114 +41,108 @@ def convert_log_to_memit_format(
     full_df = load_full_dataset()
 
     try:
-        with open(prefix + log_filename, "r") as logdata:
-            log_dict = json.load(logdata)
+        log_dict = load_log(prefix + log_filename)
+
+        model_name = log_dict["model_name"][0]
 
-            model_name = log_dict["model_name"][0]
+        if model_name is None:
+            print(f"Could not extract model name from {log_filename}")
+            raise Exception
+
+        if verbose:
+            print(f"Converting log for {model_name}")
 
-            if model_name is None:
-                print(f"Could not extract model name from {log_filename}")
-                raise Exception
+        score_dict_summary = log_dict["score_dict_summary"][model_name]
 
-            if verbose:
-                print(f"Converting log for {model_name}")
+        if verbose:
+            print(f"score dict summary: {score_dict_summary}")
 
-            score_dict_summary = log_dict["score_dict_summary"][model_name]
+        n_correct = re.search(r"([0-9]+)\/", score_dict_summary)
+        n_total = re.search(r"\/([0-9]+)", score_dict_summary)
 
-            if verbose:
-                print(f"score dict summary: {score_dict_summary}")
+        if n_correct is None or n_total is None:
+            print(f"could not extract summary performance from {log_filename}")
+            raise Exception
 
-            n_correct = re.search(r"([0-9]+)\/", score_dict_summary)
-            n_total = re.search(r"\/([0-9]+)", score_dict_summary)
+        n_correct = n_correct.group(1)
+        n_total = n_total.group(1)
+        n_wrong = int(n_total) - int(n_correct)
+        print(f"we should be correcting {n_wrong} incorrect associations via MEMIT.")
 
-            if n_correct is None or n_total is None:
-                print(f"could not extract summary performance from {log_filename}")
-                raise Exception
+        score_dict = log_dict["score_dict_full"][model_name]
 
-            n_correct = n_correct.group(1)
-            n_total = n_total.group(1)
-            n_wrong = int(n_total) - int(n_correct)
+        if score_dict is None:
+            print(f"Encountered issue parsing data for {model_name}")
+            raise Exception
+
+        if verbose:
             print(
-                f"we should be correcting {n_wrong} incorrect associations via MEMIT."
+                f"Checking {model_name}'s {len(score_dict)} item score_dict for conversions."
             )
 
-            score_dict = log_dict["score_dict_full"][model_name]
+        prompts = []
+        subjects = []
+        targets = []
 
-            if score_dict is None:
-                print(f"Encountered issue parsing data for {model_name}")
-                raise Exception
+        facts_to_correct = 0
 
-            if verbose:
-                print(
-                    f"Checking {model_name}'s {len(score_dict)} item score_dict for conversions."
+        for fact_output in score_dict:
+            if fact_output["p_true > p_false_average"] == "False":
+                # determine which dataset the entry came from
+                dataset = (
+                    "calinet"
+                    if fact_output["dataset_original"] == "calinet_input_information"
+                    else "rome"
                 )
 
-            prompts = []
-            subjects = []
-            targets = []
+                if dataset is None:
+                    print(
+                        f"Encountered issue resolving original data for {fact_output}"
+                    )
+                    raise Exception
+
+                # grab id linking back to original
+                # todo: change this to dataset_id
+                # if we re-run this with new formatted log output, not strictly necessary though
+                id = (
+                    fact_output["fact_id"]
+                    if dataset == "calinet"
+                    else fact_output["case_id"]
+                )
 
-            facts_to_correct = 0
+                if id is None:
+                    print(f"Encountered issue resolving original id for {fact_output}")
+                    raise Exception
 
-            for fact_output in score_dict:
-                if fact_output["p_true > p_false_average"] == "False":
-                    # determine which dataset the entry came from
-                    dataset = (
-                        "calinet"
-                        if fact_output["dataset_original"]
-                        == "calinet_input_information"
-                        else "rome"
-                    )
+                try:
+                    # produce the correct prompt and its subject
+                    prompt, subject, obj = parse_stem(id, full_df, dataset)
 
-                    if dataset is None:
-                        print(
-                            f"Encountered issue resolving original data for {fact_output}"
-                        )
-                        raise Exception
-
-                    # grab id linking back to original
-                    # todo: change this to dataset_id
-                    # if we re-run this with new formatted log output, not strictly necessary though
-                    id = (
-                        fact_output["fact_id"]
-                        if dataset == "calinet"
-                        else fact_output["case_id"]
-                    )
+                    # append the prompt
+                    prompts.append(prompt)
 
-                    if id is None:
-                        print(
-                            f"Encountered issue resolving original id for {fact_output}"
-                        )
-                        raise Exception
-
-                    try:
-                        # produce the correct prompt and its subject
-                        prompt, subject, obj = parse_stem(id, full_df, dataset)
-
-                        # append the prompt
-                        prompts.append(prompt)
-
-                        # append the subject
-                        subjects.append(subject)
-
-                        # append fact as the target, in ROME format
-                        targets.append({"str": obj})
-
-                        # update counter
-                        facts_to_correct += 1
-                    except Exception:
-                        print(f"problem iterating through log file {log_filename}")
-                        raise Exception
-
-            if facts_to_correct != n_wrong:
-                print("mismatch between model inaccuracies and log-conversion output")
-                raise Exception
-            else:
-                print(
-                    f"Conversion complete. Returning {facts_to_correct} associations to correct for {model_name}"
-                )
-                return pd.DataFrame(
-                    {"prompt": prompts, "subject": subjects, "target_new": targets}
-                )
+                    # append the subject
+                    subjects.append(subject)
+
+                    # append fact as the target, in ROME format
+                    targets.append({"str": obj})
+
+                    # update counter
+                    facts_to_correct += 1
+                except Exception:
+                    print(f"problem iterating through log file {log_filename}")
+                    raise Exception
+
+        if facts_to_correct != n_wrong:
+            print("mismatch between model inaccuracies and log-conversion output")
+            raise Exception
+        else:
+            print(
+                f"Conversion complete. Returning {facts_to_correct} associations to correct for {model_name}"
+            )
+            return pd.DataFrame(
+                {"prompt": prompts, "subject": subjects, "target_new": targets}
+            )
 
     except ValueError:
         print(f"problem decoding log file {log_filename}")
@@ -0,0 +1,104 @@
+"""
+Overlapped collation for batched fact-completion probes
+
+With batched probes the model forward waits on the host work that prepares
+each batch: slicing the tokenized contexts, padding them into tensors and
+pinning those for the transfer to the GPU. A BatchProducer does that work on
+a background thread, a few batches ahead, handing finished batches over a
+bounded queue while the current batch runs. Its timings show how much of the
+collation was hidden behind the forward passes.
+"""
+
+import queue
+import threading
+import time
+
+# queue item marking the end of the batches
+end_of_batches = object()
+
+
+class BatchProducer:
+    """
+    Background thread collating upcoming batches
+
+    collate_fn(batch) builds the padded tensors of a batch of work item
+    indices; up to max_prefetch collated batches wait in the queue. Iterating
+    yields (batch, padded_batch) pairs in schedule order, and an exception in
+    the thread is raised again from the iteration. A max_prefetch of 0 (or
+    None) collates inline instead, with the same timings, as a baseline.
+    """
+
+    def __init__(self, batches, collate_fn, max_prefetch=2, pin_memory=False):
+        self.batches = batches
+        self.collate_fn = collate_fn
+        self.pin_memory = pin_memory
+        self.max_prefetch = max_prefetch or 0
+        self.stop_event = threading.Event()
+        self.collate_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.thread = None
+        if self.max_prefetch > 0:
+            self.queue = queue.Queue(maxsize=self.max_prefetch)
+            self.thread = threading.Thread(target=self.produce, daemon=True)
+            self.thread.start()
+
+    def collate(self, batch):
+        start_time = time.perf_counter()
+        padded_batch = self.collate_fn(batch)
+        if self.pin_memory:
+            padded_batch = tuple(tensor.pin_memory() for tensor in padded_batch)
+        self.collate_seconds += time.perf_counter() - start_time
+        return padded_batch
+
+    def produce(self):
+        try:
+            for batch in self.batches:
+                if not self.put((batch, self.collate(batch))):
+                    return
+            self.put(end_of_batches)
+        except Exception as exception:
+            self.put(exception)
+
+    def put(self, item):
+        # blocks while the queue is full, giving up once the consumer stops
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        if self.thread is None:
+            # inline, every second of collation is waited on
+            for batch in self.batches:
+                padded_batch = self.collate(batch)
+                self.wait_seconds = self.collate_seconds
+                yield batch, padded_batch
+            return
+        try:
+            while True:
+                start_time = time.perf_counter()
+                item = self.queue.get()
+                self.wait_seconds += time.perf_counter() - start_time
+                if item is end_of_batches:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def report(self):
+        return {
+            "collate_seconds": self.collate_seconds,
+            "wait_seconds": self.wait_seconds,
+            # collation time the forward passes covered
+            "hidden_seconds": max(0.0, self.collate_seconds - self.wait_seconds),
+        }
@@ -0,0 +1,37 @@
+"""
+Helpers for scheduling batched fact-completion probes by token length
+
+Stems vary a lot in token length across languages, so batching them in dataset
+order pads most rows up to a much longer neighbor. Sorting the work items by
+length first keeps each batch close to uniform; results are scattered back to
+their original positions by index.
+"""
+
+
+# split work items into batches of indices, longest contexts first
+# ties keep their dataset order since python's sort is stable
+def schedule_batches(lengths, batch_size, sort_by_length=True):
+    order = list(range(len(lengths)))
+    if sort_by_length:
+        order.sort(key=lambda itr: lengths[itr], reverse=True)
+    return [
+        order[start : start + batch_size] for start in range(0, len(order), batch_size)
+    ]
+
+
+# real tokens / padded tokens over a schedule, where every batch is padded
+# up to its longest row
+def padding_report(lengths, batches):
+    real_tokens = 0
+    padded_tokens = 0
+    for batch in batches:
+        batch_lengths = [lengths[itr] for itr in batch]
+        real_tokens += sum(batch_lengths)
+        padded_tokens += max(batch_lengths) * len(batch_lengths)
+
+    return {
+        "num_batches": len(batches),
+        "real_tokens": real_tokens,
+        "padded_tokens": padded_tokens,
+        "padding_efficiency": real_tokens / padded_tokens if padded_tokens else 1.0,
+    }
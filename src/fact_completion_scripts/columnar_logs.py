@@ -0,0 +1,189 @@
+"""
+Columnar (Parquet) result logs
+
+JSON result logs repeat every key on every row and store booleans as strings,
+so a split's log runs to several MB and takes a while to parse. A Parquet log
+holds the same rows as typed columns: float32 probabilities (the precision
+the probes compute them in), list<float32> for p_false_list, float64 for the
+average and ratio compare_models computes from them in python floats, a
+boolean for "p_true > p_false_average" and dictionary-encoded model and
+relation columns.
+The rest of the JSON log (model names, summaries, aggregates, run report) is
+kept as JSON in the file's schema metadata, so read_parquet_log returns the
+exact layout json.load gives for a JSON log, and load_log reads either.
+Rebuilding those python rows costs about as much as parsing the JSON; the
+file is several times smaller, and pq.read_table alone is much faster, for
+tools that can work on the columns.
+
+Example usage, converting a folder of JSON logs and comparing the formats:
+python columnar_logs.py --folder ../../data/result_logs/llama-30b
+"""
+
+import glob
+import json
+import os
+import time
+from argparse import ArgumentParser
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# schema metadata key holding the non-row parts of the log
+log_metadata_key = b"cka_log"
+
+# typed columns of the logged rows, in the order compare_models records them
+# other keys (e.g. subject_type) get columns of inferred types
+row_fields = [
+    pa.field("stem", pa.string()),
+    pa.field("fact", pa.string()),
+    pa.field("counterfact", pa.list_(pa.string())),
+    pa.field("p_true", pa.float32()),
+    pa.field("p_false_list", pa.list_(pa.float32())),
+    pa.field("p_false_average", pa.float64()),
+    pa.field("p_true / p_false_average", pa.float64()),
+    pa.field("p_true > p_false_average", pa.bool_()),
+    pa.field("subject", pa.string()),
+    pa.field("object", pa.string()),
+    pa.field("relation", pa.dictionary(pa.int32(), pa.string())),
+    pa.field("dataset_id", pa.string()),
+]
+# columns every logged row has, the others are left out of rows where null
+required_columns = [
+    "stem",
+    "fact",
+    "counterfact",
+    "p_true",
+    "p_false_list",
+    "p_false_average",
+    "p_true / p_false_average",
+    "p_true > p_false_average",
+]
+
+
+def log_to_table(score_dicts_logging):
+    """
+    Lay out the rows of every model of a log as one table, with a
+    dictionary-encoded model column and the rest of the log as metadata
+    """
+    model_names = []
+    rows = []
+    for model_name, score_dict_full in score_dicts_logging["score_dict_full"].items():
+        model_names.extend([model_name] * len(score_dict_full))
+        rows.extend(score_dict_full)
+
+    columns = {"model": pa.array(model_names, pa.dictionary(pa.int32(), pa.string()))}
+    field_types = {field.name: field.type for field in row_fields}
+    row_keys = [field.name for field in row_fields]
+    for score_dict in rows:
+        row_keys.extend(key for key in score_dict if key not in row_keys)
+    for key in row_keys:
+        values = [score_dict.get(key) for score_dict in rows]
+        if key == "p_true > p_false_average":
+            values = [None if value is None else value == "True" for value in values]
+        if key in required_columns or any(value is not None for value in values):
+            columns[key] = pa.array(values, field_types.get(key))
+
+    metadata = {
+        key: value
+        for key, value in score_dicts_logging.items()
+        if key != "score_dict_full"
+    }
+    return pa.table(columns).replace_schema_metadata(
+        {log_metadata_key: json.dumps(metadata).encode("utf-8")}
+    )
+
+
+def table_to_log(table):
+    """
+    Rebuild the JSON log layout from a table written by log_to_table
+    """
+    score_dicts_logging = json.loads(table.schema.metadata[log_metadata_key])
+    optional_names = [
+        name
+        for name in table.column_names
+        if name not in required_columns and name != "model"
+    ]
+    # dictionary-encoded columns are decoded in arrow, rather than per value
+    for column_itr, field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type):
+            table = table.set_column(
+                column_itr,
+                field.name,
+                table.column(column_itr).cast(field.type.value_type),
+            )
+    score_dict_full = {}
+    for score_dict in table.to_pylist():
+        model_name = score_dict.pop("model")
+        score_dict["p_true > p_false_average"] = str(
+            score_dict["p_true > p_false_average"]
+        )
+        for name in optional_names:
+            if score_dict[name] is None:
+                del score_dict[name]
+        score_dict_full.setdefault(model_name, []).append(score_dict)
+    score_dicts_logging["score_dict_full"] = score_dict_full
+    return score_dicts_logging
+
+
+# helpers to write and read a log as parquet
+def write_parquet_log(score_dicts_logging, fpath):
+    pq.write_table(log_to_table(score_dicts_logging), fpath, compression="zstd")
+
+
+def read_parquet_log(fpath):
+    return table_to_log(pq.read_table(fpath))
+
+
+# helpers to write and read a log in the format its extension names
+def write_log(score_dicts_logging, fpath):
+    if fpath.endswith(".parquet"):
+        write_parquet_log(score_dicts_logging, fpath)
+    else:
+        with open(fpath, "w") as outfile:
+            json.dump(score_dicts_logging, outfile)
+
+
+def load_log(fpath):
+    if fpath.endswith(".parquet"):
+        return read_parquet_log(fpath)
+    with open(fpath, "r") as infile:
+        return json.load(infile)
+
+
+# helper to convert a JSON log to parquet, next to it
+def convert_json_log(json_fpath):
+    parquet_fpath = os.path.splitext(json_fpath)[0] + ".parquet"
+    write_parquet_log(load_log(json_fpath), parquet_fpath)
+    return parquet_fpath
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--folder", type=str, required=True, help="Folder of JSON logs to convert"
+    )
+    args = parser.parse_args()
+
+    # (profile sidecars, see run_profiling.py, are not result logs)
+    json_fpaths = [
+        fpath
+        for fpath in sorted(glob.glob(os.path.join(args.folder, "*.json")))
+        if not fpath.endswith("-profile.json")
+    ]
+    for json_fpath in json_fpaths:
+        start_time = time.perf_counter()
+        parquet_fpath = convert_json_log(json_fpath)
+        convert_seconds = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        load_log(json_fpath)
+        json_seconds = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        load_log(parquet_fpath)
+        parquet_seconds = time.perf_counter() - start_time
+
+        json_megabytes = os.path.getsize(json_fpath) / 1024**2
+        parquet_megabytes = os.path.getsize(parquet_fpath) / 1024**2
+        print(
+            f"{os.path.basename(json_fpath)}: {np.round(json_megabytes, 2)} MB -> {np.round(parquet_megabytes, 2)} MB, load {np.round(json_seconds, 3)}s (json) vs {np.round(parquet_seconds, 3)}s (parquet), converted in {np.round(convert_seconds, 3)}s"
+        )
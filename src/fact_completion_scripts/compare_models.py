@@ -3,351 +3,654 @@ Wrapper helpers for running fact completion with contrastive knowledge assessmen
 """
 
 import datetime
-import json
+import functools
 import os
+import time
 import numpy as np
 import tqdm
 import torch
 
-import transformers
-from transformers import (
-    AutoTokenizer,
-    AutoModelForCausalLM,
-    AutoModelForMaskedLM,
-    AutoModelForSeq2SeqLM,
-)
-
 from probe_helpers import (
-    probe_gpt,
-    probe_bert,
-    probe_llama,
-    probe_t5,
-    probe_stablelm,
-    probe_mpt,
-    probe_redpajama,
-    probe_falcon,
+    probe_causal_batch,
+    probe_teacher_forced_batch,
+    probe_causal_sequences_batch,
+    probe_causal_prefix_cached,
+    generate_probe_settings,
+    tokenize_batch_contexts,
+    collate_probe_batch,
+)
+from batch_pipeline import BatchProducer
+from run_profiling import (
+    StageProfiler,
+    set_active_profiler,
+    profile_stage,
+    profile_seconds,
+    profile_tokens,
+    write_profile_sidecar,
+)
+from model_families import model_families, get_model_family, get_family_tokenizer
+from cpu_execution import get_cpu_model_and_tokenizer
+from batch_scheduling import schedule_batches, padding_report
+from prefix_cache import PrefixCache, shared_prefix_lengths
+from tokenization_cache import (
+    load_or_build_tokenized_split,
+    flatten,
+    unflatten,
+    FlatTokenLists,
+)
+from score_cache import ScoreCache, get_score_cache_key
+from score_aggregation import ScoreAccumulator
+from columnar_logs import write_log
+from result_logging import (
+    StreamingResultWriter,
+    get_resumable_results,
+    consolidate_streamed_results,
+)
+from target_resolution import (
+    get_target_text,
+    encode_targets,
+    get_space_only_token,
+    resolve_first_target_ids,
+    resolve_full_target_ids,
+    target_id_table,
 )
-
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-if not torch.cuda.is_available():
-    raise Exception("Change runtime type to include a GPU.")
 
 
 # first, write helper to pull a pretrained LM and tokenizer off the shelf
-def get_model_and_tokenizer(model_name):
-    if "t5" in model_name.lower():
-        return AutoTokenizer.from_pretrained(
-            model_name
-        ), AutoModelForSeq2SeqLM.from_pretrained(
-            model_name, load_in_8bit=True, device_map="auto", torch_dtype=torch.float16
-        )
-
-    elif (
-        ("gpt" in model_name.lower())
-        or ("opt" in model_name.lower())
-        or ("pythia" in model_name.lower())
-        or ("bloom" in model_name.lower())
-    ):
-        return AutoTokenizer.from_pretrained(
-            model_name
-        ), AutoModelForCausalLM.from_pretrained(
-            model_name, load_in_8bit=True, device_map="auto", torch_dtype=torch.float16
+# passing a cpu_config loads it for CPU execution instead, see cpu_execution
+# the family's loader and tokenizer fixups are declared in model_families
+def get_model_and_tokenizer(model_name, cpu_config=None, revision=None):
+    if cpu_config is not None:
+        return get_cpu_model_and_tokenizer(model_name, cpu_config, revision)
+
+    family = get_model_family(model_name)
+    tokenizer = get_family_tokenizer(family, model_name, revision)
+    model = family["load_model"](
+        family["model_class"],
+        model_name,
+        trust_remote_code=family["trust_remote_code"],
+        revision=revision,
+    )
+    return tokenizer, model
+
+
+# helper to resolve the target vocab id of every entity of the dataset in one
+# batched tokenizer call, as a (rows, entities) table padded with -1
+def resolve_dataset_target_ids(tokenizer, prefix, input_dataset):
+    row_lengths = []
+    target_texts = []
+    for entities_dict in input_dataset:
+        entities = get_entities(entities_dict)
+        row_lengths.append(len(entities))
+        target_texts.extend(get_target_text(prefix, entity) for entity in entities)
+    target_tokens, target_offsets = flatten(
+        encode_targets(tokenizer, prefix, target_texts)
+    )
+    flat_target_ids = resolve_first_target_ids(
+        target_tokens, target_offsets, prefix, get_space_only_token(tokenizer, prefix)
+    )
+    return target_id_table(flat_target_ids, row_lengths)
+
+
+# helper to pair every context of the dataset with its target(s), as the
+# score cache keys them: per row, one (context, target) pairing per entity,
+# where target is the first-token vocab id, or every vocab id of the entity
+# for full-target scoring
+def get_dataset_pairings(
+    tokenizer, prefix, input_dataset, target_scoring="first_token"
+):
+    if target_scoring == "first_token":
+        target_ids = resolve_dataset_target_ids(tokenizer, prefix, input_dataset)
+    else:
+        # every vocab id of every entity, from one batched tokenizer call
+        target_texts = [
+            get_target_text(prefix, entity)
+            for entities_dict in input_dataset
+            for entity in get_entities(entities_dict)
+        ]
+        flat_target_ids = resolve_full_target_ids(
+            encode_targets(tokenizer, prefix, target_texts), prefix
         )
-
-    elif ("stablelm" in model_name.lower()) or ("redpajama" in model_name.lower()):
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
-        tokenizer.pad_token = "<|padding|>"
-        return tokenizer, AutoModelForCausalLM.from_pretrained(
-            model_name, load_in_8bit=True, device_map="auto", torch_dtype=torch.float16
-        )
-
-    elif "mpt" in model_name.lower():
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
-        tokenizer.pad_token = "<|padding|>"
-
-        bnb_config = transformers.BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_use_double_quant=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.float16,
-        )
-        model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            quantization_config=bnb_config,
-            device_map={"": 0},
-            # torch_dtype=torch.float16,
-            trust_remote_code=True,
-        )  # .to(device)
-
-        return (
-            tokenizer,
+    row_pairings = []
+    flat_itr = 0
+    for row_itr, entities_dict in enumerate(input_dataset):
+        pairings = []
+        for entity_count, entity in enumerate(get_entities(entities_dict)):
+            context = get_context(entities_dict["stem"], entity_count, prefix)
+            if target_scoring == "first_token":
+                target = int(target_ids[row_itr, entity_count])
+            else:
+                target = [int(target_id) for target_id in flat_target_ids[flat_itr]]
+                flat_itr += 1
+            pairings.append((context, target))
+        row_pairings.append(pairings)
+    return row_pairings
+
+
+# helper to split the stored counterfacts into a list of entities
+# (zeroeth entity is the true fact, next ones are counterfacts)
+def get_entities(entities_dict):
+    # convert string of list into a real list
+    if " <br> " in entities_dict["false"]:
+        counterfacts_list = entities_dict["false"].split(" <br> ")
+    else:
+        counterfacts_list = [entities_dict["false"]]
+
+    # grab true and false entities
+    entities = [entities_dict["true"]]
+    entities.extend(counterfacts_list)
+    return entities
+
+
+# helper to grab the context for a given entity
+def get_context(stem, entity_count, prefix):
+    context = stem
+    # if multiple stems are stored, grab the correct one
+    # (zeroeth stem is true fact, next ones are counterfacts)
+    if " <br> " in context:
+        context = context.split(" <br> ")
+    if type(context) == list:
+        context = context[entity_count]
+    # necessary additions based on model type (e.g. mask tokens)
+    if prefix in model_families:
+        context += model_families[prefix]["context_suffix"]
+    return context
+
+
+# helper to pull a batched probe function for the given prefix, or None
+# generate-based probes (t5, stablelm, mpt, redpajama, falcon) are batched
+# through their teacher-forced path instead
+def get_batched_probe_function(
+    prefix, teacher_forced=False, target_scoring="first_token"
+):
+    family = model_families[prefix]
+    if (target_scoring != "first_token") and family["full_target"]:
+        return functools.partial(probe_causal_sequences_batch, reduction=target_scoring)
+    if teacher_forced and (prefix in generate_probe_settings):
+        return functools.partial(probe_teacher_forced_batch, family=prefix)
+    return family["batched_probe_function"]
+
+
+# helper to score every (stem, entity) pairing of the dataset in batches
+# returns one list of probabilities per row, with the fact first, along with
+# a report on the padding of the batches that were run
+def probe_dataset_batched(
+    model,
+    tokenizer,
+    prefix,
+    input_dataset,
+    batch_size,
+    verbose=False,
+    candidate_only=False,
+    teacher_forced=False,
+    sort_by_length=True,
+    target_scoring="first_token",
+    prefix_cache=None,
+    tokenization_cache_dir=None,
+    prefetch_batches=None,
+    progress_bar=True,
+):
+    batched_probe_func = get_batched_probe_function(
+        prefix, teacher_forced, target_scoring
+    )
+    probe_kwargs = {}
+    if candidate_only:
+        probe_kwargs["candidate_only"] = True
+
+    # flatten the dataset into work items of one unique context per row
+    # the fact and its counterfacts usually share a stem, so they share a
+    # single forward pass and are gathered from the same distribution
+    contexts = []
+    entities_flat = []
+    row_offsets = []
+    item_index = []
+    model_probs = []
+    for row_itr, entities_dict in enumerate(input_dataset):
+        entities = get_entities(entities_dict)
+        row_offsets.append(len(entities_flat))
+        entities_flat.extend(entities)
+        model_probs.append([None] * len(entities))
+        row_items = {}
+        for entity_count, entity in enumerate(entities):
+            context = get_context(entities_dict["stem"], entity_count, prefix)
+            try:
+                row_items[context].append(entity_count)
+            except KeyError:
+                row_items[context] = [entity_count]
+        for context, entity_counts in row_items.items():
+            contexts.append(context)
+            item_index.append((row_itr, entity_counts))
+
+    # tokenize every context and entity once, up front, either straight from
+    # the tokenizer or through the on-disk tokenization cache
+    with profile_stage("tokenization"):
+        if tokenization_cache_dir is not None:
+            tokenized_split = load_or_build_tokenized_split(
+                tokenization_cache_dir, tokenizer, prefix, contexts, entities_flat
+            )
+            # sliced out of the memory-mapped tokens as batches are collated
+            tokenized_contexts = FlatTokenLists(
+                tokenized_split["context_tokens"], tokenized_split["context_offsets"]
+            )
+            lengths = tokenized_contexts.lengths()
+            target_tokens = tokenized_split["target_tokens"]
+            target_offsets = tokenized_split["target_offsets"]
+            space_only_token = tokenized_split["metadata"]["space_only_token"]
+        else:
+            tokenized_contexts = []
+            if contexts:
+                tokenized_contexts = tokenize_batch_contexts(
+                    tokenizer, contexts, prefix
+                )
+            lengths = [len(context_ids) for context_ids in tokenized_contexts]
+            target_tokens, target_offsets = flatten(
+                encode_targets(
+                    tokenizer,
+                    prefix,
+                    [get_target_text(prefix, entity) for entity in entities_flat],
+                )
+            )
+            space_only_token = get_space_only_token(tokenizer, prefix)
+
+    # resolve the target id(s) of every entity from its encoding
+    with profile_stage("target_resolution"):
+        if target_scoring == "first_token":
+            flat_target_ids = resolve_first_target_ids(
+                target_tokens, target_offsets, prefix, space_only_token
+            ).tolist()
+        else:
+            flat_target_ids = resolve_full_target_ids(
+                unflatten(target_tokens, target_offsets), prefix
+            )
+        target_ids = [
+            [flat_target_ids[row_offsets[row_itr] + itr] for itr in entity_counts]
+            for row_itr, entity_counts in item_index
+        ]
+
+    # schedule batches by length
+    if prefix_cache is not None:
+        # with a prefix cache, contexts run one at a time in trie order, so that
+        # a shared prefix is still cached when the next context needs it
+        prefix_lengths = shared_prefix_lengths(tokenized_contexts)
+        order = sorted(range(len(contexts)), key=lambda itr: tokenized_contexts[itr])
+        batches = [
+            order[start : start + batch_size]
+            for start in range(0, len(order), batch_size)
+        ]
+    else:
+        batches = schedule_batches(lengths, batch_size, sort_by_length)
+
+    # batches are padded (and pinned, for GPUs) ahead of their forward pass, on
+    # a background thread when prefetching
+    def collate_batch(batch):
+        return collate_probe_batch(
+            batched_probe_func,
             model,
-        )
-
-    elif "bert" in model_name.lower():
-        return AutoTokenizer.from_pretrained(
-            model_name
-        ), AutoModelForMaskedLM.from_pretrained(
-            model_name, torch_dtype=torch.float16
-        ).to(
-            device
-        )
-
-    elif "llama" in model_name.lower():
-        tokenizer = transformers.AutoTokenizer.from_pretrained(model_name)
-        tokenizer.pad_token = tokenizer.eos_token
-
-        model = transformers.LlamaForCausalLM.from_pretrained(
-            model_name, load_in_8bit=True, device_map="auto", torch_dtype=torch.float16
-        )
-        return tokenizer, model
-
-    elif "mistral" in model_name.lower():
-        tokenizer = transformers.AutoTokenizer.from_pretrained(model_name)
-        tokenizer.pad_token = tokenizer.eos_token
-
-        model = transformers.AutoModelForCausalLM.from_pretrained(
-            model_name, load_in_8bit=True, device_map="auto", torch_dtype=torch.float16
-        )
-        return tokenizer, model
-
-    elif "falcon" in model_name.lower():
-        tokenizer = transformers.AutoTokenizer.from_pretrained(model_name)
-        tokenizer.pad_token = tokenizer.eos_token
-
-        bnb_config = transformers.BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_use_double_quant=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.float16,
-        )
-        model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            quantization_config=bnb_config,
-            device_map="auto",
-            # torch_dtype=torch.float16,
-            trust_remote_code=True,
-        )  # .to(device)
-
-        return (
             tokenizer,
-            model,
+            [tokenized_contexts[itr] for itr in batch],
+            [target_ids[itr] for itr in batch],
         )
 
+    batch_producer = None
+    batch_stream = ((batch, None) for batch in batches)
+    if prefix_cache is None:
+        batch_producer = BatchProducer(
+            batches,
+            collate_batch,
+            prefetch_batches,
+            pin_memory=model.device.type == "cuda",
+        )
+        batch_stream = batch_producer
+    forward_seconds = 0.0
 
-# next, write a helper to pull a probe function for the given LM
-def get_probe_function(prefix):
-    probe_functions = [
-        probe_gpt,
-        probe_bert,
-        probe_llama,
-        probe_t5,
-        probe_stablelm,
-        probe_mpt,
-        probe_redpajama,
-        probe_falcon,
-    ]
-    for func in probe_functions:
-        if prefix.lower() in func.__name__:
-            return func
+    # run one forward pass per batch of unique contexts, then write the
+    # results back to their rows in dataset order
+    for batch, padded_batch in tqdm.tqdm(
+        batch_stream, total=len(batches), disable=not progress_bar
+    ):
+        start_time = time.perf_counter()
+        with profile_stage("forward"):
+            if prefix_cache is not None:
+                batch_probs = probe_causal_prefix_cached(
+                    model,
+                    tokenizer,
+                    [target_ids[itr] for itr in batch],
+                    [contexts[itr] for itr in batch],
+                    [tokenized_contexts[itr] for itr in batch],
+                    [prefix_lengths[itr] for itr in batch],
+                    prefix_cache,
+                    verbose,
+                )
+            else:
+                batch_probs = batched_probe_func(
+                    model,
+                    tokenizer,
+                    [target_ids[itr] for itr in batch],
+                    [contexts[itr] for itr in batch],
+                    verbose,
+                    tokenized_contexts=[tokenized_contexts[itr] for itr in batch],
+                    padded_batch=padded_batch,
+                    **probe_kwargs,
+                )
+        forward_seconds += time.perf_counter() - start_time
+        for itr, candidate_probs in zip(batch, batch_probs):
+            row_itr, entity_counts = item_index[itr]
+            for entity_count, model_prob in zip(entity_counts, candidate_probs):
+                model_probs[row_itr][entity_count] = model_prob
+
+    if prefix_cache is not None:
+        profile_tokens(sum(lengths))
+        return model_probs, {"prefix_cache": prefix_cache.report()}
+    run_stats = padding_report(lengths, batches)
+    profile_tokens(run_stats["real_tokens"])
+    # the time spent waiting on the batch producer is collation's share
+    profile_seconds("collation", batch_producer.wait_seconds)
+    run_stats["pipeline"] = dict(
+        batch_producer.report(),
+        forward_seconds=forward_seconds,
+        prefetch_batches=prefetch_batches or 0,
+    )
+    return model_probs, run_stats
+
+
+# helper to write the summary of a model's scores
+# (from its score_aggregation.ScoreAccumulator)
+def get_score_summary(accumulator):
+    overall = accumulator.overall
+    return f"This model predicted {overall.true_count}/{overall.fact_count} facts at a higher prob than the given counterfactual. In addition, the mean p_true was {np.round(overall.p_true.mean, decimals=4)} while the mean p_false_average was {np.round(overall.p_false.mean, decimals=4)}."
 
 
 # lastly, write a wrapper function to compare models
-def compare_models(model_name_list, input_dataset, verbose):
+@torch.no_grad()
+def compare_models(
+    model_name_list,
+    input_dataset,
+    verbose,
+    batch_size=None,
+    candidate_only=False,
+    teacher_forced=False,
+    sort_by_length=True,
+    target_scoring="first_token",
+    prefix_cache_mb=None,
+    tokenization_cache_dir=None,
+    prefetch_batches=None,
+    stream_log_fpath=None,
+    flush_every=100,
+    resume=False,
+    tokenizer_and_model=None,
+    language=None,
+    cpu_config=None,
+    log_dir="logging",
+    model_cache=None,
+    profile=False,
+    score_cache_fpath=None,
+    log_format="json",
+):
     """
     Model-wise comparison helper function
+
+    For the model families with batched probes, each unique stem of a row
+    gets one forward pass shared by the fact and its counterfacts, and
+    batch_size sets how many such stems run together (default of one)
+
+    Setting candidate_only has causal models project only the last position
+    through the LM head and return just the candidate probabilities
+
+    Setting teacher_forced scores the generate-based families (t5, stablelm,
+    falcon, mpt, redpajama) with forward passes instead of model.generate
+
+    Batched stems run longest first when sort_by_length is set, to cut padding;
+    results are still recorded in dataset order, and each model's padding
+    efficiency is logged under run_report
+
+    target_scoring picks how causal models score an entity: "first_token" reads
+    the probability of its first sub-token, while "sum" and "mean" reduce the
+    log-probs of all of its sub-tokens (the recorded p_true and p_false are
+    exp of that score)
+
+    Setting prefix_cache_mb has causal models run each shared stem prefix once
+    and reuse its past_key_values, from an LRU cache of that many megabytes;
+    hit rate and tokens saved are logged under run_report
+
+    Setting tokenization_cache_dir has batched probes load the token ids of
+    every stem and entity from an on-disk cache in that folder, built on first
+    use and rebuilt whenever the tokenizer changes
+
+    Setting prefetch_batches has a background thread pad (and, on GPU, pin)
+    up to that many upcoming batches while the current one runs; the time
+    spent collating, waiting on collation and in forward passes is logged
+    under run_report either way
+
+    Setting stream_log_fpath appends every scored row to that JSONL file as it
+    is recorded, fsync'ing every flush_every rows, instead of holding them in
+    memory; with resume set, rows whose dataset_id is already in the file are
+    skipped. The consolidated json log is written the same way either way
+
+    A (tokenizer, model) pair already loaded for the single model in
+    model_name_list can be passed as tokenizer_and_model, e.g. to sweep several
+    languages with one load; setting language prefixes the log file name with
+    it, as post_process_logs_folder.py expects
+
+    Setting cpu_config (a dict, see cpu_execution.default_cpu_config) loads
+    models for CPU execution, with the given threads, dtype and quantization.
+    Every model's throughput in facts/sec is logged under run_report
+
+    Passing a model_cache (see model_cache.ModelCache) takes models from it,
+    and leaves them there after the run, instead of loading and freeing them;
+    its hit, miss, eviction and load time counts are logged under run_report
+
+    Setting profile records the wall time of each stage of every model's run
+    (see run_profiling.py), with its facts/sec, tokens/sec and peak memory,
+    under run_report and in a "-profile.json" sidecar next to the json log
+
+    Setting score_cache_fpath looks every row up in that SQLite score cache
+    (see score_cache.py) before any forward passes, keyed by model, revision,
+    precision and scoring; only the rows with a pairing missing from it are
+    run, and their scores are added to it. Row hits and misses are logged
+    under run_report
+
+    Every model's accuracy, p_true and p_false moments and log-ratio histogram,
+    overall and per relation, subject type and source (see
+    score_aggregation.py), are accumulated as rows are recorded and logged
+    under score_aggregates
+
+    The log is written to log_dir, "logging" by default, as json or, with a
+    log_format of "parquet", as a columnar Parquet file (see columnar_logs.py)
     """
 
     print("Made it to start of compare models")
 
     score_dict_full = {}
     score_dict_summary = {}
+    score_aggregates = {}
+    run_report = {}
     itr_run_babysitting = 0
     list_run_babysitting = list(np.arange(0, 26300, 1000))
 
-    if not os.path.isdir("logging"):
-        os.mkdir("logging")
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
 
     now = datetime.datetime.now()
     dt_string = now.strftime("%d-%m-%Y-%H-%M-%S")
 
+    result_writer = None
+    if stream_log_fpath is not None:
+        result_writer = StreamingResultWriter(stream_log_fpath, flush_every, resume)
+    elif resume:
+        raise Exception("Resuming requires a stream_log_fpath.")
+
     for model_name in model_name_list:
-        true_count = 0
-        fact_count = 0
-        p_falses = []
-        p_trues = []
+        # accuracy, score moments and breakdowns, updated as rows are recorded
+        accumulator = ScoreAccumulator()
+
+        # with resume, count the rows of the partial log and only run the rest
+        model_dataset = input_dataset
+        row_itrs = range(len(input_dataset))
+        if resume:
+            resumed_results = get_resumable_results(
+                stream_log_fpath, model_name.lower()
+            )
+            row_itrs = []
+            for row_itr, entities_dict in enumerate(input_dataset):
+                resumed_data = resumed_results.get(entities_dict.get("dataset_id"))
+                if resumed_data is None:
+                    row_itrs.append(row_itr)
+                    continue
+                accumulator.update(resumed_data)
+            model_dataset = [input_dataset[row_itr] for row_itr in row_itrs]
+            print(
+                f"Resuming {model_name}, {accumulator.overall.fact_count} rows already scored"
+            )
 
         print(f"CKA for {model_name}")
-        print("Loading  model...")
+        family = get_model_family(model_name)
 
         # get proper model and tokenizer
-        tokenizer, model = get_model_and_tokenizer(model_name)
+        if tokenizer_and_model is not None:
+            if len(model_name_list) > 1:
+                raise Exception("A preloaded model only covers one model name.")
+            tokenizer, model = tokenizer_and_model
+        elif model_cache is not None:
+            tokenizer, model = model_cache.get(model_name, cpu_config)
+        else:
+            print("Loading  model...")
+            tokenizer, model = get_model_and_tokenizer(model_name, cpu_config)
 
         print("Running comparisons...")
-
-        # establish prefix
-        prefix = ""
-        probe_func = None
-
-        # get correct CKA function
-        if "t5" in model_name.lower():
-            prefix = "t5"
-            probe_func = get_probe_function(prefix)
-        elif (
-            ("gpt-neo" in model_name.lower())
-            or ("gpt-j" in model_name.lower())
-            or ("pythia" in model_name.lower())
-        ):
-            prefix = "eleutherai"
-            probe_func = get_probe_function("gpt")
-
-        elif "gpt" in model_name.lower():
-            prefix = "gpt"
-            probe_func = get_probe_function(prefix)
-
-        elif "opt" in model_name.lower():
-            prefix = "opt"
-            probe_func = get_probe_function("gpt")
-
-        elif "roberta" in model_name.lower():
-            prefix = "roberta"
-            probe_func = get_probe_function("bert")
-
-        elif "bert" in model_name.lower():
-            prefix = "bert"
-            probe_func = get_probe_function(prefix)
-
-        elif "llama" in model_name.lower():
-            prefix = "llama"
-            probe_func = get_probe_function(prefix)
-
-        elif "mistral" in model_name.lower():
-            prefix = "mistral"
-            probe_func = get_probe_function("llama")
-
-        elif "bloom" in model_name.lower():
-            prefix = "bloom"
-            probe_func = get_probe_function("gpt")
-
-        elif "stablelm" in model_name.lower():
-            prefix = "stablelm"
-            probe_func = get_probe_function(prefix)
-
-        elif "mpt" in model_name.lower():
-            prefix = "mpt"
-            probe_func = get_probe_function(prefix)
-
-        elif "redpajama" in model_name.lower():
-            prefix = "redpajama"
-            probe_func = get_probe_function(prefix)
-
-        elif "falcon" in model_name.lower():
-            prefix = "falcon"
-            probe_func = get_probe_function(prefix)
+        start_time = time.perf_counter()
+        resumed_count = accumulator.overall.fact_count
+        profiler = None
+        if profile:
+            profiler = StageProfiler()
+            set_active_profiler(profiler)
+
+        # establish prefix and get correct CKA function
+        prefix = family["prefix"]
+        probe_func = family["probe_function"]
+
+        batched_probe_func = get_batched_probe_function(
+            prefix, teacher_forced, target_scoring
+        )
+        if candidate_only and (batched_probe_func is not probe_causal_batch):
+            raise Exception(f"Candidate-only scoring not supported for {model_name}.")
+        if (target_scoring != "first_token") and (not family["full_target"]):
+            raise Exception(f"Full-target scoring not supported for {model_name}.")
+        prefix_cache = None
+        if prefix_cache_mb is not None:
+            if (batched_probe_func is not probe_causal_batch) or candidate_only:
+                raise Exception(f"Prefix caching not supported for {model_name}.")
+            prefix_cache = PrefixCache(max_megabytes=prefix_cache_mb)
+
+        # with a score cache, fill in the rows it already holds, leaving only
+        # the rest to run
+        score_cache = None
+        model_probs = None
+        uncached_dataset = model_dataset
+        if score_cache_fpath is not None:
+            with profile_stage("score_cache"):
+                score_cache = ScoreCache(score_cache_fpath, flush_every)
+                score_cache_key = get_score_cache_key(
+                    model_name, model, target_scoring, teacher_forced
+                )
+                row_pairings = get_dataset_pairings(
+                    tokenizer, prefix, model_dataset, target_scoring
+                )
+                model_probs = score_cache.lookup_rows(score_cache_key, row_pairings)
+            uncached_itrs = [
+                row_itr
+                for row_itr, row_probs in enumerate(model_probs)
+                if row_probs is None
+            ]
+            uncached_rows = set(uncached_itrs)
+            uncached_dataset = [model_dataset[row_itr] for row_itr in uncached_itrs]
+            print(
+                f"Score cache: {len(model_dataset) - len(uncached_dataset)}/{len(model_dataset)} rows already scored"
+            )
+
+        # where batched probes exist, score every pairing up front
+        if (batched_probe_func is not None) and (not uncached_dataset):
+            run_report[model_name.lower()] = {}
+        elif batched_probe_func is not None:
+            batched_probs, run_stats = probe_dataset_batched(
+                model,
+                tokenizer,
+                prefix,
+                uncached_dataset,
+                batch_size or 1,
+                verbose,
+                candidate_only=candidate_only,
+                teacher_forced=teacher_forced,
+                sort_by_length=sort_by_length,
+                target_scoring=target_scoring,
+                prefix_cache=prefix_cache,
+                tokenization_cache_dir=tokenization_cache_dir,
+                prefetch_batches=prefetch_batches,
+            )
+            if score_cache is not None:
+                for row_itr, row_probs in zip(uncached_itrs, batched_probs):
+                    model_probs[row_itr] = row_probs
+            else:
+                model_probs = batched_probs
+            run_report[model_name.lower()] = run_stats
+            if "padding_efficiency" in run_stats:
+                print(
+                    f"Padding efficiency (real / padded tokens): {np.round(run_stats['padding_efficiency'], decimals=4)}"
+                )
+            if "prefix_cache" in run_stats:
+                print(
+                    f"Prefix cache hit rate: {np.round(run_stats['prefix_cache']['hit_rate'], decimals=4)}, tokens saved: {run_stats['prefix_cache']['tokens_saved']}"
+                )
+            if "pipeline" in run_stats:
+                print(
+                    f"Collation: {np.round(run_stats['pipeline']['collate_seconds'], 3)}s, of which hidden behind forward passes: {np.round(run_stats['pipeline']['hidden_seconds'], 3)}s"
+                )
+        elif uncached_dataset:
+            with profile_stage("target_resolution"):
+                target_ids = resolve_dataset_target_ids(
+                    tokenizer, prefix, model_dataset
+                )
+        if resume:
+            run_report.setdefault(model_name.lower(), {})[
+                "resumed_rows"
+            ] = resumed_count
 
         # iterate over context/entity pairings
         # input_dataset is a datasets dataset
         # context is a plain string (since our context's will be unique)
         # and entities is a list containing, in the first slot, the true
         # value for the statement and in the subsequent slots, incorrect information
-        for entities_dict in tqdm.tqdm(input_dataset):
-            # convert string of list into a real list
-            if " <br> " in entities_dict["false"]:
-                counterfacts_list = entities_dict["false"].split(" <br> ")
-            else:
-                counterfacts_list = [entities_dict["false"]]
-
+        for row_itr, entities_dict in enumerate(tqdm.tqdm(model_dataset)):
             # intitiate vars
             p_true = 0.0
             p_false = 0.0
             p_false_list_inner = []
+            row_probs = []
+            row_cached = (model_probs is not None) and (
+                model_probs[row_itr] is not None
+            )
 
             # grab true and false entities
-            entities = [entities_dict["true"]]
-            entities.extend(counterfacts_list)
+            entities = get_entities(entities_dict)
 
             # iterate through each fact and counterfact
             for entity_count, entity in enumerate(entities):
                 # grab the context
-                context = entities_dict["stem"]
-                # if multiple stems are stored, grab the correct one
-                # (zeroeth stem is true fact, next ones are counterfacts)
-                if " <br> " in context:
-                    context = context.split(" <br> ")
-                if type(context) == list:
-                    context = context[entity_count]
-                # necessary additions based on model type
-                if prefix == "roberta":
-                    context += " <mask>."
-                elif prefix == "bert":
-                    context += " [MASK]."
-
-                # first find target vocab id
-                # default to the very first token that get's predicted
-                # e.g. in the case of Tokyo, which gets split into <Tok> <yo>,
-                target_id = None
-                if prefix == "t5":
-                    target_ids = tokenizer.encode(
-                        " " + entity,
-                        padding="longest",
-                        max_length=512,
-                        truncation=True,
-                        return_tensors="pt",
-                    ).tolist()
-                    space_only_token = tokenizer.encode(" ")[0]
-                    try:
-                        target_ids[0].remove(space_only_token)
-                    except ValueError:
-                        pass
-                    target_id = torch.tensor(target_ids).to(device)[0][0]
-
-                elif (
-                    (prefix == "gpt")
-                    or (prefix == "eleutherai")
-                    or (prefix == "bloom")
-                    or (prefix == "stablelm")
-                    or (prefix == "mpt")
-                    or (prefix == "redpajama")
-                ):
-                    target_id = tokenizer.encode(" " + entity, return_tensors="pt").to(
-                        device
-                    )[0][0]
-
-                elif prefix == "falcon":
-                    target_id = tokenizer.encode(
-                        " " + entity, return_token_type_ids=False, return_tensors="pt"
-                    ).to(device)[0][0]
-
-                elif prefix == "opt":
-                    target_id = tokenizer.encode(" " + entity, return_tensors="pt").to(
-                        device
-                    )[0][1]
-
-                elif prefix == "roberta":
-                    target_id = tokenizer.encode(
-                        " " + entity,
-                        padding="longest",
-                        max_length=512,
-                        truncation=True,
-                        return_tensors="pt",
-                    ).to(device)[0][1]
-
-                elif prefix == "bert":
-                    target_id = tokenizer.encode(
-                        entity,
-                        padding="longest",
-                        max_length=512,
-                        truncation=True,
-                        return_tensors="pt",
-                    ).to(device)[0][1]
-
-                elif (prefix == "llama") or (prefix == "mistral"):
-                    target_id = tokenizer.encode(" " + entity, return_tensors="pt").to(
-                        device
-                    )[0][2]
-
-                # next call probe function
-                model_prob = probe_func(model, tokenizer, target_id, context, verbose)
+                context = get_context(entities_dict["stem"], entity_count, prefix)
+
+                if row_cached:
+                    # batched probes (or the score cache) already scored this pairing
+                    model_prob = model_probs[row_itr][entity_count]
+                else:
+                    # first find target vocab id, resolved for the whole split
+                    target_id = torch.tensor(target_ids[row_itr, entity_count])
+
+                    # next call probe function
+                    with profile_stage("forward"):
+                        model_prob = probe_func(
+                            model, tokenizer, target_id, context, verbose
+                        )
+
+                row_probs.append(model_prob)
 
                 # lastly, register results
                 # if it is the first time through, it is the fact
@@ -358,6 +661,10 @@ def compare_models(model_name_list, input_dataset, verbose):
                     p_false += model_prob
                     p_false_list_inner.append(float(model_prob))
 
+            # add newly scored rows to the score cache
+            if (score_cache is not None) and (row_itr in uncached_rows):
+                score_cache.store_row(score_cache_key, row_pairings[row_itr], row_probs)
+
             # entity count is equal to the num counterfactuals
             # (since it started at a 0 index in the enumerate)
             p_false /= entity_count
@@ -393,38 +700,83 @@ def compare_models(model_name_list, input_dataset, verbose):
                 score_dict_full_data["dataset_id"] = entities_dict["dataset_id"]
             except KeyError:
                 pass
-
-            # add results to the given model name
             try:
-                score_dict_full[model_name.lower()].append(score_dict_full_data)
+                score_dict_full_data["subject_type"] = entities_dict["subject_type"]
             except KeyError:
-                score_dict_full[model_name.lower()] = [score_dict_full_data]
+                pass
 
-            # append p_false and p_true
-            p_falses.append(float(p_false))
-            p_trues.append(float(p_true))
+            # add results to the given model name
+            with profile_stage("logging"):
+                if result_writer is not None:
+                    result_writer.write(
+                        model_name.lower(), row_itrs[row_itr], score_dict_full_data
+                    )
+                else:
+                    try:
+                        score_dict_full[model_name.lower()].append(score_dict_full_data)
+                    except KeyError:
+                        score_dict_full[model_name.lower()] = [score_dict_full_data]
 
-            # update counts based on probs
-            if p_true > p_false:
-                true_count += 1
-            fact_count += 1
+            # update counts and score aggregates
+            accumulator.update(score_dict_full_data)
 
             # randomly print some during training to checkin on thing
             if itr_run_babysitting in list_run_babysitting:
                 print(
                     f"\nRandom prints, itr {itr_run_babysitting}: \n\t{score_dict_full_data}"
                 )
+                print(
+                    f"\tRunning accuracy: {np.round(accumulator.overall.true_count / accumulator.overall.fact_count, decimals=4)}"
+                )
             itr_run_babysitting += 1
 
         # record the summary dict
-        score_dict_summary[
-            model_name.lower()
-        ] = f"This model predicted {true_count}/{fact_count} facts at a higher prob than the given counterfactual. In addition, the mean p_true was {np.round(np.mean(np.array(p_trues)), decimals=4)} while the mean p_false_average was {np.round(np.mean(np.array(p_falses)), decimals=4)}."
+        score_dict_summary[model_name.lower()] = get_score_summary(accumulator)
+        score_aggregates[model_name.lower()] = accumulator.report()
+
+        # record throughput, over the rows scored in this run
+        run_seconds = time.perf_counter() - start_time
+        scored_count = accumulator.overall.fact_count - resumed_count
+        model_report = run_report.setdefault(model_name.lower(), {})
+        model_report["seconds"] = run_seconds
+        model_report["facts_per_second"] = (
+            scored_count / run_seconds if run_seconds else 0.0
+        )
+        model_report["execution"] = {
+            "device": str(model.device),
+            "dtype": str(model.dtype),
+            "num_threads": torch.get_num_threads(),
+            "cpu_config": cpu_config,
+        }
+        print(f"Throughput: {np.round(model_report['facts_per_second'], 2)} facts/sec")
+
+        # read the streamed rows back, in dataset order, for the json log
+        if result_writer is not None:
+            with profile_stage("logging"):
+                result_writer.flush()
+                score_dict_full[model_name.lower()] = consolidate_streamed_results(
+                    stream_log_fpath, model_name.lower()
+                )
+
+        if profiler is not None:
+            model_report["profile"] = profiler.report(scored_count)
+            set_active_profiler(None)
+
+        if model_cache is not None:
+            model_report["model_cache"] = model_cache.report()
+
+        if score_cache is not None:
+            score_cache.close()
+            model_report["score_cache"] = score_cache.report()
 
         print("Done\n")
         del tokenizer
         del model
-        torch.cuda.empty_cache()
+        if model_cache is None:
+            torch.cuda.empty_cache()
+
+    if result_writer is not None:
+        result_writer.close()
 
     score_dicts = [score_dict_full, score_dict_summary]
 
@@ -438,10 +790,17 @@ def compare_models(model_name_list, input_dataset, verbose):
 
     score_dicts_logging["score_dict_summary"] = score_dict_summary
     score_dicts_logging["score_dict_full"] = score_dict_full
+    score_dicts_logging["score_aggregates"] = score_aggregates
+    score_dicts_logging["run_report"] = run_report
+
+    log_fname = f"{prefix}-logged-cka-outputs-{dt_string}.{log_format}"
+    if language is not None:
+        log_fname = f"{language}-{log_fname}"
+    log_fpath = os.path.join(log_dir, log_fname)
 
-    log_fpath = f"logging/{prefix}-logged-cka-outputs-{dt_string}.json"
+    write_log(score_dicts_logging, log_fpath)
 
-    with open(log_fpath, "w") as outfile:
-        json.dump(score_dicts_logging, outfile)
+    if profile:
+        write_profile_sidecar(log_fpath, run_report)
 
     return score_dicts, log_fpath
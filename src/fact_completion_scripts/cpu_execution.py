@@ -0,0 +1,262 @@
+"""
+CPU execution mode for fact-completion runs
+
+Small and medium models (GPT-2, Pythia-410m, mBERT, mT5-small) can be scored
+on CPU fleets instead of GPUs. The CPU path loads models without bitsandbytes,
+in fp32, bf16, fp16 or the checkpoint's own dtype, optionally with dynamic int8
+quantization of the Linear layers, and sets the torch intra-op threads, pinned
+to one NUMA node's cores if asked.
+
+Example usage, comparing facts/sec against the default path:
+python cpu_execution.py \
+    --model gpt2 \
+    --language en \
+    --num_facts 500 \
+    --num_threads 8 \
+    --quantize_int8 True
+"""
+
+import os
+import json
+from argparse import ArgumentParser
+import numpy as np
+import torch
+from transformers.pytorch_utils import Conv1D
+
+from model_families import get_model_family, get_family_tokenizer
+from shared_weights import load_shared_model
+
+# "auto" keeps the dtype the checkpoint was saved in
+cpu_dtypes = {
+    "fp32": torch.float32,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+    "auto": "auto",
+}
+
+# defaults for the cpu_config dict
+default_cpu_config = {
+    # torch intra-op threads, None keeps torch's default (or the NUMA node size)
+    "num_threads": None,
+    # "fp32", "bf16", "fp16" or "auto", None is fp32, or auto with shared weights
+    "dtype": None,
+    # dynamically quantize the Linear layers to int8 (fp32 models only)
+    "quantize_int8": False,
+    # pin the process to the cores of this NUMA node, None leaves it unpinned
+    "numa_node": None,
+    # point the weights at the memory-mapped safetensors checkpoint, so that
+    # forked workers share them (see shared_weights.py)
+    "share_weights": False,
+}
+
+
+# helper to fill in and check a cpu_config
+def get_cpu_config(cpu_config):
+    cpu_config = dict(default_cpu_config, **(cpu_config or {}))
+    if cpu_config["dtype"] is None:
+        cpu_config["dtype"] = "auto" if cpu_config["share_weights"] else "fp32"
+    if cpu_config["dtype"] not in cpu_dtypes:
+        raise Exception(f"CPU dtype {cpu_config['dtype']} not supported.")
+    if cpu_config["quantize_int8"] and (cpu_config["dtype"] != "fp32"):
+        raise Exception("Dynamic int8 quantization needs an fp32 model.")
+    if cpu_config["quantize_int8"] and cpu_config["share_weights"]:
+        raise Exception("Shared weights can't be quantized in place.")
+    return cpu_config
+
+
+# helper to list the cores of a NUMA node, from e.g. "0-3,8-11"
+def get_numa_node_cpus(numa_node):
+    cpulist_fpath = f"/sys/devices/system/node/node{numa_node}/cpulist"
+    if not os.path.isfile(cpulist_fpath):
+        raise Exception(f"NUMA node {numa_node} not found.")
+    with open(cpulist_fpath, "r") as infile:
+        cpulist = infile.read().strip()
+
+    cpus = []
+    for cpu_range in cpulist.split(","):
+        if "-" in cpu_range:
+            first, last = cpu_range.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(cpu_range))
+    return cpus
+
+
+# helper to pin the process and set torch's intra-op threads
+# pinning keeps every thread, and the memory it first touches, on one node
+def configure_cpu_threads(cpu_config):
+    num_threads = cpu_config["num_threads"]
+    if cpu_config["numa_node"] is not None:
+        if not hasattr(os, "sched_setaffinity"):
+            raise Exception("NUMA pinning needs os.sched_setaffinity (Linux).")
+        cpus = get_numa_node_cpus(cpu_config["numa_node"])
+        os.sched_setaffinity(0, cpus)
+        if num_threads is None:
+            num_threads = len(cpus)
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    return torch.get_num_threads()
+
+
+# helper to swap GPT-2-style Conv1D layers (Linear layers with transposed
+# weights) for the equivalent Linear layers, so dynamic quantization covers them
+def convert_conv1d_to_linear(model):
+    for name, module in list(model.named_modules()):
+        if not isinstance(module, Conv1D):
+            continue
+        in_features, out_features = module.weight.shape
+        linear = torch.nn.Linear(
+            in_features, out_features, dtype=module.weight.dtype, device="meta"
+        )
+        linear.weight = torch.nn.Parameter(module.weight.detach().t().contiguous())
+        linear.bias = torch.nn.Parameter(module.bias.detach())
+        parent_name, _, child_name = name.rpartition(".")
+        setattr(model.get_submodule(parent_name), child_name, linear)
+    return model
+
+
+# helper to dynamically quantize a model's Linear layers to int8, raising if
+# there are none, so that an unquantized model is never reported as int8
+def quantize_model_int8(model, model_name):
+    model = torch.ao.quantization.quantize_dynamic(
+        convert_conv1d_to_linear(model), {torch.nn.Linear}, dtype=torch.qint8
+    )
+    quantized_count = sum(
+        type(module).__module__.startswith("torch.ao.nn.quantized")
+        for module in model.modules()
+    )
+    if quantized_count == 0:
+        raise Exception(f"{model_name} has no Linear layers to quantize to int8.")
+    print(f"Quantized {quantized_count} Linear layers to int8")
+    return model
+
+
+def get_cpu_model_and_tokenizer(model_name, cpu_config=None, revision=None):
+    """
+    CPU counterpart of compare_models.get_model_and_tokenizer
+
+    Loads the family's model class and tokenizer settings without bitsandbytes,
+    in the cpu_config's dtype, or straight onto the memory-mapped checkpoint
+    (in its own dtype) when sharing weights. Dynamic int8 quantization covers
+    torch.nn.Linear layers, and GPT-2's Conv1D layers once swapped for them
+    """
+    cpu_config = get_cpu_config(cpu_config)
+    num_threads = configure_cpu_threads(cpu_config)
+    print(
+        f"CPU mode: {num_threads} threads, {cpu_config['dtype']}, int8 {cpu_config['quantize_int8']}"
+    )
+
+    family = get_model_family(model_name)
+    tokenizer = get_family_tokenizer(family, model_name, revision)
+    if cpu_config["share_weights"]:
+        model, sharing_report = load_shared_model(
+            family["model_class"],
+            model_name,
+            None if cpu_config["dtype"] == "auto" else cpu_dtypes[cpu_config["dtype"]],
+            trust_remote_code=family["trust_remote_code"],
+            revision=revision,
+        )
+        print(
+            f"Shared weights: {np.round(sharing_report['shared_megabytes'], 1)} MB mapped, {np.round(sharing_report['unshared_megabytes'], 1)} MB private"
+        )
+    else:
+        model = (
+            family["model_class"]
+            .from_pretrained(
+                model_name,
+                torch_dtype=cpu_dtypes[cpu_config["dtype"]],
+                trust_remote_code=family["trust_remote_code"],
+                revision=revision,
+            )
+            .eval()
+        )
+    if cpu_config["quantize_int8"]:
+        model = quantize_model_int8(model, model_name)
+    return tokenizer, model
+
+
+def compare_throughput(model_name, input_dataset, cpu_config, batch_size=None):
+    """
+    Score the same facts on the default path and in CPU mode, and report the
+    facts/sec of each along with the CPU mode's speedup
+
+    The default path is the GPU loader when CUDA is available, otherwise plain
+    fp32 with torch's default threads
+    """
+    # imported here, since compare_models imports this module
+    from compare_models import compare_models
+
+    runs = [("default", None), ("cpu", get_cpu_config(cpu_config))]
+    throughput_report = {}
+    for label, run_cpu_config in runs:
+        if (run_cpu_config is None) and (not torch.cuda.is_available()):
+            run_cpu_config = get_cpu_config(None)
+        _, log_fpath = compare_models(
+            [model_name],
+            input_dataset,
+            False,
+            batch_size=batch_size,
+            cpu_config=run_cpu_config,
+        )
+        with open(log_fpath, "r") as infile:
+            run_report = json.load(infile)["run_report"][model_name.lower()]
+        throughput_report[label] = {
+            "facts_per_second": run_report["facts_per_second"],
+            "execution": run_report["execution"],
+        }
+
+    throughput_report["cpu_speedup"] = (
+        throughput_report["cpu"]["facts_per_second"]
+        / throughput_report["default"]["facts_per_second"]
+    )
+    return throughput_report
+
+
+if __name__ == "__main__":
+    from datasets import load_dataset
+    from post_process_logs_folder import supported_languages
+
+    parser = ArgumentParser()
+    parser.add_argument("--model", type=str, default="gpt2", help="Model name")
+    parser.add_argument("--language", type=str, default="en", help="Language code")
+    parser.add_argument(
+        "--num_facts", type=int, default=500, help="Number of facts to score"
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=None, help="Stems per forward pass"
+    )
+    parser.add_argument(
+        "--num_threads", type=int, default=None, help="Torch intra-op threads"
+    )
+    parser.add_argument(
+        "--dtype", type=str, default="fp32", help="fp32, bf16, fp16 or auto"
+    )
+    parser.add_argument(
+        "--quantize_int8",
+        type=bool,
+        default=False,
+        help="Whether to dynamically quantize Linear layers to int8",
+    )
+    parser.add_argument(
+        "--numa_node", type=int, default=None, help="NUMA node to pin to"
+    )
+    args = parser.parse_args()
+
+    dataset = load_dataset(
+        "Polyglot-or-Not/Fact-Completion",
+        split=supported_languages[args.language].capitalize(),
+    )
+    dataset = dataset.select(range(min(args.num_facts, len(dataset))))
+
+    throughput_report = compare_throughput(
+        args.model,
+        dataset,
+        {
+            "num_threads": args.num_threads,
+            "dtype": args.dtype,
+            "quantize_int8": args.quantize_int8,
+            "numa_node": args.numa_node,
+        },
+        batch_size=args.batch_size,
+    )
+    print(json.dumps(throughput_report, indent=4))
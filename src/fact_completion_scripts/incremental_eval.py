@@ -0,0 +1,280 @@
+"""
+Incremental re-evaluation of a model against a new dataset version
+
+The dataset gets republished as dated parquet files (e.g.
+en-fact-completion-3-20-23.parquet, then -3-21-23), and every change used to
+force a full re-run. Here the old and new versions are diffed by dataset_id
+and a content hash of each row's stem, true and false entities; only added or
+changed rows are scored, the unchanged ones are carried over from the result
+log of the old version, and a complete log of the new version is written,
+with the provenance of every row (reused or rescored, and why).
+
+A carried-over row is rescored anyway if the old log doesn't hold it, or holds
+other entities than the old version did (i.e. the log is of another version).
+
+Example usage:
+python incremental_eval.py \
+    --model gpt2 \
+    --language en \
+    --old_version ../../data/ingested_data/en-fact-completion-3-20-23.parquet \
+    --new_version ../../data/ingested_data/en-fact-completion-3-21-23.parquet \
+    --previous_log logging/en-gpt-logged-cka-outputs-20-03-2023-10-00-00.json
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import time
+from argparse import ArgumentParser
+import pandas as pd
+
+from compare_models import (
+    compare_models,
+    get_entities,
+    get_context,
+    get_score_summary,
+)
+from model_families import get_model_family
+from score_aggregation import accumulate_rows
+from columnar_logs import load_log, write_log
+
+
+# helper to read a dataset version's parquet file into a list of rows
+# early versions (e.g. 3-20-23) store counterfacts as lists, which are joined
+# with <br> delimiters as in the published splits
+def load_dataset_version(fpath):
+    input_dataset = pd.read_parquet(fpath).to_dict("records")
+    for entities_dict in input_dataset:
+        for key in ["stem", "false"]:
+            if not isinstance(entities_dict[key], str):
+                entities_dict[key] = " <br> ".join(entities_dict[key])
+    return input_dataset
+
+
+# content hash of the fields of a row that its scores depend on
+def get_row_hash(entities_dict):
+    content = [entities_dict["stem"], entities_dict["true"], entities_dict["false"]]
+    return hashlib.sha256(json.dumps(content).encode("utf-8")).hexdigest()
+
+
+# helper to key the rows of a dataset version by dataset_id
+def get_rows_by_id(input_dataset):
+    rows_by_id = {}
+    for entities_dict in input_dataset:
+        dataset_id = entities_dict.get("dataset_id")
+        if dataset_id is None:
+            raise Exception("Incremental evaluation needs a dataset_id on every row.")
+        if dataset_id in rows_by_id:
+            raise Exception(f"Duplicate dataset_id {dataset_id}.")
+        rows_by_id[dataset_id] = entities_dict
+    return rows_by_id
+
+
+def diff_dataset_versions(old_dataset, new_dataset):
+    """
+    Diff two dataset versions by dataset_id and row content hash
+
+    Returns the dataset_ids that were added, changed, unchanged (in the new
+    version's order) and removed (in the old version's order)
+    """
+    old_rows = get_rows_by_id(old_dataset)
+    new_rows = get_rows_by_id(new_dataset)
+    diff = {"added": [], "changed": [], "unchanged": [], "removed": []}
+    for dataset_id, entities_dict in new_rows.items():
+        if dataset_id not in old_rows:
+            diff["added"].append(dataset_id)
+        elif get_row_hash(old_rows[dataset_id]) != get_row_hash(entities_dict):
+            diff["changed"].append(dataset_id)
+        else:
+            diff["unchanged"].append(dataset_id)
+    diff["removed"] = [
+        dataset_id for dataset_id in old_rows if dataset_id not in new_rows
+    ]
+    return diff
+
+
+# helper to check a logged row was scored on the stem and entities of a
+# dataset row; logs only keep the context of the last entity, so where the log
+# is itself an incremental one, the content hash it recorded is checked too
+def logged_row_matches(score_dict, entities_dict, prefix, content_hash=None):
+    if (content_hash is not None) and (content_hash != get_row_hash(entities_dict)):
+        return False
+    entities = get_entities(entities_dict)
+    return (
+        (score_dict["fact"] == entities[0])
+        and (list(score_dict["counterfact"]) == entities[1:])
+        and (
+            score_dict["stem"]
+            == get_context(entities_dict["stem"], len(entities) - 1, prefix)
+        )
+    )
+
+
+def incremental_compare_models(
+    model_name,
+    old_dataset,
+    new_dataset,
+    previous_log_fpath,
+    verbose=False,
+    log_dir="logging",
+    language=None,
+    **compare_kwargs,
+):
+    """
+    Score the new dataset version, reusing the old version's log where rows
+    are unchanged
+
+    The rows to rescore run through compare_models (with compare_kwargs) into
+    a log of their own, in an "incremental-<datetime>" folder of log_dir, and
+    are merged with the reused rows, in the new version's order, into a log in
+    log_dir named like compare_models' own. Returns the merged log path and
+    its provenance
+    """
+    previous_log = load_log(previous_log_fpath)
+    previous_rows = {
+        score_dict["dataset_id"]: score_dict
+        for score_dict in previous_log["score_dict_full"].get(model_name.lower(), [])
+        if "dataset_id" in score_dict
+    }
+    previous_provenance = (
+        previous_log.get("provenance", {}).get(model_name.lower(), {}).get("rows", {})
+    )
+    prefix = get_model_family(model_name)["prefix"]
+    diff = diff_dataset_versions(old_dataset, new_dataset)
+    old_rows = get_rows_by_id(old_dataset)
+    unchanged_ids = set(diff["unchanged"])
+    changed_ids = set(diff["changed"])
+
+    # work out every row's source, in the new version's order
+    row_provenance = {}
+    rescored_dataset = []
+    for entities_dict in new_dataset:
+        dataset_id = entities_dict["dataset_id"]
+        if dataset_id in unchanged_ids:
+            score_dict = previous_rows.get(dataset_id)
+            if score_dict is None:
+                reason = "missing_from_previous_log"
+            elif not logged_row_matches(
+                score_dict,
+                old_rows[dataset_id],
+                prefix,
+                previous_provenance.get(dataset_id, {}).get("content_hash"),
+            ):
+                reason = "previous_log_mismatch"
+            else:
+                reason = "unchanged"
+        else:
+            reason = "changed" if dataset_id in changed_ids else "added"
+        row_provenance[dataset_id] = {
+            "source": "reused" if reason == "unchanged" else "rescored",
+            "reason": reason,
+            "content_hash": get_row_hash(entities_dict),
+        }
+        if reason != "unchanged":
+            rescored_dataset.append(entities_dict)
+    print(
+        f"Incremental run of {model_name}: {len(new_dataset) - len(rescored_dataset)} rows reused, {len(rescored_dataset)} to rescore"
+    )
+
+    dt_string = datetime.datetime.now().strftime("%d-%m-%Y-%H-%M-%S")
+    start_time = time.perf_counter()
+    run_report = {}
+    rescored_rows = {}
+    if rescored_dataset:
+        _, rescored_log_fpath = compare_models(
+            [model_name],
+            rescored_dataset,
+            verbose,
+            log_dir=os.path.join(log_dir, f"incremental-{dt_string}"),
+            language=language,
+            **compare_kwargs,
+        )
+        rescored_log = load_log(rescored_log_fpath)
+        rescored_rows = {
+            score_dict["dataset_id"]: score_dict
+            for score_dict in rescored_log["score_dict_full"][model_name.lower()]
+        }
+        run_report = rescored_log["run_report"].get(model_name.lower(), {})
+        run_report["rescored_log_fpath"] = rescored_log_fpath
+    run_report["seconds"] = time.perf_counter() - start_time
+
+    # merge the reused and rescored rows in the new version's order
+    score_dict_full = []
+    for entities_dict in new_dataset:
+        dataset_id = entities_dict["dataset_id"]
+        if row_provenance[dataset_id]["source"] == "reused":
+            score_dict_full.append(previous_rows[dataset_id])
+        else:
+            score_dict_full.append(rescored_rows[dataset_id])
+
+    accumulator = accumulate_rows(score_dict_full)
+    provenance = {
+        "previous_log_fpath": previous_log_fpath,
+        "diff": {change: len(dataset_ids) for change, dataset_ids in diff.items()},
+        "removed_dataset_ids": diff["removed"],
+        "reused_rows": len(score_dict_full) - len(rescored_dataset),
+        "rescored_rows": len(rescored_dataset),
+        "rows": row_provenance,
+    }
+
+    score_dicts_logging = {}
+    score_dicts_logging["curr_datetime"] = str(datetime.datetime.now())
+    score_dicts_logging["model_name"] = [model_name]
+    score_dicts_logging["score_dict_summary"] = {
+        model_name.lower(): get_score_summary(accumulator)
+    }
+    score_dicts_logging["score_dict_full"] = {model_name.lower(): score_dict_full}
+    score_dicts_logging["score_aggregates"] = {model_name.lower(): accumulator.report()}
+    score_dicts_logging["run_report"] = {model_name.lower(): run_report}
+    score_dicts_logging["provenance"] = {model_name.lower(): provenance}
+
+    log_format = compare_kwargs.get("log_format", "json")
+    log_fname = f"{prefix}-logged-cka-outputs-{dt_string}.{log_format}"
+    if language is not None:
+        log_fname = f"{language}-{log_fname}"
+    log_fpath = os.path.join(log_dir, log_fname)
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    write_log(score_dicts_logging, log_fpath)
+
+    return log_fpath, provenance
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--model", type=str, default="gpt2", help="Model name")
+    parser.add_argument("--language", type=str, default="en", help="Language code")
+    parser.add_argument(
+        "--old_version", type=str, required=True, help="Old dataset parquet file"
+    )
+    parser.add_argument(
+        "--new_version", type=str, required=True, help="New dataset parquet file"
+    )
+    parser.add_argument(
+        "--previous_log",
+        type=str,
+        required=True,
+        help="Result log of the model on the old version",
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=None, help="Stems per forward pass"
+    )
+    parser.add_argument(
+        "--log_dir", type=str, default="logging", help="Folder to write the log to"
+    )
+    args = parser.parse_args()
+
+    log_fpath, provenance = incremental_compare_models(
+        args.model,
+        load_dataset_version(args.old_version),
+        load_dataset_version(args.new_version),
+        args.previous_log,
+        log_dir=args.log_dir,
+        language=args.language,
+        batch_size=args.batch_size,
+    )
+    print(
+        f"{provenance['reused_rows']} rows reused, {provenance['rescored_rows']} rescored ({provenance['diff']})"
+    )
+    print(log_fpath)
@@ -6,17 +6,42 @@ from transformers import set_seed
 from datasets import load_dataset
 
 from compare_models import compare_models
+from model_families import get_model_family
 
 # args config for running the benchmark
 args = Namespace(
     model="meta-llama/Llama-2-70b-hf",
     language="en",
+    # number of stems per forward pass, None probes one stem at a time
+    batch_size=None,
+    # score causal models from the last position's candidate logits only
+    candidate_only=False,
+    # score generate-based models with forward passes instead of generate
+    teacher_forced=False,
+    # "first_token", or "sum" / "mean" of the log-probs of every target token
+    target_scoring="first_token",
+    # megabytes of shared-prefix past_key_values to cache, None disables it
+    prefix_cache_mb=None,
+    # folder for the on-disk tokenization cache, None tokenizes every run
+    tokenization_cache_dir=None,
+    # upcoming batches to collate on a background thread, None collates inline
+    prefetch_batches=None,
+    # rows between fsyncs of the streamed jsonl log
+    flush_every=100,
+    # skip dataset_ids already in the streamed log of an interrupted run
+    resume=False,
+    # dict of CPU execution settings (see cpu_execution.py), None runs on GPU
+    cpu_config=None,
+    # SQLite file of scores from earlier runs (see score_cache.py), None disables it
+    score_cache_fpath=None,
+    # "json", or "parquet" for a columnar log (see columnar_logs.py)
+    log_format="json",
 )
 
 print(args)
 
-# ensure GPU access
-if not torch.cuda.is_available():
+# ensure GPU access, unless running in CPU mode
+if (not torch.cuda.is_available()) and (args.cpu_config is None):
     raise Exception("Change runtime type to include a GPU.")
 
 # set warning level
@@ -59,47 +84,55 @@ for lang_arr in supported_languages:
             "Polyglot-or-Not/Fact-Completion",
             split=lang_arr[0].capitalize(),
         )
+        lang_code = lang_arr[1]
         dataset_bool = True
 
 if not dataset_bool:
     raise Exception("Language not supported.")
 
 # check the input model is compatible
-compatible_model_prefixes = [
-    "t5",
-    "pythia",
-    "gpt",
-    "opt",
-    "llama",
-    "roberta",
-    "bert",
-    "bloom",
-    "stablelm",
-    "mpt",
-    "redpajama",
-    "falcon",
-    "mistral",
-]
-
-model_supported = False
-for model_prefix in compatible_model_prefixes:
-    if model_prefix in args.model.lower():
-        model_supported = True
-
-if not model_supported:
-    raise Exception("Model not supported.")
+get_model_family(args.model)
 
 # create a config for running the pipeline
 config = {
     "models": [args.model],
     "input_information": dataset,
     "verbosity": False,
+    "batch_size": args.batch_size,
+    "candidate_only": args.candidate_only,
+    "teacher_forced": args.teacher_forced,
+    "target_scoring": args.target_scoring,
+    "prefix_cache_mb": args.prefix_cache_mb,
+    "tokenization_cache_dir": args.tokenization_cache_dir,
+    "prefetch_batches": args.prefetch_batches,
+    # rows are streamed here as they're scored, for crash recovery
+    "stream_log_fpath": f"logging/{lang_code}-{args.model.split('/')[-1]}-partial-cka-outputs.jsonl",
+    "flush_every": args.flush_every,
+    "resume": args.resume,
+    "cpu_config": args.cpu_config,
+    "score_cache_fpath": args.score_cache_fpath,
+    "log_format": args.log_format,
 }
 
 # run the contrastive knowledge assessment function
 # logs saved at './content/logging/'
 score_dicts, log_fpath = compare_models(
-    config["models"], config["input_information"], config["verbosity"]
+    config["models"],
+    config["input_information"],
+    config["verbosity"],
+    batch_size=config["batch_size"],
+    candidate_only=config["candidate_only"],
+    teacher_forced=config["teacher_forced"],
+    target_scoring=config["target_scoring"],
+    prefix_cache_mb=config["prefix_cache_mb"],
+    tokenization_cache_dir=config["tokenization_cache_dir"],
+    prefetch_batches=config["prefetch_batches"],
+    stream_log_fpath=config["stream_log_fpath"],
+    flush_every=config["flush_every"],
+    resume=config["resume"],
+    cpu_config=config["cpu_config"],
+    score_cache_fpath=config["score_cache_fpath"],
+    log_format=config["log_format"],
 )
 
 # print the summary results
@@ -0,0 +1,144 @@
+"""
+In-process model cache for multi-model and multi-dataset comparisons
+
+compare_models loads every model it runs and frees it afterwards, so calling it
+again (e.g. for another language or dataset) reloads the model from disk. A
+ModelCache passed to compare_models keeps loaded (tokenizer, model) pairs
+instead, keyed by model name, revision, dtype and quantization, and evicts the
+least recently used ones once the cached weights exceed a RAM or VRAM budget.
+"""
+
+import collections
+import time
+import torch
+
+from compare_models import get_model_and_tokenizer
+from model_families import get_model_family
+from cpu_execution import get_cpu_config
+
+
+# helper to build the cache key of a model as it would be loaded
+def get_model_cache_key(model_name, cpu_config=None, revision=None):
+    if cpu_config is not None:
+        cpu_config = get_cpu_config(cpu_config)
+        dtype = cpu_config["dtype"]
+        quantization = "int8-dynamic" if cpu_config["quantize_int8"] else None
+    else:
+        # GPU loaders are named after their quantization (see model_families)
+        load_model = get_model_family(model_name)["load_model"]
+        dtype = "fp16"
+        quantization = getattr(load_model, "func", load_model).__name__
+    return (model_name.lower(), revision, dtype, quantization)
+
+
+# helper to count a model's weight megabytes on the CPU and on accelerators,
+# counting tied weights once
+def get_model_megabytes(model):
+    megabytes = {"cpu": 0.0, "gpu": 0.0}
+    seen = set()
+    tensors = list(model.state_dict(keep_vars=True).values())
+    while tensors:
+        tensor = tensors.pop()
+        if isinstance(tensor, (tuple, list)):
+            tensors.extend(tensor)
+            continue
+        if not torch.is_tensor(tensor):
+            continue
+        storage_key = (str(tensor.device), tensor.data_ptr())
+        if storage_key in seen:
+            continue
+        seen.add(storage_key)
+        device_type = "cpu" if tensor.device.type == "cpu" else "gpu"
+        megabytes[device_type] += tensor.numel() * tensor.element_size() / 1024**2
+    return megabytes
+
+
+class ModelCache:
+    """
+    LRU cache of loaded (tokenizer, model) pairs
+
+    Models are loaded with compare_models.get_model_and_tokenizer on a miss.
+    Once a load takes the cached weights over max_cpu_megabytes (RAM) or
+    max_gpu_megabytes (VRAM), the least recently used models are evicted until
+    they fit again; a budget of None is unbounded. A model larger than its
+    budget is returned without being cached.
+    """
+
+    def __init__(self, max_cpu_megabytes=None, max_gpu_megabytes=None):
+        self.max_megabytes = {"cpu": max_cpu_megabytes, "gpu": max_gpu_megabytes}
+        self.entries = collections.OrderedDict()
+        self.cached_megabytes = {"cpu": 0.0, "gpu": 0.0}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.loads = []
+
+    def get(self, model_name, cpu_config=None, revision=None):
+        key = get_model_cache_key(model_name, cpu_config, revision)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry["tokenizer_and_model"]
+
+        self.misses += 1
+        start_time = time.perf_counter()
+        tokenizer_and_model = get_model_and_tokenizer(model_name, cpu_config, revision)
+        self.loads.append(
+            {
+                "model": "/".join(map(str, key)),
+                "seconds": time.perf_counter() - start_time,
+            }
+        )
+        self.put(key, tokenizer_and_model)
+        return tokenizer_and_model
+
+    def fits(self, megabytes):
+        return all(
+            (max_megabytes is None) or (megabytes[device_type] <= max_megabytes)
+            for device_type, max_megabytes in self.max_megabytes.items()
+        )
+
+    def put(self, key, tokenizer_and_model):
+        entry = {
+            "tokenizer_and_model": tokenizer_and_model,
+            "megabytes": get_model_megabytes(tokenizer_and_model[1]),
+        }
+        if not self.fits(entry["megabytes"]):
+            return
+        while self.entries and not self.fits(
+            {
+                device_type: self.cached_megabytes[device_type] + megabytes
+                for device_type, megabytes in entry["megabytes"].items()
+            }
+        ):
+            self.evict()
+        self.entries[key] = entry
+        for device_type, megabytes in entry["megabytes"].items():
+            self.cached_megabytes[device_type] += megabytes
+
+    def evict(self):
+        _, evicted = self.entries.popitem(last=False)
+        for device_type, megabytes in evicted["megabytes"].items():
+            self.cached_megabytes[device_type] -= megabytes
+        self.evictions += 1
+        del evicted
+        torch.cuda.empty_cache()
+
+    def clear(self):
+        while self.entries:
+            self.evict()
+
+    def report(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "load_seconds": sum(load["seconds"] for load in self.loads),
+            "loads": list(self.loads),
+            "cached_models": ["/".join(map(str, key)) for key in self.entries],
+            "cached_cpu_megabytes": self.cached_megabytes["cpu"],
+            "cached_gpu_megabytes": self.cached_megabytes["gpu"],
+        }
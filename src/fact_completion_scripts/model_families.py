@@ -0,0 +1,291 @@
+"""
+Model-family adapters for fact-completion runs
+
+Each model family (keyed by its prefix, e.g. "gpt" or "llama") is registered
+once below, declaring the substrings that identify its model names, how its
+model and tokenizer are loaded, its tokenizer fixups, its target-id rule (see
+target_resolution.py) and its single-pairing and batched probe functions.
+Model names are matched against the families in registration order, so more
+specific patterns (e.g. "gpt-neo") are registered before broader ones ("gpt").
+
+Adding a family is one register_model_family call, e.g. for Qwen:
+register_model_family(
+    "qwen",
+    ["qwen"],
+    AutoModelForCausalLM,
+    load_in_8bit,
+    probe_llama,
+    batched_probe_function=probe_causal_batch,
+    pad_with_eos=True,
+    full_target=True,
+    target_rule={
+        "leading_space": True,
+        "offset": 0,
+        "strip_space_token": False,
+        "truncate": False,
+    },
+)
+"""
+
+import functools
+import torch
+
+import transformers
+from transformers import (
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    AutoModelForMaskedLM,
+    AutoModelForSeq2SeqLM,
+)
+
+from probe_helpers import (
+    probe_gpt,
+    probe_bert,
+    probe_llama,
+    probe_t5,
+    probe_stablelm,
+    probe_mpt,
+    probe_redpajama,
+    probe_falcon,
+    probe_causal_batch,
+    probe_bert_batch,
+    generate_probe_settings,
+)
+from target_resolution import target_id_rules
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+# registered families, keyed by prefix, in matching order
+model_families = {}
+
+
+# GPU loaders, called with the family's model class and the model name
+def load_in_8bit(model_class, model_name, trust_remote_code=False, revision=None):
+    return model_class.from_pretrained(
+        model_name,
+        load_in_8bit=True,
+        device_map="auto",
+        torch_dtype=torch.float16,
+        trust_remote_code=trust_remote_code,
+        revision=revision,
+    )
+
+
+def load_in_4bit(
+    model_class, model_name, trust_remote_code=False, revision=None, device_map="auto"
+):
+    bnb_config = transformers.BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_use_double_quant=True,
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_compute_dtype=torch.float16,
+    )
+    return model_class.from_pretrained(
+        model_name,
+        quantization_config=bnb_config,
+        device_map=device_map,
+        trust_remote_code=trust_remote_code,
+        revision=revision,
+    )
+
+
+def load_in_fp16(model_class, model_name, trust_remote_code=False, revision=None):
+    return model_class.from_pretrained(
+        model_name,
+        torch_dtype=torch.float16,
+        trust_remote_code=trust_remote_code,
+        revision=revision,
+    ).to(device)
+
+
+def register_model_family(
+    prefix,
+    name_patterns,
+    model_class,
+    load_model,
+    probe_function,
+    batched_probe_function=None,
+    pad_token=None,
+    pad_with_eos=False,
+    trust_remote_code=False,
+    context_suffix="",
+    full_target=False,
+    target_rule=None,
+    generate_settings=None,
+):
+    """
+    Register a model family under prefix
+
+    name_patterns: lowercase substrings of the model names of the family
+    model_class: transformers class the CPU loader uses
+    load_model: GPU loader, called as load_model(model_class, model_name,
+        trust_remote_code=..., revision=...)
+    probe_function: probe for one (context, target id) pairing
+    batched_probe_function: probe for a batch of pairings, or None
+    pad_token / pad_with_eos: pad token to set on the tokenizer
+    context_suffix: appended to each stem (e.g. the mask token of MLMs)
+    full_target: whether full-target scoring is supported (causal LMs)
+    target_rule: target-id rule, if target_resolution has none for prefix
+    generate_settings: teacher-forced settings of generate-based probes
+    """
+    if target_rule is not None:
+        target_id_rules[prefix] = target_rule
+    if prefix not in target_id_rules:
+        raise Exception(f"No target-id rule for model prefix {prefix}.")
+    if generate_settings is not None:
+        generate_probe_settings[prefix] = generate_settings
+
+    model_families[prefix] = {
+        "prefix": prefix,
+        "name_patterns": name_patterns,
+        "model_class": model_class,
+        "load_model": load_model,
+        "probe_function": probe_function,
+        "batched_probe_function": batched_probe_function,
+        "pad_token": pad_token,
+        "pad_with_eos": pad_with_eos,
+        "trust_remote_code": trust_remote_code,
+        "context_suffix": context_suffix,
+        "full_target": full_target,
+    }
+    return model_families[prefix]
+
+
+# helper to find the family of a model name
+def get_model_family(model_name):
+    for family in model_families.values():
+        if any(pattern in model_name.lower() for pattern in family["name_patterns"]):
+            return family
+    raise Exception(f"Model {model_name} not supported.")
+
+
+# helper to apply a family's pad token fixups to a tokenizer
+def apply_tokenizer_fixups(family, tokenizer):
+    if family["pad_token"] is not None:
+        tokenizer.pad_token = family["pad_token"]
+    elif family["pad_with_eos"]:
+        tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+
+# helper to load a family's tokenizer, with its fixups
+def get_family_tokenizer(family, model_name, revision=None):
+    tokenizer = AutoTokenizer.from_pretrained(model_name, revision=revision)
+    return apply_tokenizer_fixups(family, tokenizer)
+
+
+register_model_family(
+    "t5",
+    ["t5"],
+    AutoModelForSeq2SeqLM,
+    load_in_8bit,
+    probe_t5,
+)
+register_model_family(
+    "eleutherai",
+    ["gpt-neo", "gpt-j", "pythia"],
+    AutoModelForCausalLM,
+    load_in_8bit,
+    probe_gpt,
+    batched_probe_function=probe_causal_batch,
+    full_target=True,
+)
+register_model_family(
+    "gpt",
+    ["gpt"],
+    AutoModelForCausalLM,
+    load_in_8bit,
+    probe_gpt,
+    batched_probe_function=probe_causal_batch,
+    full_target=True,
+)
+register_model_family(
+    "opt",
+    ["opt"],
+    AutoModelForCausalLM,
+    load_in_8bit,
+    probe_gpt,
+    batched_probe_function=probe_causal_batch,
+    full_target=True,
+)
+register_model_family(
+    "roberta",
+    ["roberta"],
+    AutoModelForMaskedLM,
+    load_in_fp16,
+    probe_bert,
+    batched_probe_function=probe_bert_batch,
+    context_suffix=" <mask>.",
+)
+register_model_family(
+    "bert",
+    ["bert"],
+    AutoModelForMaskedLM,
+    load_in_fp16,
+    probe_bert,
+    batched_probe_function=probe_bert_batch,
+    context_suffix=" [MASK].",
+)
+register_model_family(
+    "llama",
+    ["llama"],
+    transformers.LlamaForCausalLM,
+    load_in_8bit,
+    probe_llama,
+    batched_probe_function=probe_causal_batch,
+    pad_with_eos=True,
+    full_target=True,
+)
+register_model_family(
+    "mistral",
+    ["mistral"],
+    AutoModelForCausalLM,
+    load_in_8bit,
+    probe_llama,
+    batched_probe_function=probe_causal_batch,
+    pad_with_eos=True,
+    full_target=True,
+)
+register_model_family(
+    "bloom",
+    ["bloom"],
+    AutoModelForCausalLM,
+    load_in_8bit,
+    probe_gpt,
+    batched_probe_function=probe_causal_batch,
+    full_target=True,
+)
+register_model_family(
+    "stablelm",
+    ["stablelm"],
+    AutoModelForCausalLM,
+    load_in_8bit,
+    probe_stablelm,
+    pad_token="<|padding|>",
+)
+register_model_family(
+    "mpt",
+    ["mpt"],
+    AutoModelForCausalLM,
+    functools.partial(load_in_4bit, device_map={"": 0}),
+    probe_mpt,
+    pad_token="<|padding|>",
+    trust_remote_code=True,
+)
+register_model_family(
+    "redpajama",
+    ["redpajama"],
+    AutoModelForCausalLM,
+    load_in_8bit,
+    probe_redpajama,
+    pad_token="<|padding|>",
+)
+register_model_family(
+    "falcon",
+    ["falcon"],
+    AutoModelForCausalLM,
+    load_in_4bit,
+    probe_falcon,
+    pad_with_eos=True,
+    trust_remote_code=True,
+)
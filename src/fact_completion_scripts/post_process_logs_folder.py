@@ -10,7 +10,6 @@ python post_process_logs_folder.py \
 from typing import List
 from random import choices
 import numpy as np
-import json
 import pandas as pd
 from argparse import ArgumentParser
 import glob
@@ -18,6 +17,8 @@ import os
 import sys
 import tqdm
 
+from columnar_logs import load_log
+
 
 def post_process(args):
     num_resamples = args.num_resamples
@@ -33,10 +34,16 @@ def post_process(args):
         sys.stdout = f
 
         print(f"Running post-processing for {input_folder}...")
-        fpaths = glob.glob(os.path.join(input_folder, "*.json"))
+        # json or parquet logs (see columnar_logs.py)
+        # (profile sidecars, see run_profiling.py, are not result logs)
+        fpaths = [
+            fpath
+            for fpath in glob.glob(os.path.join(input_folder, "*.json"))
+            + glob.glob(os.path.join(input_folder, "*.parquet"))
+            if not fpath.endswith("-profile.json")
+        ]
         for fpath in tqdm.tqdm(fpaths):
-            with open(fpath, "r") as f:
-                data = json.load(f)
+            data = load_log(fpath)
 
             model_name = data["model_name"][0]
             print(f"\n\tThe model name is {model_name}")
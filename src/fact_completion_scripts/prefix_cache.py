@@ -0,0 +1,136 @@
+"""
+Prefix KV-cache helpers for causal fact-completion probes
+
+Many stems share long token prefixes, e.g. one subject probed for several
+relations, or ROME prompts filling the same template with different subjects.
+A trie over the tokenized contexts finds the prefix each context shares with
+others; that prefix is run once and its past_key_values are reused for every
+suffix. Cached prefixes live in an LRU bounded by a memory budget.
+"""
+
+import collections
+import copy
+import torch
+
+
+# helper to build a trie over tokenized contexts, counting the contexts that
+# pass through each node
+def build_prefix_trie(tokenized_contexts):
+    root = {"count": 0, "children": {}}
+    for context_ids in tokenized_contexts:
+        node = root
+        node["count"] += 1
+        for token_id in context_ids:
+            node = node["children"].setdefault(token_id, {"count": 0, "children": {}})
+            node["count"] += 1
+    return root
+
+
+# helper to find, for every context, the length of the longest token prefix it
+# shares with at least one other context (zero if shorter than the minimum)
+def shared_prefix_lengths(tokenized_contexts, min_prefix_tokens=4):
+    trie = build_prefix_trie(tokenized_contexts)
+    prefix_lengths = []
+    for context_ids in tokenized_contexts:
+        node = trie
+        shared_length = 0
+        for depth, token_id in enumerate(context_ids):
+            node = node["children"][token_id]
+            if node["count"] < 2:
+                break
+            shared_length = depth + 1
+        if shared_length < min_prefix_tokens:
+            shared_length = 0
+        prefix_lengths.append(shared_length)
+    return prefix_lengths
+
+
+# helper to count the bytes of every tensor held by a (possibly nested) cache
+def tensor_nbytes(obj, seen=None):
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if torch.is_tensor(obj):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, (tuple, list)):
+        return sum(tensor_nbytes(item, seen) for item in obj)
+    if isinstance(obj, dict):
+        return sum(tensor_nbytes(item, seen) for item in obj.values())
+    if hasattr(obj, "__dict__"):
+        return sum(tensor_nbytes(item, seen) for item in vars(obj).values())
+    return 0
+
+
+class PrefixCache:
+    """
+    LRU cache of past_key_values for shared token prefixes
+
+    Entries are keyed by the tuple of prefix token ids and hold the prefix's
+    past_key_values and last-position logits. The oldest entries are evicted
+    once the cached tensors exceed max_megabytes.
+    """
+
+    def __init__(self, max_megabytes=1024):
+        self.max_bytes = int(max_megabytes * 1024**2)
+        self.entries = collections.OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.tokens_saved = 0
+        self.tokens_run = 0
+
+    def get(self, prefix_ids):
+        entry = self.entries.get(prefix_ids)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(prefix_ids)
+        self.hits += 1
+        return entry
+
+    def put(self, prefix_ids, past_key_values, last_logits):
+        entry = {
+            "past_key_values": past_key_values,
+            "last_logits": last_logits,
+            "nbytes": tensor_nbytes(past_key_values) + tensor_nbytes(last_logits),
+        }
+        # entries larger than the whole budget are used once and not kept
+        if entry["nbytes"] > self.max_bytes:
+            return entry
+        while self.cached_bytes + entry["nbytes"] > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.cached_bytes -= evicted["nbytes"]
+            self.evictions += 1
+        self.entries[prefix_ids] = entry
+        self.cached_bytes += entry["nbytes"]
+        return entry
+
+    def checkout(self, entry):
+        # legacy tuple caches are never written to by the model, while Cache
+        # objects grow in place; those that can't be cropped back get copied
+        past_key_values = entry["past_key_values"]
+        if isinstance(past_key_values, tuple) or hasattr(past_key_values, "crop"):
+            return past_key_values
+        return copy.deepcopy(past_key_values)
+
+    def checkin(self, entry, past_key_values, prefix_length):
+        # drop the suffix a Cache object picked up, restoring the cached prefix
+        if (past_key_values is entry["past_key_values"]) and hasattr(
+            past_key_values, "crop"
+        ):
+            past_key_values.crop(prefix_length)
+
+    def report(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "cached_megabytes": self.cached_bytes / 1024**2,
+            "tokens_saved": self.tokens_saved,
+            "tokens_run": self.tokens_run,
+        }
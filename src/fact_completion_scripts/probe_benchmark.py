@@ -0,0 +1,604 @@
+"""
+Offline micro-benchmark of probe throughput across model families
+
+Tiny, randomly initialized models are built locally for each family, along
+with tokenizers trained on a synthetic Polyglot-style dataset (so no hub
+access is needed), laid out the way each family's real tokenizer encodes a
+target (BOS tokens, lone space tokens, mask tokens). The probe functions are
+then timed over that dataset: the single-pairing probes for a batch size of
+None, and the batched probes otherwise. Generate-based families (t5, falcon,
+mpt) are timed through their teacher-forced probes, since a random model's
+free generation does not follow the expected format.
+
+Per family and batch size, the latency percentiles of the probe calls and the
+facts/sec are reported, and checked for regressions against a baseline file.
+The committed benchmark_baseline.json, next to this script, was recorded on
+one CPU thread (torch 2.14, transformers 5.19) and is checked against by
+default; on other hardware, save a baseline of your own first.
+
+Example usage, checking a change against the committed baseline:
+python probe_benchmark.py --num_threads 1 --tolerance 0.2
+
+Example usage, saving a local baseline then checking a change against it:
+python probe_benchmark.py --save_baseline local_baseline.json
+python probe_benchmark.py --baseline local_baseline.json
+"""
+
+import json
+import os
+import random
+import sys
+import time
+from argparse import ArgumentParser
+import numpy as np
+import torch
+import transformers
+from tokenizers import Tokenizer, models, pre_tokenizers, processors, trainers
+from transformers import PreTrainedTokenizerFast
+
+from compare_models import (
+    get_entities,
+    get_context,
+    get_batched_probe_function,
+    resolve_dataset_target_ids,
+)
+from model_families import model_families, apply_tokenizer_fixups
+from probe_helpers import (
+    generate_probe_settings,
+    tokenize_batch_contexts,
+    probe_teacher_forced,
+)
+from batch_scheduling import schedule_batches
+from run_profiling import get_latency_summary
+
+# baseline checked against unless another one is given
+default_baseline_fpath = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json"
+)
+
+# relations of the synthetic dataset, with their stem templates and objects
+synthetic_relations = {
+    "P36": (
+        "the capital of {} is",
+        ["paris", "tokyo", "ottawa", "berlin", "rome", "madrid", "cairo", "lima"],
+    ),
+    "P37": (
+        "the official language of {} is",
+        ["french", "japanese", "english", "german", "italian", "spanish", "arabic"],
+    ),
+    "P30": (
+        "{} is located in the continent of",
+        ["europe", "asia", "america", "africa", "oceania"],
+    ),
+    "P38": (
+        "the currency used in {} is the",
+        ["euro", "yen", "dollar", "pound", "peso", "rupee"],
+    ),
+}
+synthetic_subjects = [
+    "france",
+    "japan",
+    "canada",
+    "germany",
+    "italy",
+    "spain",
+    "egypt",
+    "peru",
+    "kenya",
+    "india",
+    "chile",
+    "norway",
+]
+
+
+def make_synthetic_dataset(num_facts, seed=0):
+    """
+    Build Polyglot-style rows (stem, true, false, relation, subject, object,
+    dataset_id), with one to three counterfacts per fact; every fifth row has
+    one stem per entity, " <br> "-separated, like the calinet rows
+    """
+    rng = random.Random(seed)
+    dataset = []
+    for row_itr in range(num_facts):
+        relation = rng.choice(sorted(synthetic_relations))
+        template, objects = synthetic_relations[relation]
+        subject = rng.choice(synthetic_subjects)
+        entities = rng.sample(objects, rng.randint(2, 4))
+        stem = template.format(subject)
+        if row_itr % 5 == 4:
+            stem = " <br> ".join(
+                [stem] + [f"as is well known, {stem}" for _ in entities[1:]]
+            )
+        dataset.append(
+            {
+                "dataset_id": f"synthetic_{row_itr}",
+                "stem": stem,
+                "true": entities[0],
+                "false": " <br> ".join(entities[1:]),
+                "relation": relation,
+                "subject": subject,
+                "object": entities[0],
+            }
+        )
+    return dataset
+
+
+# helper to gather the texts a benchmark tokenizer is trained on
+def get_synthetic_corpus(dataset):
+    corpus = []
+    for entities_dict in dataset:
+        for entity_count, entity in enumerate(get_entities(entities_dict)):
+            corpus.append(
+                f"{get_context(entities_dict['stem'], entity_count, None)} {entity}"
+            )
+            corpus.append(entity)
+    return corpus
+
+
+def train_tokenizer(corpus, special_tokens, style, template=None):
+    """
+    Train a small tokenizer on corpus
+
+    style "byte_level" encodes spaces into the following word (gpt-2 style),
+    "space_token" splits every space off as its own token (the lone "▁" of
+    sentencepiece tokenizers) and "wordpiece" is BERT's; template adds the
+    family's special tokens around each encoding, e.g. "<s> $A"
+    """
+    if style == "wordpiece":
+        tokenizer = Tokenizer(models.WordPiece(unk_token="[UNK]"))
+        tokenizer.pre_tokenizer = pre_tokenizers.BertPreTokenizer()
+        trainer = trainers.WordPieceTrainer(
+            vocab_size=500, special_tokens=special_tokens, show_progress=False
+        )
+    else:
+        tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+        if style == "byte_level":
+            tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+            initial_alphabet = pre_tokenizers.ByteLevel.alphabet()
+        else:
+            tokenizer.pre_tokenizer = pre_tokenizers.Split(" ", behavior="isolated")
+            initial_alphabet = [" "]
+        trainer = trainers.BpeTrainer(
+            vocab_size=500,
+            special_tokens=special_tokens,
+            initial_alphabet=initial_alphabet,
+            show_progress=False,
+        )
+    tokenizer.train_from_iterator(corpus, trainer)
+
+    if template is not None:
+        tokenizer.post_processor = processors.TemplateProcessing(
+            single=template,
+            special_tokens=[
+                (token, tokenizer.token_to_id(token))
+                for token in special_tokens
+                if token in template.split()
+            ],
+        )
+    return tokenizer
+
+
+# tiny model builders, called with the tokenizer's vocab size
+def build_gpt(vocab_size):
+    return transformers.GPT2LMHeadModel(
+        transformers.GPT2Config(
+            vocab_size=vocab_size,
+            n_embd=64,
+            n_layer=2,
+            n_head=2,
+            n_positions=256,
+            # <|endoftext|> is the first special token, see benchmark_families
+            bos_token_id=0,
+            eos_token_id=0,
+        )
+    )
+
+
+def build_opt(vocab_size):
+    return transformers.OPTForCausalLM(
+        transformers.OPTConfig(
+            vocab_size=vocab_size,
+            hidden_size=64,
+            num_hidden_layers=2,
+            num_attention_heads=2,
+            ffn_dim=128,
+            max_position_embeddings=256,
+            word_embed_proj_dim=64,
+        )
+    )
+
+
+def build_llama(vocab_size):
+    return transformers.LlamaForCausalLM(
+        transformers.LlamaConfig(
+            vocab_size=vocab_size,
+            hidden_size=64,
+            intermediate_size=128,
+            num_hidden_layers=2,
+            num_attention_heads=2,
+            num_key_value_heads=2,
+            max_position_embeddings=256,
+        )
+    )
+
+
+def build_bert(vocab_size):
+    return transformers.BertForMaskedLM(
+        transformers.BertConfig(
+            vocab_size=vocab_size,
+            hidden_size=64,
+            num_hidden_layers=2,
+            num_attention_heads=2,
+            intermediate_size=128,
+            max_position_embeddings=256,
+        )
+    )
+
+
+def build_roberta(vocab_size):
+    return transformers.RobertaForMaskedLM(
+        transformers.RobertaConfig(
+            vocab_size=vocab_size,
+            hidden_size=64,
+            num_hidden_layers=2,
+            num_attention_heads=2,
+            intermediate_size=128,
+            max_position_embeddings=256,
+            pad_token_id=1,
+        )
+    )
+
+
+def build_t5(vocab_size):
+    return transformers.T5ForConditionalGeneration(
+        transformers.T5Config(
+            vocab_size=vocab_size,
+            d_model=64,
+            d_kv=32,
+            d_ff=128,
+            num_layers=2,
+            num_heads=2,
+            decoder_start_token_id=0,
+            pad_token_id=0,
+            eos_token_id=1,
+        )
+    )
+
+
+def build_falcon(vocab_size):
+    return transformers.FalconForCausalLM(
+        transformers.FalconConfig(
+            vocab_size=vocab_size,
+            hidden_size=64,
+            num_hidden_layers=2,
+            num_attention_heads=2,
+        )
+    )
+
+
+def build_mpt(vocab_size):
+    return transformers.MptForCausalLM(
+        transformers.MptConfig(
+            vocab_size=vocab_size, d_model=64, n_heads=2, n_layers=2, max_seq_len=256
+        )
+    )
+
+
+# benchmarked families, keyed by prefix
+# special tokens come first, so that e.g. t5's pad and eos get ids 0 and 1
+benchmark_families = {
+    "gpt": {
+        "model_class": "GPT2LMHeadModel",
+        "build_model": build_gpt,
+        "style": "byte_level",
+        "special_tokens": {"eos_token": "<|endoftext|>", "unk_token": "<unk>"},
+        "template": None,
+    },
+    "opt": {
+        "model_class": "OPTForCausalLM",
+        "build_model": build_opt,
+        "style": "byte_level",
+        "special_tokens": {
+            "pad_token": "<pad>",
+            "bos_token": "</s>",
+            "unk_token": "<unk>",
+        },
+        "template": "</s> $A",
+    },
+    "llama": {
+        "model_class": "LlamaForCausalLM",
+        "build_model": build_llama,
+        "style": "space_token",
+        "special_tokens": {
+            "unk_token": "<unk>",
+            "bos_token": "<s>",
+            "eos_token": "</s>",
+        },
+        "template": "<s> $A",
+    },
+    "bert": {
+        "model_class": "BertForMaskedLM",
+        "build_model": build_bert,
+        "style": "wordpiece",
+        "special_tokens": {
+            "pad_token": "[PAD]",
+            "unk_token": "[UNK]",
+            "cls_token": "[CLS]",
+            "sep_token": "[SEP]",
+            "mask_token": "[MASK]",
+        },
+        "template": "[CLS] $A [SEP]",
+    },
+    "roberta": {
+        "model_class": "RobertaForMaskedLM",
+        "build_model": build_roberta,
+        "style": "byte_level",
+        "special_tokens": {
+            "bos_token": "<s>",
+            "pad_token": "<pad>",
+            "eos_token": "</s>",
+            "unk_token": "<unk>",
+            "mask_token": "<mask>",
+        },
+        "template": "<s> $A </s>",
+    },
+    "t5": {
+        "model_class": "T5ForConditionalGeneration",
+        "build_model": build_t5,
+        "style": "space_token",
+        "special_tokens": {
+            "pad_token": "<pad>",
+            "eos_token": "</s>",
+            "unk_token": "<unk>",
+            "additional_special_tokens": ["<extra_id_0>", "<extra_id_1>"],
+        },
+        "template": "$A </s>",
+    },
+    "falcon": {
+        "model_class": "FalconForCausalLM",
+        "build_model": build_falcon,
+        "style": "byte_level",
+        "special_tokens": {"eos_token": "<|endoftext|>", "unk_token": "<unk>"},
+        "template": None,
+    },
+    "mpt": {
+        "model_class": "MptForCausalLM",
+        "build_model": build_mpt,
+        "style": "byte_level",
+        "special_tokens": {
+            "eos_token": "<|endoftext|>",
+            "pad_token": "<|padding|>",
+            "unk_token": "<unk>",
+        },
+        "template": None,
+    },
+}
+
+
+def build_benchmark_model(prefix, corpus, seed=0):
+    """
+    Build the tiny (tokenizer, model) pair of a benchmarked family, or None
+    when the installed transformers lacks the family's model class
+    """
+    settings = benchmark_families[prefix]
+    if not hasattr(transformers, settings["model_class"]):
+        return None
+
+    special_tokens = []
+    for token in settings["special_tokens"].values():
+        special_tokens.extend(token if isinstance(token, list) else [token])
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=train_tokenizer(
+            corpus, special_tokens, settings["style"], settings["template"]
+        ),
+        **settings["special_tokens"],
+    )
+    tokenizer = apply_tokenizer_fixups(model_families[prefix], tokenizer)
+
+    torch.manual_seed(seed)
+    model = settings["build_model"](len(tokenizer)).eval()
+    return tokenizer, model
+
+
+@torch.no_grad()
+def benchmark_probes(tokenizer, model, prefix, dataset, batch_size, repeats=3):
+    """
+    Time the probes of one family over the dataset, after one warm-up pass
+
+    A batch_size of None times the single-pairing probe, once per (stem,
+    entity) pairing; otherwise the batched probe, once per batch of unique
+    stems. Returns the call latency percentiles and facts/sec
+    """
+    target_ids = resolve_dataset_target_ids(tokenizer, prefix, dataset)
+    if batch_size is None:
+        probe_func = model_families[prefix]["probe_function"]
+        if prefix in generate_probe_settings:
+
+            def probe_func(model, tokenizer, target_id, context, verbose):
+                return probe_teacher_forced(
+                    model, tokenizer, target_id, context, verbose, family=prefix
+                )
+
+        calls = []
+        for row_itr, entities_dict in enumerate(dataset):
+            for entity_count, _ in enumerate(get_entities(entities_dict)):
+                context = get_context(entities_dict["stem"], entity_count, prefix)
+                target_id = torch.tensor(target_ids[row_itr, entity_count])
+                calls.append(
+                    (probe_func, (model, tokenizer, target_id, context, False), {})
+                )
+    else:
+        batched_probe_func = get_batched_probe_function(prefix, teacher_forced=True)
+        contexts = []
+        context_target_ids = []
+        for row_itr, entities_dict in enumerate(dataset):
+            row_items = {}
+            for entity_count, _ in enumerate(get_entities(entities_dict)):
+                context = get_context(entities_dict["stem"], entity_count, prefix)
+                row_items.setdefault(context, []).append(
+                    int(target_ids[row_itr, entity_count])
+                )
+            contexts.extend(row_items)
+            context_target_ids.extend(row_items.values())
+        tokenized_contexts = tokenize_batch_contexts(tokenizer, contexts, prefix)
+        batches = schedule_batches(
+            [len(context_ids) for context_ids in tokenized_contexts], batch_size
+        )
+        calls = [
+            (
+                batched_probe_func,
+                (
+                    model,
+                    tokenizer,
+                    [context_target_ids[itr] for itr in batch],
+                    [contexts[itr] for itr in batch],
+                    False,
+                ),
+                {"tokenized_contexts": [tokenized_contexts[itr] for itr in batch]},
+            )
+            for batch in batches
+        ]
+
+    latencies = []
+    total_seconds = 0.0
+    for repeat_itr in range(repeats + 1):
+        for func, args, kwargs in calls:
+            start_time = time.perf_counter()
+            func(*args, **kwargs)
+            seconds = time.perf_counter() - start_time
+            # the first pass only warms up
+            if repeat_itr > 0:
+                latencies.append(seconds)
+                total_seconds += seconds
+
+    return {
+        "family": prefix,
+        "batch_size": batch_size,
+        "facts": len(dataset),
+        "calls": len(calls),
+        "latency_ms": get_latency_summary(latencies),
+        "facts_per_second": len(dataset) * repeats / total_seconds,
+    }
+
+
+def run_benchmark(families, batch_sizes, num_facts=200, repeats=3, seed=0):
+    """
+    Benchmark every family at every batch size over one synthetic dataset,
+    skipping families the installed transformers can't build
+    """
+    dataset = make_synthetic_dataset(num_facts, seed)
+    corpus = get_synthetic_corpus(dataset)
+    results = []
+    for prefix in families:
+        tokenizer_and_model = build_benchmark_model(prefix, corpus, seed)
+        if tokenizer_and_model is None:
+            print(f"Skipping {prefix}, not supported by this transformers version")
+            continue
+        tokenizer, model = tokenizer_and_model
+        for batch_size in batch_sizes:
+            result = benchmark_probes(
+                tokenizer, model, prefix, dataset, batch_size, repeats
+            )
+            print(
+                f"{prefix}, batch size {batch_size}: {np.round(result['facts_per_second'], 1)} facts/sec, p50 {np.round(result['latency_ms']['p50'], 2)} ms, p99 {np.round(result['latency_ms']['p99'], 2)} ms"
+            )
+            results.append(result)
+    return results
+
+
+# helper to key benchmark results by family and batch size
+def get_result_key(result):
+    return f"{result['family']}/{result['batch_size']}"
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    """
+    Check results against a baseline's, returning the regressions: the
+    family / batch size pairs whose facts/sec dropped by more than tolerance
+    (a fraction of the baseline's)
+    """
+    baseline_results = {get_result_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        baseline_result = baseline_results.get(get_result_key(result))
+        if baseline_result is None:
+            continue
+        ratio = result["facts_per_second"] / baseline_result["facts_per_second"]
+        if ratio < 1 - tolerance:
+            regressions.append(
+                {
+                    "key": get_result_key(result),
+                    "baseline_facts_per_second": baseline_result["facts_per_second"],
+                    "facts_per_second": result["facts_per_second"],
+                    "ratio": ratio,
+                }
+            )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--families",
+        type=str,
+        nargs="+",
+        default=list(benchmark_families),
+        help="Family prefixes to benchmark",
+    )
+    parser.add_argument(
+        "--batch_sizes",
+        type=str,
+        nargs="+",
+        default=["None", "8", "32"],
+        help="Batch sizes to benchmark, None for the single-pairing probes",
+    )
+    parser.add_argument(
+        "--num_facts", type=int, default=200, help="Synthetic facts to score"
+    )
+    parser.add_argument(
+        "--repeats", type=int, default=3, help="Timed passes over the facts"
+    )
+    parser.add_argument(
+        "--num_threads", type=int, default=None, help="Torch intra-op threads"
+    )
+    parser.add_argument(
+        "--save_baseline", type=str, default=None, help="File to save results to"
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=default_baseline_fpath,
+        help="Baseline file to check against, None to skip the check",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Largest facts/sec drop, as a fraction, that is not a regression",
+    )
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    batch_sizes = [
+        None if batch_size == "None" else int(batch_size)
+        for batch_size in args.batch_sizes
+    ]
+    results = run_benchmark(args.families, batch_sizes, args.num_facts, args.repeats)
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, "w") as outfile:
+            json.dump(results, outfile, indent=4)
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if args.baseline != "None":
+        with open(args.baseline, "r") as infile:
+            baseline = json.load(infile)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(
+                f"Regression in {regression['key']}: {np.round(regression['facts_per_second'], 1)} facts/sec, baseline {np.round(regression['baseline_facts_per_second'], 1)}"
+            )
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline")
@@ -2,13 +2,28 @@
 Helpers for probing large language model prediction probabilities
 """
 
+import inspect
 import numpy as np
 import torch
-from torch.nn.functional import softmax
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-if not torch.cuda.is_available():
-    raise Exception("Change runtime type to include a GPU.")
+from run_profiling import profile_stage
+
+
+# helper to move probabilities to the host as a numpy array
+# numpy has no bfloat16, so those (from CPU bf16 runs) are upcast to float32
+def to_numpy(tensor):
+    with profile_stage("host_transfer"):
+        tensor = tensor.detach().cpu()
+        if tensor.dtype == torch.bfloat16:
+            tensor = tensor.float()
+        return tensor.numpy()
+
+
+# helper to convert prediction scores to a probability distribution, timed as
+# its own stage when profiling (see run_profiling.py)
+def softmax(logits, dim=-1):
+    with profile_stage("softmax_gather"):
+        return torch.nn.functional.softmax(logits, dim=dim)
 
 
 def probe_t5(model, tokenizer, target_id, context, verbose=False):
@@ -22,7 +37,7 @@ def probe_t5(model, tokenizer, target_id, context, verbose=False):
     ).input_ids
     # use model to solicit a prediction
     outputs = model.generate(
-        input_ids=input_ids.to(device),
+        input_ids=input_ids.to(model.device),
         output_scores=True,
         return_dict=True,
         return_dict_in_generate=True,
@@ -35,7 +50,7 @@ def probe_t5(model, tokenizer, target_id, context, verbose=False):
     for i in range(4):
         logits = outputs["scores"][i]
         probs = softmax(logits, dim=-1)
-        probs = probs.detach().cpu().numpy()
+        probs = to_numpy(probs)
         if tokenizer.decode([np.argmax(probs)]) not in [
             "<extra_id_0>",
             "",
@@ -48,7 +63,7 @@ def probe_t5(model, tokenizer, target_id, context, verbose=False):
     logits = outputs["scores"][save_itr]
     # convert our prediction scores to a probability distribution with softmax
     probs = softmax(logits, dim=-1)
-    probs = probs.detach().cpu().numpy()
+    probs = to_numpy(probs)
     # grab the full decoded output for verbose:
     decoded_output = tokenizer.decode(sequences)
 
@@ -75,7 +90,7 @@ def probe_stablelm(model, tokenizer, target_id, context, verbose=False):
     ).input_ids
     # use model to solicit a prediction
     outputs = model.generate(
-        input_ids=input_ids.to(device),
+        input_ids=input_ids.to(model.device),
         output_scores=True,
         return_dict=True,
         return_dict_in_generate=True,
@@ -88,7 +103,7 @@ def probe_stablelm(model, tokenizer, target_id, context, verbose=False):
     for i in range(4):
         logits = outputs["scores"][i]
         probs = softmax(logits, dim=-1)
-        probs = probs.detach().cpu().numpy()
+        probs = to_numpy(probs)
         if tokenizer.decode([np.argmax(probs)]) not in [
             "<|endoftext|>",
             "<|padding|>",
@@ -101,7 +116,7 @@ def probe_stablelm(model, tokenizer, target_id, context, verbose=False):
     logits = outputs["scores"][save_itr]
     # convert our prediction scores to a probability distribution with softmax
     probs = softmax(logits, dim=-1)
-    probs = probs.detach().cpu().numpy()
+    probs = to_numpy(probs)
     # grab the full decoded output for verbose:
     decoded_output = tokenizer.decode(sequences)
 
@@ -129,7 +144,7 @@ def probe_falcon(model, tokenizer, target_id, context, verbose=False):
     ).input_ids
     # use model to solicit a prediction
     outputs = model.generate(
-        input_ids=input_ids.to(device),
+        input_ids=input_ids.to(model.device),
         output_scores=True,
         return_dict=True,
         return_dict_in_generate=True,
@@ -142,7 +157,7 @@ def probe_falcon(model, tokenizer, target_id, context, verbose=False):
     for i in range(3):
         logits = outputs["scores"][i]
         probs = softmax(logits, dim=-1)
-        probs = probs.detach().cpu().numpy()
+        probs = to_numpy(probs)
         if tokenizer.decode([np.argmax(probs)]) not in [
             "<|endoftext|>",
             "<|padding|>",
@@ -155,7 +170,7 @@ def probe_falcon(model, tokenizer, target_id, context, verbose=False):
     logits = outputs["scores"][save_itr]
     # convert our prediction scores to a probability distribution with softmax
     probs = softmax(logits, dim=-1)
-    probs = probs.detach().cpu().numpy()
+    probs = to_numpy(probs)
     # grab the full decoded output for verbose:
     decoded_output = tokenizer.decode(sequences)
 
@@ -182,7 +197,7 @@ def probe_redpajama(model, tokenizer, target_id, context, verbose=False):
     ).input_ids
     # use model to solicit a prediction
     outputs = model.generate(
-        input_ids=input_ids.to(device),
+        input_ids=input_ids.to(model.device),
         output_scores=True,
         return_dict=True,
         return_dict_in_generate=True,
@@ -195,7 +210,7 @@ def probe_redpajama(model, tokenizer, target_id, context, verbose=False):
     for i in range(4):
         logits = outputs["scores"][i]
         probs = softmax(logits, dim=-1)
-        probs = probs.detach().cpu().numpy()
+        probs = to_numpy(probs)
         if tokenizer.decode([np.argmax(probs)]) not in [
             "<|endoftext|>",
             "<|padding|>",
@@ -208,7 +223,7 @@ def probe_redpajama(model, tokenizer, target_id, context, verbose=False):
     logits = outputs["scores"][save_itr]
     # convert our prediction scores to a probability distribution with softmax
     probs = softmax(logits, dim=-1)
-    probs = probs.detach().cpu().numpy()
+    probs = to_numpy(probs)
     # grab the full decoded output for verbose:
     decoded_output = tokenizer.decode(sequences)
 
@@ -235,7 +250,7 @@ def probe_mpt(model, tokenizer, target_id, context, verbose=False):
     ).input_ids
     # use model to solicit a prediction
     outputs = model.generate(
-        input_ids=input_ids.to(device),
+        input_ids=input_ids.to(model.device),
         output_scores=True,
         return_dict=True,
         return_dict_in_generate=True,
@@ -248,7 +263,7 @@ def probe_mpt(model, tokenizer, target_id, context, verbose=False):
     for i in range(4):
         logits = outputs["scores"][i]
         probs = softmax(logits, dim=-1)
-        probs = probs.detach().cpu().numpy()
+        probs = to_numpy(probs)
         if tokenizer.decode([np.argmax(probs)]) not in [
             "<|endoftext|>",
             "<|padding|>",
@@ -261,7 +276,7 @@ def probe_mpt(model, tokenizer, target_id, context, verbose=False):
     logits = outputs["scores"][save_itr]
     # convert our prediction scores to a probability distribution with softmax
     probs = softmax(logits, dim=-1)
-    probs = probs.detach().cpu().numpy()
+    probs = to_numpy(probs)
     # grab the full decoded output for verbose:
     decoded_output = tokenizer.decode(sequences)
 
@@ -277,16 +292,23 @@ def probe_mpt(model, tokenizer, target_id, context, verbose=False):
     return probs[0][target_id.item()]
 
 
-def probe_gpt(model, tokenizer, target_id, context, verbose=False):
+def probe_gpt(
+    model, tokenizer, target_id, context, verbose=False, candidate_only=False
+):
     # tokenize context
     input_ids = tokenizer(
         context,
         return_tensors="pt",
-    ).input_ids.to(device)
+    ).input_ids.to(model.device)
 
     # grab value
     target_scalar = target_id.detach().cpu().numpy()
 
+    if candidate_only:
+        return probe_causal_candidates(
+            model, tokenizer, target_id, context, input_ids, verbose
+        )
+
     # use model to solicit a prediction
     outputs = model(input_ids=input_ids, output_hidden_states=True, return_dict=True)
 
@@ -294,7 +316,7 @@ def probe_gpt(model, tokenizer, target_id, context, verbose=False):
     logits = outputs["logits"][0, -1]
     # convert our prediction scores to a probability distribution with softmax
     probs = softmax(logits, dim=-1)
-    probs = list(probs.detach().cpu().numpy())
+    probs = list(to_numpy(probs))
 
     if verbose:
         print(f"\n\tcontext... {context}")
@@ -332,13 +354,13 @@ def probe_bert(model, tokenizer, target_id, context, verbose=False):
     mask_token_index = torch.where(input_ids == tokenizer.mask_token_id)[1]
 
     # use model to solicit a prediction
-    logits = model(input_ids=input_ids.to(device)).logits
+    logits = model(input_ids=input_ids.to(model.device)).logits
     mask_token_logits = logits[0, mask_token_index, :]
 
     # Convert our prediction scores to a probability distribution with softmax
     probs = torch.squeeze(softmax(mask_token_logits, dim=-1))
 
-    probs = probs.detach().cpu().numpy()
+    probs = to_numpy(probs)
 
     if verbose:
         print(f"\n\tcontext... {context}")
@@ -354,16 +376,23 @@ def probe_bert(model, tokenizer, target_id, context, verbose=False):
     return probs[target_id.item()]
 
 
-def probe_llama(model, tokenizer, target_id, context, verbose=False):
+def probe_llama(
+    model, tokenizer, target_id, context, verbose=False, candidate_only=False
+):
     # tokenize context
     input_ids = tokenizer(
         context,
         return_tensors="pt",
-    ).input_ids.to(device)
+    ).input_ids.to(model.device)
 
     # grab value
     target_scalar = target_id.detach().cpu().numpy()
 
+    if candidate_only:
+        return probe_causal_candidates(
+            model, tokenizer, target_id, context, input_ids, verbose
+        )
+
     # use model to solicit a prediction
     outputs = model(input_ids=input_ids, output_hidden_states=True, return_dict=True)
 
@@ -372,7 +401,7 @@ def probe_llama(model, tokenizer, target_id, context, verbose=False):
     # convert our prediction scores to a probability distribution with softmax
     probs = softmax(logits, dim=-1)
 
-    probs = list(probs.detach().cpu().numpy())
+    probs = list(to_numpy(probs))
 
     if verbose:
         print(f"\n\tcontext... {context}")
@@ -395,3 +424,623 @@ def probe_llama(model, tokenizer, target_id, context, verbose=False):
     except IndexError:
         print("target index not in model vocabulary scope; raising IndexError")
         return None
+
+
+# batched probing helpers
+# instead of one forward pass per (context, target) pair, the helpers below
+# run a whole batch of contexts through the model at once and gather each
+# row's target probability from its own next-token distribution
+
+
+def pad_batch(sequences, pad_id, left=True):
+    # pad a list of token id lists into a rectangular batch with an attention mask
+    # causal models are left-padded so that the last position of every row
+    # is that row's final context token
+    max_len = max(len(seq) for seq in sequences)
+    input_ids = torch.full((len(sequences), max_len), pad_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(sequences), max_len), dtype=torch.long)
+    for row, seq in enumerate(sequences):
+        if left:
+            input_ids[row, max_len - len(seq) :] = torch.tensor(seq, dtype=torch.long)
+            attention_mask[row, max_len - len(seq) :] = 1
+        else:
+            input_ids[row, : len(seq)] = torch.tensor(seq, dtype=torch.long)
+            attention_mask[row, : len(seq)] = 1
+    return input_ids, attention_mask
+
+
+def get_pad_id(tokenizer):
+    # not every tokenizer ships a pad token (e.g., gpt2), fall back to eos
+    if tokenizer.pad_token_id is not None:
+        return tokenizer.pad_token_id
+    if tokenizer.eos_token_id is not None:
+        return tokenizer.eos_token_id
+    return 0
+
+
+def tokenize_batch_contexts(tokenizer, contexts, prefix):
+    # tokenize contexts in one call, the way the batched probe for prefix does
+    if prefix in generate_probe_settings:
+        return tokenizer(
+            contexts,
+            max_length=generate_probe_settings[prefix]["max_length"],
+            truncation=True,
+            return_token_type_ids=False,
+        )["input_ids"]
+    elif prefix in ["bert", "roberta"]:
+        return tokenizer(
+            contexts,
+            max_length=512,
+            truncation=True,
+        )["input_ids"]
+    return tokenizer(contexts, return_token_type_ids=False)["input_ids"]
+
+
+def pad_sequences_batch(tokenizer, tokenized_contexts, target_ids):
+    # right-pad every (context, candidate) sequence of a full-target batch
+    sequences = []
+    for context_ids, candidates in zip(tokenized_contexts, target_ids):
+        for candidate_ids in candidates:
+            sequences.append(context_ids + candidate_ids)
+    return pad_batch(sequences, get_pad_id(tokenizer), left=False)
+
+
+def collate_probe_batch(
+    batched_probe_func, model, tokenizer, tokenized_contexts, target_ids
+):
+    # pad a batch the way batched_probe_func would, so that it can be done
+    # ahead of time and passed back in as padded_batch
+    probe_func = getattr(batched_probe_func, "func", batched_probe_func)
+    if probe_func is probe_causal_sequences_batch:
+        return pad_sequences_batch(tokenizer, tokenized_contexts, target_ids)
+    left = (probe_func is probe_causal_batch) or (
+        (probe_func is probe_teacher_forced_batch)
+        and (not model.config.is_encoder_decoder)
+    )
+    return pad_batch(tokenized_contexts, get_pad_id(tokenizer), left=left)
+
+
+def causal_forward_kwargs(model, input_ids, attention_mask):
+    # models with absolute positions (e.g., gpt2) need explicit position ids
+    # under left-padding, models that accept them get ids counted from the
+    # first real token; the rest (opt, bloom) derive them from the mask
+    forward_kwargs = {"input_ids": input_ids, "attention_mask": attention_mask}
+    if "position_ids" in inspect.signature(model.forward).parameters:
+        position_ids = attention_mask.cumsum(-1) - 1
+        position_ids.masked_fill_(attention_mask == 0, 1)
+        forward_kwargs["position_ids"] = position_ids
+    return forward_kwargs
+
+
+def probe_causal_batch(
+    model,
+    tokenizer,
+    target_ids,
+    contexts,
+    verbose=False,
+    candidate_only=False,
+    tokenized_contexts=None,
+    padded_batch=None,
+):
+    # batched counterpart of probe_gpt and probe_llama
+    # tokenize all contexts in one call (unless done upstream), then left-pad them
+    # (unless collated upstream, see collate_probe_batch)
+    if tokenized_contexts is None:
+        tokenized_contexts = tokenize_batch_contexts(tokenizer, contexts, "gpt")
+    if padded_batch is None:
+        padded_batch = pad_batch(tokenized_contexts, get_pad_id(tokenizer))
+    input_ids, attention_mask = padded_batch
+    input_ids = input_ids.to(model.device, non_blocking=True)
+    attention_mask = attention_mask.to(model.device, non_blocking=True)
+    forward_kwargs = causal_forward_kwargs(model, input_ids, attention_mask)
+
+    if candidate_only:
+        hidden_states = last_hidden_states(model, forward_kwargs)
+        target_probs, vocab_size = candidate_probs(model, hidden_states, target_ids)
+        if verbose:
+            for row, context in enumerate(contexts):
+                print(f"\n\tcontext... {context}")
+                print(f"\ttokenized_context ids... {tokenized_contexts[row]}")
+                print(f"\tdecoded target ids... {tokenizer.decode(target_ids[row])}\n")
+        return unpack_target_probs(target_probs, target_ids, vocab_size)
+
+    # use model to solicit a prediction for every row at once
+    outputs = model(**forward_kwargs, return_dict=True)
+
+    # last-position logits of every row, which are real tokens due to left-padding
+    logits = outputs["logits"][:, -1, :]
+    # convert our prediction scores to a probability distribution with softmax
+    probs = softmax(logits, dim=-1)
+
+    return gather_target_probs(
+        tokenizer, probs, target_ids, contexts, tokenized_contexts, verbose
+    )
+
+
+def probe_bert_batch(
+    model,
+    tokenizer,
+    target_ids,
+    contexts,
+    verbose=False,
+    tokenized_contexts=None,
+    padded_batch=None,
+):
+    # batched counterpart of probe_bert
+    if tokenized_contexts is None:
+        tokenized_contexts = tokenize_batch_contexts(tokenizer, contexts, "bert")
+    # masked LMs attend in both directions, so right-padding is fine
+    if padded_batch is None:
+        padded_batch = pad_batch(tokenized_contexts, get_pad_id(tokenizer), left=False)
+    input_ids, attention_mask = padded_batch
+
+    # first mask token of every row
+    mask_token_index = (input_ids == tokenizer.mask_token_id).int().argmax(dim=-1)
+
+    # use model to solicit a prediction for every row at once
+    logits = model(
+        input_ids=input_ids.to(model.device, non_blocking=True),
+        attention_mask=attention_mask.to(model.device, non_blocking=True),
+    ).logits
+    mask_token_logits = logits[
+        torch.arange(logits.shape[0], device=logits.device),
+        mask_token_index.to(logits.device),
+    ]
+
+    # Convert our prediction scores to a probability distribution with softmax
+    probs = softmax(mask_token_logits, dim=-1)
+
+    return gather_target_probs(
+        tokenizer, probs, target_ids, contexts, tokenized_contexts, verbose
+    )
+
+
+def gather_target_probs(
+    tokenizer, probs, target_ids, contexts, tokenized_contexts, verbose=False
+):
+    # target_ids holds one list of candidate ids per row, since a fact and its
+    # counterfacts are all read off the same next-token distribution
+    # pick the candidate probabilities on device and only move those to host
+    vocab_size = probs.shape[-1]
+    with profile_stage("softmax_gather"):
+        index = candidate_index(target_ids, vocab_size).to(probs.device)
+        target_probs = probs.gather(1, index)
+    target_probs = to_numpy(target_probs)
+
+    if verbose:
+        predicted_ids = probs.argmax(dim=-1).tolist()
+        for row, context in enumerate(contexts):
+            print(f"\n\tcontext... {context}")
+            print(f"\ttokenized_context ids... {tokenized_contexts[row]}")
+            print(f"\tdecoded target ids... {tokenizer.decode(target_ids[row])}")
+            print(
+                f"\tmost probable prediction id decoded... {tokenizer.decode([predicted_ids[row]])}\n"
+            )
+
+    return unpack_target_probs(target_probs, target_ids, vocab_size)
+
+
+def candidate_index(target_ids, vocab_size):
+    # rectangular index of every row's candidate ids, zero-filled where a row has
+    # fewer candidates or a target falls outside the vocabulary
+    max_candidates = max(len(candidate_ids) for candidate_ids in target_ids)
+    index = torch.zeros((len(target_ids), max_candidates), dtype=torch.long)
+    for row, candidate_ids in enumerate(target_ids):
+        index[row, : len(candidate_ids)] = torch.tensor(
+            [target_id if target_id < vocab_size else 0 for target_id in candidate_ids],
+            dtype=torch.long,
+        )
+    return index
+
+
+def unpack_target_probs(target_probs, target_ids, vocab_size):
+    # out-of-vocabulary targets mirror the None returned by the single probes
+    return [
+        [
+            target_probs[row][col] if target_id < vocab_size else None
+            for col, target_id in enumerate(candidate_ids)
+        ]
+        for row, candidate_ids in enumerate(target_ids)
+    ]
+
+
+# candidate-only scoring helpers
+# a causal LM's forward projects every position onto the full vocabulary,
+# though only the last position's distribution over a few candidates is read
+
+
+def last_hidden_states(model, forward_kwargs):
+    # run the transformer body without its LM head, keeping the last position
+    base_model = getattr(model, model.base_model_prefix)
+    outputs = base_model(**forward_kwargs, return_dict=True)
+    return outputs["last_hidden_state"][:, -1, :]
+
+
+def candidate_probs(model, hidden_states, target_ids):
+    # project the last-position hidden states with the LM head, normalize with one
+    # logsumexp, and return just the candidate probabilities to the host
+    # the normalizer is exact, so these match the full softmax
+    with profile_stage("softmax_gather"):
+        logits = model.get_output_embeddings()(hidden_states).float()
+        vocab_size = logits.shape[-1]
+        index = candidate_index(target_ids, vocab_size).to(logits.device)
+        log_normalizer = torch.logsumexp(logits, dim=-1, keepdim=True)
+        target_probs = torch.exp(logits.gather(1, index) - log_normalizer)
+    return to_numpy(target_probs), vocab_size
+
+
+def probe_causal_candidates(model, tokenizer, target_id, context, input_ids, verbose):
+    # candidate-only path of probe_gpt and probe_llama
+    hidden_states = last_hidden_states(model, {"input_ids": input_ids})
+    target_probs, vocab_size = candidate_probs(
+        model, hidden_states, [[target_id.item()]]
+    )
+
+    if verbose:
+        print(f"\n\tcontext... {context}")
+        print(f"\ttokenized_context ids... {input_ids}")
+        print(f"\tdecoded tokenized_context... {tokenizer.decode(input_ids[0])}")
+        print(f"\tdecoded target id... {tokenizer.decode([target_id.item()])}\n")
+
+    return unpack_target_probs(target_probs, [[target_id.item()]], vocab_size)[0][0]
+
+
+# prefix-cached scoring for causal probes
+# contexts sharing a long token prefix reuse that prefix's past_key_values from a
+# PrefixCache (see prefix_cache.py), so only their suffixes are run
+
+
+def prefix_cached_last_logits(model, context_ids, prefix_length, prefix_cache):
+    # last-position logits of one context, running its shared prefix at most once
+    if prefix_length == 0:
+        prefix_cache.tokens_run += len(context_ids)
+        return model(
+            input_ids=torch.tensor([context_ids], device=model.device), return_dict=True
+        ).logits[0, -1]
+
+    prefix_ids = tuple(context_ids[:prefix_length])
+    entry = prefix_cache.get(prefix_ids)
+    if entry is None:
+        outputs = model(
+            input_ids=torch.tensor([prefix_ids], device=model.device),
+            use_cache=True,
+            return_dict=True,
+        )
+        entry = prefix_cache.put(
+            prefix_ids, outputs.past_key_values, outputs.logits[0, -1]
+        )
+        prefix_cache.tokens_run += prefix_length
+    else:
+        prefix_cache.tokens_saved += prefix_length
+
+    # the context is the shared prefix itself, e.g. a stem repeated across rows
+    if prefix_length == len(context_ids):
+        return entry["last_logits"]
+
+    past_key_values = prefix_cache.checkout(entry)
+    outputs = model(
+        input_ids=torch.tensor([context_ids[prefix_length:]], device=model.device),
+        past_key_values=past_key_values,
+        use_cache=True,
+        return_dict=True,
+    )
+    prefix_cache.checkin(entry, past_key_values, prefix_length)
+    prefix_cache.tokens_run += len(context_ids) - prefix_length
+    return outputs.logits[0, -1]
+
+
+def probe_causal_prefix_cached(
+    model,
+    tokenizer,
+    target_ids,
+    contexts,
+    tokenized_contexts,
+    prefix_lengths,
+    prefix_cache,
+    verbose=False,
+):
+    # prefix-cached counterpart of probe_causal_batch, one context at a time
+    model_probs = []
+    for context, context_ids, prefix_length, candidate_ids in zip(
+        contexts, tokenized_contexts, prefix_lengths, target_ids
+    ):
+        logits = prefix_cached_last_logits(
+            model, context_ids, prefix_length, prefix_cache
+        )
+        # convert our prediction scores to a probability distribution with softmax
+        probs = softmax(logits.unsqueeze(0), dim=-1)
+        model_probs.extend(
+            gather_target_probs(
+                tokenizer, probs, [candidate_ids], [context], [context_ids], verbose
+            )
+        )
+    return model_probs
+
+
+# full-target scoring for causal probes
+# the probes above score only the first sub-token of each entity, so entities
+# sharing that piece (e.g., <Tok>yo vs <Tok>ronto) can collide. The helper below
+# scores every sub-token instead: each candidate is appended to its context, all
+# candidates of a batch run through one forward pass, and the log-probs of the
+# candidate's tokens are summed (or averaged) per candidate
+
+
+def probe_causal_sequences_batch(
+    model,
+    tokenizer,
+    target_ids,
+    contexts,
+    verbose=False,
+    tokenized_contexts=None,
+    reduction="sum",
+    padded_batch=None,
+):
+    # target_ids holds, per context, one list of token ids per candidate
+    if tokenized_contexts is None:
+        tokenized_contexts = tokenize_batch_contexts(tokenizer, contexts, "gpt")
+
+    # pack every (context, candidate) sequence of the batch together, right-padded
+    # so that each row's context starts at position zero
+    if padded_batch is None:
+        padded_batch = pad_sequences_batch(tokenizer, tokenized_contexts, target_ids)
+    input_ids, attention_mask = padded_batch
+    forward_kwargs = causal_forward_kwargs(
+        model,
+        input_ids.to(model.device, non_blocking=True),
+        attention_mask.to(model.device, non_blocking=True),
+    )
+
+    # the logits at position t predict token t + 1, so every candidate token is
+    # scored at the position just before it
+    row_index = []
+    position_index = []
+    token_index = []
+    token_owner = []
+    sequence_itr = 0
+    for context_ids, candidates in zip(tokenized_contexts, target_ids):
+        for candidate_ids in candidates:
+            for token_count, token_id in enumerate(candidate_ids):
+                row_index.append(sequence_itr)
+                position_index.append(len(context_ids) - 1 + token_count)
+                token_index.append(token_id)
+                token_owner.append(sequence_itr)
+            sequence_itr += 1
+
+    # only the scored positions go through the LM head
+    base_model = getattr(model, model.base_model_prefix)
+    hidden_states = base_model(**forward_kwargs, return_dict=True)["last_hidden_state"]
+    hidden_states = hidden_states[
+        torch.tensor(row_index, device=hidden_states.device),
+        torch.tensor(position_index, device=hidden_states.device),
+    ]
+    with profile_stage("softmax_gather"):
+        logits = model.get_output_embeddings()(hidden_states).float()
+        token_log_probs = logits.gather(
+            1, torch.tensor(token_index, device=logits.device).unsqueeze(-1)
+        ).squeeze(-1) - torch.logsumexp(logits, dim=-1)
+
+        # reduce the token log-probs of each candidate
+        owner = torch.tensor(token_owner, device=logits.device)
+        sequence_log_probs = torch.zeros(
+            input_ids.shape[0], device=logits.device
+        ).index_add_(0, owner, token_log_probs)
+        if reduction == "mean":
+            sequence_lengths = torch.zeros(input_ids.shape[0], device=logits.device)
+            sequence_lengths.index_add_(0, owner, torch.ones_like(token_log_probs))
+            sequence_log_probs = sequence_log_probs / sequence_lengths.clamp(min=1)
+    sequence_probs = to_numpy(torch.exp(sequence_log_probs))
+
+    if verbose:
+        for row, context in enumerate(contexts):
+            print(f"\n\tcontext... {context}")
+            print(f"\ttokenized_context ids... {tokenized_contexts[row]}")
+            for candidate_ids in target_ids[row]:
+                print(f"\tdecoded target... {tokenizer.decode(candidate_ids)}")
+
+    # regroup per context, candidates without any tokens get no score
+    model_probs = []
+    sequence_itr = 0
+    for candidates in target_ids:
+        candidate_probs = []
+        for candidate_ids in candidates:
+            candidate_probs.append(
+                sequence_probs[sequence_itr] if candidate_ids else None
+            )
+            sequence_itr += 1
+        model_probs.append(candidate_probs)
+    return model_probs
+
+
+# teacher-forced scoring for the generate-based probes
+# probe_t5, probe_stablelm, probe_falcon, probe_redpajama and probe_mpt greedily
+# generate a few tokens and read the target probability off the first step
+# whose prediction is not a special token. The helpers below recover that same
+# step with plain forward passes: known tokens are fed in as decoder inputs
+# (t5) or appended to the context (decoder-only models), and the greedy
+# predictions are only checked against them on the host, one id per step
+
+# settings of the generate-based probes, keyed by prefix
+generate_probe_settings = {
+    "t5": {
+        "max_length": 512,
+        "max_new_tokens": 4,
+        "skip_tokens": ["<extra_id_0>", "", " ", "<pad>"],
+        # t5 answers span-corruption style, so its first step is expected to be
+        # the sentinel; it is verified like any other forced token
+        "forced_tokens": ["<extra_id_0>"],
+    },
+    "stablelm": {
+        "max_length": 4096,
+        "max_new_tokens": 4,
+        "skip_tokens": ["<|endoftext|>", "<|padding|>", "", " "],
+        "forced_tokens": [],
+    },
+    "falcon": {
+        "max_length": 2048,
+        "max_new_tokens": 3,
+        "skip_tokens": ["<|endoftext|>", "<|padding|>", "", " "],
+        "forced_tokens": [],
+    },
+    "redpajama": {
+        "max_length": 2048,
+        "max_new_tokens": 4,
+        "skip_tokens": ["<|endoftext|>", "<|padding|>", "", " "],
+        "forced_tokens": [],
+    },
+    "mpt": {
+        "max_length": 2048,
+        "max_new_tokens": 4,
+        "skip_tokens": ["<|endoftext|>", "<|padding|>", "", " "],
+        "forced_tokens": [],
+    },
+}
+
+
+def teacher_forced_step_logits(model, input_ids, attention_mask, forced_ids):
+    # logits of every decoding step given the forced tokens, in one forward pass
+    # returns a (batch, len(forced_ids) + 1, vocab) tensor
+    if model.config.is_encoder_decoder:
+        decoder_input_ids = torch.tensor(
+            [[model.config.decoder_start_token_id] + forced_ids] * input_ids.shape[0],
+            device=input_ids.device,
+        )
+        return model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            decoder_input_ids=decoder_input_ids,
+            return_dict=True,
+        ).logits
+
+    # decoder-only models see the forced tokens appended to the left-padded context
+    forced = torch.tensor(
+        [forced_ids] * input_ids.shape[0], dtype=torch.long, device=input_ids.device
+    )
+    input_ids = torch.cat([input_ids, forced], dim=-1)
+    attention_mask = torch.cat([attention_mask, torch.ones_like(forced)], dim=-1)
+    logits = model(
+        **causal_forward_kwargs(model, input_ids, attention_mask), return_dict=True
+    ).logits
+    return logits[:, -(len(forced_ids) + 1) :, :]
+
+
+def find_scored_step(tokenizer, predicted_ids, forced_ids, settings):
+    # replay greedy decoding over one row's predictions
+    # returns the step to score, or the corrected forced tokens if a forced
+    # token disagrees with the greedy prediction
+    for step, predicted_id in enumerate(predicted_ids):
+        if (tokenizer.decode([predicted_id]) not in settings["skip_tokens"]) or (
+            step == settings["max_new_tokens"] - 1
+        ):
+            return step, None
+        if (step == len(forced_ids)) or (forced_ids[step] != predicted_id):
+            return None, forced_ids[:step] + [predicted_id]
+
+
+def teacher_forced_row_logits(model, tokenizer, context_ids, forced_ids, settings):
+    # single-row fallback for rows whose greedy path left the forced tokens
+    input_ids = torch.tensor([context_ids], dtype=torch.long, device=model.device)
+    attention_mask = torch.ones_like(input_ids)
+    while True:
+        step_logits = teacher_forced_step_logits(
+            model, input_ids, attention_mask, forced_ids
+        )[0]
+        step, forced_ids = find_scored_step(
+            tokenizer, step_logits.argmax(dim=-1).tolist(), forced_ids, settings
+        )
+        if step is not None:
+            return step_logits[step]
+
+
+def probe_teacher_forced_batch(
+    model,
+    tokenizer,
+    target_ids,
+    contexts,
+    verbose=False,
+    family="t5",
+    tokenized_contexts=None,
+    padded_batch=None,
+):
+    # batched, teacher-forced counterpart of the generate-based probes
+    settings = generate_probe_settings[family]
+    if tokenized_contexts is None:
+        tokenized_contexts = tokenize_batch_contexts(tokenizer, contexts, family)
+    forced_ids = tokenizer.convert_tokens_to_ids(settings["forced_tokens"])
+
+    # encoder inputs are right-padded, decoder-only contexts left-padded
+    if padded_batch is None:
+        padded_batch = pad_batch(
+            tokenized_contexts,
+            get_pad_id(tokenizer),
+            left=not model.config.is_encoder_decoder,
+        )
+    input_ids, attention_mask = padded_batch
+    step_logits = teacher_forced_step_logits(
+        model,
+        input_ids.to(model.device, non_blocking=True),
+        attention_mask.to(model.device, non_blocking=True),
+        forced_ids,
+    )
+
+    # pick every row's scored step, falling back row-wise when greedy decoding
+    # would not have produced the forced tokens
+    scored_logits = []
+    for row, predicted_ids in enumerate(step_logits.argmax(dim=-1).tolist()):
+        step, row_forced_ids = find_scored_step(
+            tokenizer, predicted_ids, forced_ids, settings
+        )
+        if step is not None:
+            scored_logits.append(step_logits[row, step])
+        else:
+            scored_logits.append(
+                teacher_forced_row_logits(
+                    model, tokenizer, tokenized_contexts[row], row_forced_ids, settings
+                )
+            )
+
+    # convert our prediction scores to a probability distribution with softmax
+    probs = softmax(torch.stack(scored_logits), dim=-1)
+
+    return gather_target_probs(
+        tokenizer, probs, target_ids, contexts, tokenized_contexts, verbose
+    )
+
+
+def probe_teacher_forced(
+    model, tokenizer, target_id, context, verbose=False, family="t5"
+):
+    # single-context, teacher-forced counterpart of the generate-based probes
+    return probe_teacher_forced_batch(
+        model, tokenizer, [[target_id.item()]], [context], verbose, family
+    )[0][0]
+
+
+def check_teacher_forced_agreement(
+    model, tokenizer, family, reference_pairs, verbose=False
+):
+    # compare teacher-forced probabilities against the generate-based probe of the
+    # given family on a reference set of (context, target_id) pairs
+    # returns the largest absolute difference
+    generate_probe = {
+        "t5": probe_t5,
+        "stablelm": probe_stablelm,
+        "falcon": probe_falcon,
+        "redpajama": probe_redpajama,
+        "mpt": probe_mpt,
+    }[family]
+
+    max_abs_diff = 0.0
+    for context, target_id in reference_pairs:
+        generate_prob = generate_probe(model, tokenizer, target_id, context)
+        teacher_forced_prob = probe_teacher_forced(
+            model, tokenizer, target_id, context, family=family
+        )
+        abs_diff = abs(float(generate_prob) - float(teacher_forced_prob))
+        max_abs_diff = max(max_abs_diff, abs_diff)
+        if verbose:
+            print(
+                f"\t{context}... generate {generate_prob}, teacher-forced {teacher_forced_prob}"
+            )
+
+    print(f"max abs diff over {len(reference_pairs)} reference pairs: {max_abs_diff}")
+    return max_abs_diff
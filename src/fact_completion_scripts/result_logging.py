@@ -0,0 +1,90 @@
+"""
+Streaming, crash-safe result logging for fact-completion runs
+
+Each scored row is appended to a JSONL log as soon as it is recorded, and the
+log is flushed and fsync'd every few rows, so a crash late in a long run loses
+at most the rows since the last sync. A resumed run reads the partial log back
+to skip the dataset_ids already scored. Once a run finishes, the rows are
+consolidated into the usual score_dict_full layout.
+"""
+
+import json
+import os
+
+
+class StreamingResultWriter:
+    """
+    Append-only JSONL writer for scored rows
+
+    Every line holds the model name, the row's position in the dataset and
+    the row's results; the file is fsync'd every flush_every rows. With resume
+    set, an existing log is appended to rather than truncated.
+    """
+
+    def __init__(self, fpath, flush_every=100, resume=False):
+        self.fpath = fpath
+        self.flush_every = flush_every
+        self.pending_rows = 0
+
+        if resume and os.path.isfile(fpath) and os.path.getsize(fpath):
+            # a crash mid-write can leave a partial last line, which is ended
+            # here so that it doesn't swallow the next row (readers skip it)
+            with open(fpath, "rb") as infile:
+                infile.seek(-1, os.SEEK_END)
+                ends_with_newline = infile.read(1) == b"\n"
+            self.outfile = open(fpath, "a", encoding="utf-8")
+            if not ends_with_newline:
+                self.outfile.write("\n")
+        else:
+            self.outfile = open(fpath, "w", encoding="utf-8")
+
+    def write(self, model_name, row_itr, result):
+        record = {"model_name": model_name, "row": row_itr, "result": result}
+        self.outfile.write(json.dumps(record) + "\n")
+        self.pending_rows += 1
+        if self.pending_rows >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self.outfile.flush()
+        os.fsync(self.outfile.fileno())
+        self.pending_rows = 0
+
+    def close(self):
+        self.flush()
+        self.outfile.close()
+
+
+# helper to read a model's rows back from a streamed log, keyed by dataset
+# position (a row written twice keeps its latest results)
+def read_streamed_results(fpath, model_name):
+    results = {}
+    if not os.path.isfile(fpath):
+        return results
+    with open(fpath, "r", encoding="utf-8") as infile:
+        for line in infile:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # partial line from a crash mid-write
+                continue
+            if record["model_name"] == model_name:
+                results[record["row"]] = record["result"]
+    return results
+
+
+# helper to pull the rows of a partial log that a resumed run can skip, keyed
+# by dataset_id (rows without one are always re-run)
+def get_resumable_results(fpath, model_name):
+    return {
+        result["dataset_id"]: result
+        for result in read_streamed_results(fpath, model_name).values()
+        if "dataset_id" in result
+    }
+
+
+# helper to consolidate a model's streamed rows in dataset order, matching
+# the score_dict_full layout
+def consolidate_streamed_results(fpath, model_name):
+    results = read_streamed_results(fpath, model_name)
+    return [results[row_itr] for row_itr in sorted(results)]
@@ -4,29 +4,147 @@ Main script for running fact completion with contrastive knowledge assessment
 Instead of running the full benchmark, this script enables users to enter a
 custom config file for their experiment. For example, the demo notebook that
 tests a handful of example facts uses this function.
+
+Setting "languages" in the config (a list of language codes or names, or
+"all") sweeps the Fact-Completion splits of those languages instead of
+"input_information", loading each model once for the whole sweep and writing
+one log per language.
+
+Setting "model_cache" to a model_cache.ModelCache keeps the models loaded
+between calls of main, e.g. when a notebook runs several configs in a row.
 """
 
 from argparse import ArgumentParser
 import importlib
 from transformers import set_seed
+from datasets import load_dataset
+
+from compare_models import compare_models, get_model_and_tokenizer
+from post_process_logs_folder import supported_languages
 
-from compare_models import compare_models
+
+# helper to map a language code or name to its (code, name) pair
+def get_language(language):
+    for lang_code, lang_name in supported_languages.items():
+        if language.lower() in [lang_code, lang_name]:
+            return lang_code, lang_name
+    raise Exception(f"Language {language} not supported.")
+
+
+def run_compare_models(config, input_dataset, **kwargs):
+    return compare_models(
+        config["models"],
+        input_dataset,
+        config["verbosity"],
+        batch_size=config.get("batch_size"),
+        candidate_only=config.get("candidate_only", False),
+        teacher_forced=config.get("teacher_forced", False),
+        sort_by_length=config.get("sort_by_length", True),
+        target_scoring=config.get("target_scoring", "first_token"),
+        prefix_cache_mb=config.get("prefix_cache_mb"),
+        tokenization_cache_dir=config.get("tokenization_cache_dir"),
+        prefetch_batches=config.get("prefetch_batches"),
+        stream_log_fpath=config.get("stream_log_fpath"),
+        flush_every=config.get("flush_every", 100),
+        resume=config.get("resume", False),
+        cpu_config=config.get("cpu_config"),
+        model_cache=config.get("model_cache"),
+        profile=config.get("profile", False),
+        score_cache_fpath=config.get("score_cache_fpath"),
+        log_format=config.get("log_format", "json"),
+        **kwargs,
+    )
 
 
 def main(config):
     set_seed(42)
 
-    score_dicts = compare_models(
-        config["models"], config["input_information"], config["verbosity"]
-    )
+    if config.get("languages"):
+        return sweep_languages(config)
+
+    score_dicts = run_compare_models(config, config["input_information"])
 
     return score_dicts
 
 
+def sweep_languages(config):
+    """
+    Run every model of the config over several languages' splits
+
+    Each model is loaded once and the splits are loaded one at a time; a
+    "{language}" placeholder in stream_log_fpath, required when sweeping more
+    than one language, is filled per language.
+    Returns the (score_dicts, log_fpath) of each run, keyed by language code
+    """
+    languages = config["languages"]
+    if languages == "all":
+        languages = list(supported_languages)
+    languages = [get_language(language) for language in languages]
+    # dataset_ids are shared across the translated splits, so languages
+    # streaming to one file would truncate (or resume from) each other's rows
+    stream_log_fpath = config.get("stream_log_fpath")
+    if (
+        stream_log_fpath
+        and (len(languages) > 1)
+        and ("{language}" not in stream_log_fpath)
+    ):
+        raise Exception(
+            "stream_log_fpath needs a {language} placeholder to sweep several languages."
+        )
+
+    sweep_results = {}
+    for model_name in config["models"]:
+        print(f"Loading {model_name} once for {len(languages)} languages...")
+        if config.get("model_cache") is not None:
+            tokenizer_and_model = config["model_cache"].get(
+                model_name, config.get("cpu_config")
+            )
+        else:
+            tokenizer_and_model = get_model_and_tokenizer(
+                model_name, config.get("cpu_config")
+            )
+        model_config = dict(config, models=[model_name])
+
+        for lang_code, lang_name in languages:
+            print(f"Running {lang_name}...")
+            input_dataset = load_dataset(
+                "Polyglot-or-Not/Fact-Completion", split=lang_name.capitalize()
+            )
+            if config.get("stream_log_fpath"):
+                model_config["stream_log_fpath"] = config["stream_log_fpath"].format(
+                    language=lang_code
+                )
+            sweep_results.setdefault(lang_code, []).append(
+                run_compare_models(
+                    model_config,
+                    input_dataset,
+                    tokenizer_and_model=tokenizer_and_model,
+                    language=lang_code,
+                )
+            )
+
+        del tokenizer_and_model
+
+    return sweep_results
+
+
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("configs", type=str, help="Config file to set up run cka")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip dataset_ids already in the config's stream_log_fpath",
+    )
     args = parser.parse_args()
     config = importlib.import_module(args.configs).config
+    if args.resume:
+        config["resume"] = True
     score_dicts = main(config)
-    print(f"\nScore dict summary:\n{score_dicts[1]}")
+    if config.get("languages"):
+        for lang_code, lang_results in score_dicts.items():
+            for lang_score_dicts, log_fpath in lang_results:
+                print(f"\n{lang_code} score dict summary:\n{lang_score_dicts[1]}")
+                print(log_fpath)
+    else:
+        print(f"\nScore dict summary:\n{score_dicts[1]}")
@@ -0,0 +1,175 @@
+"""
+Per-stage profiling for fact-completion runs
+
+A StageProfiler records the wall time spent in each stage of a run
+(tokenization, target resolution, collation, forward pass, softmax/gather,
+host transfer and logging), along with facts/sec, tokens/sec, peak RSS and
+peak device memory. Stages are marked with profile_stage, which does nothing
+unless a profiler is active, so the probes can be instrumented at no cost to
+unprofiled runs. Nested stages are timed exclusively: the time of an inner
+stage is not counted again in the stage around it.
+
+With an active profiler, CUDA is synchronized at every stage boundary so that
+asynchronous kernels are charged to the stage that launched them; this costs
+some overlap, so profiled runs are a little slower than unprofiled ones.
+"""
+
+import collections
+import contextlib
+import datetime
+import json
+import os
+import resource
+import threading
+import time
+import numpy as np
+import torch
+
+# profiler that profile_stage reports to, None when not profiling
+active_profiler = None
+
+# stages, in the order they are reported
+profile_stages = [
+    "tokenization",
+    "target_resolution",
+    "score_cache",
+    "collation",
+    "forward",
+    "softmax_gather",
+    "host_transfer",
+    "logging",
+]
+
+
+class StageProfiler:
+    """
+    Wall time per stage, token counts and peak memory of one model's run
+
+    Only the thread that created the profiler is timed (e.g. not the batch
+    producer's thread, see batch_pipeline.py)
+    """
+
+    def __init__(self):
+        self.seconds = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+        self.stack = []
+        self.tokens = 0
+        self.thread_id = threading.get_ident()
+        self.synchronize = torch.cuda.is_available()
+        if self.synchronize:
+            torch.cuda.reset_peak_memory_stats()
+        self.start_time = time.perf_counter()
+
+    def sync(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+
+    def start(self, stage):
+        self.sync()
+        self.stack.append([stage, time.perf_counter(), 0.0])
+
+    def stop(self):
+        self.sync()
+        stage, start_time, nested_seconds = self.stack.pop()
+        seconds = time.perf_counter() - start_time
+        self.seconds[stage] += seconds - nested_seconds
+        self.calls[stage] += 1
+        if self.stack:
+            self.stack[-1][2] += seconds
+
+    def add_seconds(self, stage, seconds):
+        # time measured elsewhere, outside of any other stage
+        self.seconds[stage] += seconds
+
+    def add_tokens(self, tokens):
+        self.tokens += tokens
+
+    def report(self, fact_count):
+        total_seconds = time.perf_counter() - self.start_time
+        stages = {
+            stage: {"seconds": self.seconds[stage], "calls": self.calls[stage]}
+            for stage in profile_stages
+            + sorted(set(self.seconds) - set(profile_stages))
+        }
+        report = {
+            "total_seconds": total_seconds,
+            "stages": stages,
+            "other_seconds": total_seconds - sum(self.seconds.values()),
+            "facts": fact_count,
+            "tokens": self.tokens,
+            "facts_per_second": fact_count / total_seconds if total_seconds else 0.0,
+            "tokens_per_second": self.tokens / total_seconds if total_seconds else 0.0,
+            # ru_maxrss is in kilobytes on Linux, and covers the whole process
+            "peak_rss_megabytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            / 1024,
+            "peak_device_megabytes": None,
+        }
+        if torch.cuda.is_available():
+            report["peak_device_megabytes"] = {
+                f"cuda:{device_itr}": torch.cuda.max_memory_allocated(device_itr)
+                / 1024**2
+                for device_itr in range(torch.cuda.device_count())
+            }
+        return report
+
+
+# helper to make profiler the one profile_stage reports to (None to stop)
+def set_active_profiler(profiler):
+    global active_profiler
+    active_profiler = profiler
+
+
+@contextlib.contextmanager
+def profile_stage(stage):
+    profiler = active_profiler
+    if (profiler is None) or (profiler.thread_id != threading.get_ident()):
+        yield
+        return
+    profiler.start(stage)
+    try:
+        yield
+    finally:
+        profiler.stop()
+
+
+# helpers to report time measured elsewhere, and tokens processed, to the
+# active profiler, if any
+def profile_seconds(stage, seconds):
+    if active_profiler is not None:
+        active_profiler.add_seconds(stage, seconds)
+
+
+def profile_tokens(tokens):
+    if active_profiler is not None:
+        active_profiler.add_tokens(tokens)
+
+
+# helper to summarize latencies (in seconds) as milliseconds percentiles
+def get_latency_summary(latencies):
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "mean": float(np.mean(latencies_ms)),
+        "p50": float(np.percentile(latencies_ms, 50)),
+        "p90": float(np.percentile(latencies_ms, 90)),
+        "p99": float(np.percentile(latencies_ms, 99)),
+    }
+
+
+# helper to write the profiles of a run report next to its json log
+# (e.g. logging/gpt-logged-cka-outputs-<dt>-profile.json)
+def write_profile_sidecar(log_fpath, run_report):
+    sidecar = {
+        "log_fpath": log_fpath,
+        "curr_datetime": str(datetime.datetime.now()),
+        "models": {
+            model_name: dict(
+                model_report["profile"], execution=model_report.get("execution")
+            )
+            for model_name, model_report in run_report.items()
+            if "profile" in model_report
+        },
+    }
+    sidecar_fpath = os.path.splitext(log_fpath)[0] + "-profile.json"
+    with open(sidecar_fpath, "w") as outfile:
+        json.dump(sidecar, outfile, indent=4)
+    return sidecar_fpath
@@ -0,0 +1,139 @@
+"""
+Streaming aggregates of fact-completion scores
+
+compare_models used to keep every p_true and p_false in lists to summarize a
+run at the end, and per-relation breakdowns were recomputed later from the
+full json log. A ScoreAccumulator instead updates, row by row, the accuracy,
+the mean and variance of p_true and p_false (with Welford's algorithm) and a
+histogram of log10(p_true / p_false_average), both overall and per group of
+each grouping (e.g. per relation). Its memory is constant in the number of
+rows, so breakdowns are available during a run and after it, from the log's
+"score_aggregates", without re-reading the rows.
+"""
+
+import numpy as np
+
+# edges of the log-ratio histogram bins, in log10 units
+log_ratio_edges = np.linspace(-8.0, 8.0, 33)
+
+
+# helper to pull the source of a row (e.g. "rome" or "calinet") off its id
+def get_row_source(score_dict):
+    dataset_id = score_dict.get("dataset_id")
+    if dataset_id is None:
+        return None
+    return dataset_id.split("_")[0]
+
+
+# groupings of the breakdowns, each a function of a logged row returning its
+# group, or None to leave the row out of that grouping; subject types are only
+# grouped for datasets whose rows carry a "subject_type"
+default_groupings = {
+    "relation": lambda score_dict: score_dict.get("relation"),
+    "subject_type": lambda score_dict: score_dict.get("subject_type"),
+    "source": get_row_source,
+}
+
+
+class RunningMoments:
+    """
+    Count, mean and (population) variance of a stream, with Welford's algorithm
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def report(self):
+        variance = self.m2 / self.count if self.count else 0.0
+        return {"mean": self.mean, "variance": variance, "std": variance**0.5}
+
+
+class ScoreAggregate:
+    """
+    Accuracy, p_true and p_false moments and log-ratio histogram of some rows
+
+    The histogram has a bin below the first edge and one above the last, so
+    counts has one more entry than there are edges
+    """
+
+    def __init__(self):
+        self.fact_count = 0
+        self.true_count = 0
+        self.p_true = RunningMoments()
+        self.p_false = RunningMoments()
+        self.log_ratio_counts = np.zeros(len(log_ratio_edges) + 1, dtype=np.int64)
+
+    def update(self, p_true, p_false, is_true):
+        self.fact_count += 1
+        self.true_count += int(is_true)
+        self.p_true.update(p_true)
+        self.p_false.update(p_false)
+        log_ratio = np.log10((p_true + 1e-13) / (p_false + 1e-13))
+        self.log_ratio_counts[np.searchsorted(log_ratio_edges, log_ratio)] += 1
+
+    def report(self):
+        return {
+            "fact_count": self.fact_count,
+            "true_count": self.true_count,
+            "accuracy": self.true_count / self.fact_count if self.fact_count else 0.0,
+            "p_true": self.p_true.report(),
+            "p_false_average": self.p_false.report(),
+            "log_ratio_histogram": {
+                "edges": log_ratio_edges.tolist(),
+                "counts": self.log_ratio_counts.tolist(),
+            },
+        }
+
+
+class ScoreAccumulator:
+    """
+    Overall and per-group ScoreAggregates of a model's logged rows
+
+    groupings maps each breakdown's name to a function of a logged row that
+    returns its group, see default_groupings
+    """
+
+    def __init__(self, groupings=None):
+        self.groupings = default_groupings if groupings is None else groupings
+        self.overall = ScoreAggregate()
+        self.breakdowns = {grouping: {} for grouping in self.groupings}
+
+    def update(self, score_dict):
+        p_true = float(score_dict["p_true"])
+        p_false = float(score_dict["p_false_average"])
+        is_true = score_dict["p_true > p_false_average"] == "True"
+        self.overall.update(p_true, p_false, is_true)
+        for grouping, get_group in self.groupings.items():
+            group = get_group(score_dict)
+            if group is None:
+                continue
+            if group not in self.breakdowns[grouping]:
+                self.breakdowns[grouping][group] = ScoreAggregate()
+            self.breakdowns[grouping][group].update(p_true, p_false, is_true)
+
+    def report(self):
+        return {
+            "overall": self.overall.report(),
+            "breakdowns": {
+                grouping: {
+                    group: aggregate.report() for group, aggregate in groups.items()
+                }
+                for grouping, groups in self.breakdowns.items()
+            },
+        }
+
+
+# helper to accumulate the rows of a log, e.g. after merging logs
+def accumulate_rows(score_dict_full, groupings=None):
+    accumulator = ScoreAccumulator(groupings)
+    for score_dict in score_dict_full:
+        accumulator.update(score_dict)
+    return accumulator
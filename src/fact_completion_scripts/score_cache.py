@@ -0,0 +1,166 @@
+"""
+Persistent cross-run cache of fact-completion scores
+
+Runs are often repeated over mostly unchanged data, e.g. after fixing one
+language's translations or adding a counterfactual. The score cache is an
+SQLite file mapping (model, revision, precision, scoring, context, target) to
+the probability a model gave that pairing, and compare_models looks every row
+up in it before scheduling any forward passes: rows whose pairings are all
+cached are filled in from it and only new or changed rows are run (and then
+added to it). Runs sharing a cache file can write to it concurrently.
+"""
+
+import json
+import sqlite3
+import numpy as np
+
+# contexts per lookup query, under SQLite's default bound-variable limit
+lookup_chunk_size = 500
+
+
+# helper to describe a loaded model's weight precision (dtype and quantization)
+def get_model_precision(model):
+    precision = str(model.dtype).replace("torch.", "")
+    if getattr(model, "is_loaded_in_4bit", False):
+        precision += "-4bit"
+    elif getattr(model, "is_loaded_in_8bit", False):
+        precision += "-8bit"
+    elif any(
+        type(module).__module__.startswith("torch.ao.nn.quantized")
+        for module in model.modules()
+    ):
+        precision += "-int8-dynamic"
+    return precision
+
+
+# helper to build the score cache key of a model as it was loaded and of the
+# way its pairings get scored; the revision is the hub commit the weights were
+# loaded from, when known
+def get_score_cache_key(
+    model_name, model, target_scoring="first_token", teacher_forced=False
+):
+    scoring = target_scoring
+    if teacher_forced:
+        scoring += "-teacher_forced"
+    return (
+        model_name.lower(),
+        getattr(model.config, "_commit_hash", None) or "",
+        get_model_precision(model),
+        scoring,
+    )
+
+
+class ScoreCache:
+    """
+    SQLite-backed store of pairing probabilities
+
+    A pairing is a (context, target) pair, where target is the vocab id of
+    the scored token, or the list of them for full-target scoring. New scores
+    are committed every flush_every pairings and on close. Hits and misses
+    are counted per row: a row is a hit only if all of its pairings are.
+    """
+
+    def __init__(self, db_fpath, flush_every=1000):
+        self.db_fpath = db_fpath
+        self.flush_every = flush_every
+        self.pending_scores = []
+        self.row_hits = 0
+        self.row_misses = 0
+        self.stored_scores = 0
+
+        # a generous timeout lets concurrent runs (e.g. shards) wait on locks
+        self.connection = sqlite3.connect(db_fpath, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS scores (
+                model TEXT NOT NULL,
+                revision TEXT NOT NULL,
+                precision TEXT NOT NULL,
+                scoring TEXT NOT NULL,
+                context TEXT NOT NULL,
+                target TEXT NOT NULL,
+                prob REAL NOT NULL,
+                PRIMARY KEY (model, revision, precision, scoring, context, target)
+            )
+            """
+        )
+        self.connection.commit()
+
+    def lookup(self, cache_key, contexts):
+        # every cached (context, target) score of the given contexts
+        scores = {}
+        contexts = sorted(set(contexts))
+        for start in range(0, len(contexts), lookup_chunk_size):
+            chunk = contexts[start : start + lookup_chunk_size]
+            rows = self.connection.execute(
+                f"""
+                SELECT context, target, prob FROM scores
+                WHERE model = ? AND revision = ? AND precision = ? AND scoring = ?
+                AND context IN ({", ".join("?" * len(chunk))})
+                """,
+                list(cache_key) + chunk,
+            )
+            for context, target, prob in rows:
+                scores[(context, target)] = prob
+        return scores
+
+    def lookup_rows(self, cache_key, row_pairings):
+        """
+        Look up the rows of a dataset, each a list of (context, target)
+        pairings; returns one list of probabilities per row, or None for the
+        rows with any pairing missing from the cache
+
+        Probabilities come back as float32, like the probes return them, so
+        that cached rows average out exactly as freshly scored ones do
+        """
+        scores = self.lookup(
+            cache_key,
+            [context for pairings in row_pairings for context, _ in pairings],
+        )
+        row_probs = []
+        for pairings in row_pairings:
+            try:
+                row_probs.append(
+                    [
+                        np.float32(scores[(context, json.dumps(target))])
+                        for context, target in pairings
+                    ]
+                )
+                self.row_hits += 1
+            except KeyError:
+                row_probs.append(None)
+                self.row_misses += 1
+        return row_probs
+
+    def store_row(self, cache_key, pairings, probs):
+        for (context, target), prob in zip(pairings, probs):
+            self.pending_scores.append(
+                tuple(cache_key) + (context, json.dumps(target), float(prob))
+            )
+        if len(self.pending_scores) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.pending_scores:
+            return
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?, ?)",
+                self.pending_scores,
+            )
+        self.stored_scores += len(self.pending_scores)
+        self.pending_scores = []
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def report(self):
+        lookups = self.row_hits + self.row_misses
+        return {
+            "row_hits": self.row_hits,
+            "row_misses": self.row_misses,
+            "hit_rate": self.row_hits / lookups if lookups else 0.0,
+            "stored_scores": self.stored_scores + len(self.pending_scores),
+        }
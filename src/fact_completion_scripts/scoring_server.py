@@ -0,0 +1,342 @@
+"""
+Local HTTP server scoring completions with the fact-completion probes
+
+Rather than every notebook loading its own copy of a model, one long-running
+server holds it and answers "how likely is each of these completions after
+this context" over HTTP. Concurrent requests are coalesced into micro-batches:
+the scoring thread waits up to max_wait_ms after the first queued request (or
+until max_batch_requests are queued) and scores them all through
+probe_dataset_batched, so they share the batched forward passes, the length
+scheduling and the family's target resolution and context suffix of a
+compare_models run.
+
+Endpoints:
+POST /score with {"context": "The capital of France is", "candidates":
+["Paris", "Tokyo"]} returns {"probs": [...]}, one probability per candidate
+(of its first target token, as compare_models scores facts; generate-based
+families, e.g. t5, are scored through their teacher-forced probes)
+GET /metrics returns the queue depth and the batch size and latency stats
+GET /health returns the model name
+
+Example usage, serving gpt2 on CPU:
+python scoring_server.py --model gpt2 --port 8411 --cpu --max_wait_ms 10
+"""
+
+import collections
+import json
+import queue
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+
+from compare_models import get_model_and_tokenizer, probe_dataset_batched
+from model_families import get_model_family
+from probe_helpers import generate_probe_settings
+from run_profiling import get_latency_summary
+
+# requests whose latencies the metrics summarize
+latency_window = 1000
+
+
+class ScoringRequest:
+    """
+    A (context, candidates) request waiting on the scoring thread
+    """
+
+    def __init__(self, context, candidates):
+        self.context = context
+        self.candidates = candidates
+        self.enqueue_time = time.perf_counter()
+        self.done_event = threading.Event()
+        self.probs = None
+        self.error = None
+
+
+# helper to turn a request into a dataset row, with the first candidate as the
+# "fact" and the others as "counterfacts"; a single candidate is paired with a
+# copy of itself, whose probability is dropped
+def get_request_row(scoring_request):
+    candidates = scoring_request.candidates
+    if len(candidates) == 1:
+        candidates = candidates * 2
+    return {
+        "stem": scoring_request.context,
+        "true": candidates[0],
+        "false": " <br> ".join(candidates[1:]),
+    }
+
+
+class MicroBatcher:
+    """
+    Scoring thread coalescing queued requests into micro-batches
+
+    Each micro-batch holds up to max_batch_requests requests, collected for at
+    most max_wait_ms after its first one, and runs through
+    probe_dataset_batched with batch_size contexts per forward pass. score()
+    blocks the calling (e.g. HTTP handler) thread until its request is done
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        model,
+        prefix,
+        max_batch_requests=32,
+        max_wait_ms=10,
+        batch_size=16,
+    ):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.prefix = prefix
+        self.max_batch_requests = max_batch_requests
+        self.max_wait_seconds = max_wait_ms / 1000
+        self.batch_size = batch_size
+        self.request_queue = queue.Queue()
+        self.metrics_lock = threading.Lock()
+        self.request_count = 0
+        self.error_count = 0
+        self.batch_count = 0
+        self.batch_requests = collections.Counter()
+        self.forward_seconds = 0.0
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.queue_waits = collections.deque(maxlen=latency_window)
+        self.start_time = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def score(self, context, candidates):
+        scoring_request = ScoringRequest(context, candidates)
+        self.request_queue.put(scoring_request)
+        scoring_request.done_event.wait()
+        if scoring_request.error is not None:
+            raise scoring_request.error
+        return scoring_request.probs
+
+    def collect_batch(self):
+        # block for a first request, then take more until the window closes
+        batch = [self.request_queue.get()]
+        deadline = time.perf_counter() + self.max_wait_seconds
+        while len(batch) < self.max_batch_requests:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.request_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    @torch.no_grad()
+    def score_batch(self, batch):
+        model_probs, _ = probe_dataset_batched(
+            self.model,
+            self.tokenizer,
+            self.prefix,
+            [get_request_row(scoring_request) for scoring_request in batch],
+            self.batch_size,
+            teacher_forced=self.prefix in generate_probe_settings,
+            progress_bar=False,
+        )
+        for scoring_request, probs in zip(batch, model_probs):
+            probs = probs[: len(scoring_request.candidates)]
+            scoring_request.probs = [float(prob) for prob in probs]
+
+    def run(self):
+        while True:
+            batch = self.collect_batch()
+            start_time = time.perf_counter()
+            try:
+                self.score_batch(batch)
+            except Exception as error:
+                for scoring_request in batch:
+                    scoring_request.error = error
+            end_time = time.perf_counter()
+
+            with self.metrics_lock:
+                self.batch_count += 1
+                self.batch_requests[len(batch)] += 1
+                self.forward_seconds += end_time - start_time
+                for scoring_request in batch:
+                    self.request_count += 1
+                    self.error_count += int(scoring_request.error is not None)
+                    self.queue_waits.append(start_time - scoring_request.enqueue_time)
+                    self.latencies.append(end_time - scoring_request.enqueue_time)
+            for scoring_request in batch:
+                scoring_request.done_event.set()
+
+    def report(self):
+        with self.metrics_lock:
+            batch_sizes = list(self.batch_requests.elements())
+            report = {
+                "queue_depth": self.request_queue.qsize(),
+                "requests": self.request_count,
+                "errors": self.error_count,
+                "batches": self.batch_count,
+                "batch_requests": {
+                    "mean": float(np.mean(batch_sizes)) if batch_sizes else 0.0,
+                    "max": max(batch_sizes, default=0),
+                    "histogram": {
+                        str(size): count
+                        for size, count in sorted(self.batch_requests.items())
+                    },
+                },
+                "forward_seconds": self.forward_seconds,
+                "uptime_seconds": time.perf_counter() - self.start_time,
+            }
+            if self.latencies:
+                report["latency_ms"] = get_latency_summary(list(self.latencies))
+                report["queue_wait_ms"] = get_latency_summary(list(self.queue_waits))
+        return report
+
+
+# helper to check the body of a /score request, returning an error or None
+def validate_score_request(body):
+    if not isinstance(body, dict):
+        return "Request body must be a JSON object."
+    context = body.get("context")
+    candidates = body.get("candidates")
+    if not isinstance(context, str) or not context:
+        return "context must be a non-empty string."
+    if (
+        not isinstance(candidates, list)
+        or not candidates
+        or not all(isinstance(candidate, str) and candidate for candidate in candidates)
+    ):
+        return "candidates must be a non-empty list of non-empty strings."
+    # " <br> " delimits entities and stems in dataset rows
+    if any(" <br> " in text for text in [context] + candidates):
+        return "context and candidates can't contain ' <br> '."
+    return None
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    """
+    JSON endpoints of the scoring server, see the module docstring
+    """
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.send_json(200, self.server.batcher.report())
+        elif self.path == "/health":
+            self.send_json(200, {"status": "ok", "model": self.server.model_name})
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}."})
+
+    def do_POST(self):
+        if self.path != "/score":
+            self.send_json(404, {"error": f"Unknown path {self.path}."})
+            return
+        try:
+            content_length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(content_length))
+        except ValueError:
+            self.send_json(400, {"error": "Request body must be JSON."})
+            return
+        error = validate_score_request(body)
+        if error is not None:
+            self.send_json(400, {"error": error})
+            return
+        try:
+            probs = self.server.batcher.score(body["context"], body["candidates"])
+        except Exception as error:
+            self.send_json(500, {"error": str(error)})
+            return
+        self.send_json(200, {"probs": probs})
+
+    def log_message(self, format, *args):
+        # per-request access logs would drown out the scoring output
+        pass
+
+
+class ScoringServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server, one handler thread per connection, with room in the
+    listen backlog for bursts of concurrent clients
+    """
+
+    request_queue_size = 128
+
+
+def make_scoring_server(
+    model_name,
+    host="127.0.0.1",
+    port=8411,
+    tokenizer_and_model=None,
+    cpu_config=None,
+    max_batch_requests=32,
+    max_wait_ms=10,
+    batch_size=16,
+):
+    """
+    Build a (not yet serving) scoring server for a model
+
+    The model is loaded as compare_models loads it, unless tokenizer_and_model
+    is given. Call serve_forever() on the returned server to serve requests
+    """
+    if tokenizer_and_model is None:
+        tokenizer_and_model = get_model_and_tokenizer(model_name, cpu_config)
+    tokenizer, model = tokenizer_and_model
+
+    server = ScoringServer((host, port), ScoringRequestHandler)
+    server.model_name = model_name
+    server.batcher = MicroBatcher(
+        tokenizer,
+        model,
+        get_model_family(model_name)["prefix"],
+        max_batch_requests,
+        max_wait_ms,
+        batch_size,
+    )
+    return server
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--model", type=str, default="gpt2", help="Model name")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to bind")
+    parser.add_argument("--port", type=int, default=8411, help="Port to bind")
+    parser.add_argument(
+        "--cpu", action="store_true", help="Load the model for CPU execution"
+    )
+    parser.add_argument(
+        "--max_batch_requests",
+        type=int,
+        default=32,
+        help="Most requests coalesced into one micro-batch",
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=10,
+        help="Longest wait for more requests after the first of a micro-batch",
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=16, help="Contexts per forward pass"
+    )
+    args = parser.parse_args()
+
+    server = make_scoring_server(
+        args.model,
+        args.host,
+        args.port,
+        cpu_config={} if args.cpu else None,
+        max_batch_requests=args.max_batch_requests,
+        max_wait_ms=args.max_wait_ms,
+        batch_size=args.batch_size,
+    )
+    print(f"Serving {args.model} on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,248 @@
+"""
+Sequential evaluation with early stopping at a target confidence interval
+
+For a quick triage of a model, accuracy to within, say, +/- 0.5% at 95%
+confidence is enough, which takes far fewer facts than a full split. Here the
+split is scored in a random permutation stratified by relation (so that every
+prefix of it covers the relations in proportion), check_every facts at a
+time, with a Wilson score interval on the running accuracy; scoring stops
+once the interval's half-width reaches the target. The log reports the facts
+used, the interval after every check and the GPU time the skipped facts would
+have taken at the measured throughput.
+
+Checking the interval after every chunk makes it slightly optimistic (as with
+any optional stopping), so check_every shouldn't be set too small.
+
+Example usage, estimating English accuracy to +/- 0.5% at 95% confidence:
+python sequential_eval.py \
+    --model gpt2 \
+    --language en \
+    --target_half_width 0.005 \
+    --batch_size 8
+"""
+
+import datetime
+import math
+import os
+import random
+import time
+from argparse import ArgumentParser
+from statistics import NormalDist
+import numpy as np
+
+from compare_models import compare_models, get_score_summary, get_model_and_tokenizer
+from model_families import get_model_family
+from score_aggregation import ScoreAccumulator
+from columnar_logs import write_log
+
+
+def stratified_permutation(input_dataset, seed=0, stratify_key="relation"):
+    """
+    Shuffle the row indices of the dataset so that every prefix of the order
+    holds each stratum (e.g. relation) in proportion to its size
+
+    Each stratum is shuffled, then its rows are spread evenly over the order,
+    with a random offset within each row's slot
+    """
+    rng = random.Random(seed)
+    strata = {}
+    for row_itr, entities_dict in enumerate(input_dataset):
+        strata.setdefault(entities_dict.get(stratify_key), []).append(row_itr)
+
+    positions = []
+    for stratum_rows in strata.values():
+        rng.shuffle(stratum_rows)
+        for rank, row_itr in enumerate(stratum_rows):
+            positions.append(((rank + rng.random()) / len(stratum_rows), row_itr))
+    positions.sort()
+    return [row_itr for _, row_itr in positions]
+
+
+# helper to compute the Wilson score interval of a proportion
+def wilson_interval(successes, trials, confidence_level=0.95):
+    if trials == 0:
+        return 0.0, 1.0
+    z = NormalDist().inv_cdf(1 - (1 - confidence_level) / 2)
+    proportion = successes / trials
+    denominator = 1 + z**2 / trials
+    center = (proportion + z**2 / (2 * trials)) / denominator
+    half_width = (
+        z
+        * math.sqrt(proportion * (1 - proportion) / trials + z**2 / (4 * trials**2))
+        / denominator
+    )
+    return max(center - half_width, 0.0), min(center + half_width, 1.0)
+
+
+# helper to slice rows out of a datasets dataset or a list of rows
+def select_rows(input_dataset, row_itrs):
+    if hasattr(input_dataset, "select"):
+        return input_dataset.select(row_itrs)
+    return [input_dataset[row_itr] for row_itr in row_itrs]
+
+
+def sequential_compare_models(
+    model_name,
+    input_dataset,
+    target_half_width=0.005,
+    confidence_level=0.95,
+    check_every=1000,
+    min_facts=1000,
+    seed=0,
+    verbose=False,
+    log_dir="logging",
+    language=None,
+    tokenizer_and_model=None,
+    cpu_config=None,
+    **compare_kwargs,
+):
+    """
+    Score a stratified permutation of input_dataset until the confidence
+    interval on accuracy is within target_half_width (at confidence_level)
+
+    The model is loaded once (unless tokenizer_and_model is given) and scored
+    check_every facts per compare_models call (with compare_kwargs), whose
+    logs go to "chunk-<index>" folders of a "sequential-<datetime>" folder of
+    log_dir (compare_models names logs by the second); the interval is
+    checked after each call, once min_facts have been scored. The rows used
+    are merged, in the order scored, into a log in log_dir named like
+    compare_models' own. Returns its path and the sequential report
+    """
+    if compare_kwargs.get("stream_log_fpath") is not None:
+        raise Exception("Sequential evaluation doesn't support streamed logs.")
+    if tokenizer_and_model is None:
+        tokenizer_and_model = get_model_and_tokenizer(model_name, cpu_config)
+
+    order = stratified_permutation(input_dataset, seed)
+    dt_string = datetime.datetime.now().strftime("%d-%m-%Y-%H-%M-%S")
+    chunk_dir = os.path.join(log_dir, f"sequential-{dt_string}")
+
+    accumulator = ScoreAccumulator()
+    score_dict_full = []
+    checks = []
+    scoring_seconds = 0.0
+    for chunk_itr, start in enumerate(range(0, len(order), check_every)):
+        chunk_start_time = time.perf_counter()
+        score_dicts, _ = compare_models(
+            [model_name],
+            select_rows(input_dataset, order[start : start + check_every]),
+            verbose,
+            log_dir=os.path.join(chunk_dir, f"chunk-{chunk_itr}"),
+            language=language,
+            tokenizer_and_model=tokenizer_and_model,
+            cpu_config=cpu_config,
+            **compare_kwargs,
+        )
+        scoring_seconds += time.perf_counter() - chunk_start_time
+        for score_dict in score_dicts[0][model_name.lower()]:
+            accumulator.update(score_dict)
+            score_dict_full.append(score_dict)
+
+        true_count = accumulator.overall.true_count
+        fact_count = accumulator.overall.fact_count
+        lower, upper = wilson_interval(true_count, fact_count, confidence_level)
+        checks.append(
+            {
+                "facts": fact_count,
+                "accuracy": true_count / fact_count,
+                "ci_lower": lower,
+                "ci_upper": upper,
+                "half_width": (upper - lower) / 2,
+            }
+        )
+        print(
+            f"Sequential check, {fact_count} facts: accuracy {np.round(true_count / fact_count, 4)}, +/- {np.round((upper - lower) / 2, 4)}"
+        )
+        if (fact_count >= min_facts) and ((upper - lower) / 2 <= target_half_width):
+            break
+
+    # the skipped facts would have run at the measured throughput
+    facts_per_second = fact_count / scoring_seconds if scoring_seconds else 0.0
+    skipped_facts = len(order) - fact_count
+    sequential_report = {
+        "target_half_width": target_half_width,
+        "confidence_level": confidence_level,
+        "check_every": check_every,
+        "seed": seed,
+        "facts_used": fact_count,
+        "total_facts": len(order),
+        "stopped_early": skipped_facts > 0,
+        "accuracy": checks[-1]["accuracy"],
+        "ci_lower": checks[-1]["ci_lower"],
+        "ci_upper": checks[-1]["ci_upper"],
+        "half_width": checks[-1]["half_width"],
+        "checks": checks,
+        "seconds": scoring_seconds,
+        "facts_per_second": facts_per_second,
+        "estimated_seconds_saved": (
+            skipped_facts / facts_per_second if facts_per_second else 0.0
+        ),
+    }
+    print(
+        f"Used {fact_count}/{len(order)} facts, saving an estimated {np.round(sequential_report['estimated_seconds_saved'], 1)}s"
+    )
+
+    score_dicts_logging = {}
+    score_dicts_logging["curr_datetime"] = str(datetime.datetime.now())
+    score_dicts_logging["model_name"] = [model_name]
+    score_dicts_logging["score_dict_summary"] = {
+        model_name.lower(): get_score_summary(accumulator)
+    }
+    score_dicts_logging["score_dict_full"] = {model_name.lower(): score_dict_full}
+    score_dicts_logging["score_aggregates"] = {model_name.lower(): accumulator.report()}
+    score_dicts_logging["run_report"] = {
+        model_name.lower(): {"sequential": sequential_report}
+    }
+
+    prefix = get_model_family(model_name)["prefix"]
+    log_format = compare_kwargs.get("log_format", "json")
+    log_fname = f"{prefix}-logged-cka-outputs-{dt_string}.{log_format}"
+    if language is not None:
+        log_fname = f"{language}-{log_fname}"
+    log_fpath = os.path.join(log_dir, log_fname)
+    write_log(score_dicts_logging, log_fpath)
+
+    return log_fpath, sequential_report
+
+
+if __name__ == "__main__":
+    from datasets import load_dataset
+    from post_process_logs_folder import supported_languages
+
+    parser = ArgumentParser()
+    parser.add_argument("--model", type=str, default="gpt2", help="Model name")
+    parser.add_argument("--language", type=str, default="en", help="Language code")
+    parser.add_argument(
+        "--target_half_width",
+        type=float,
+        default=0.005,
+        help="Half-width of the confidence interval to stop at",
+    )
+    parser.add_argument(
+        "--confidence_level", type=float, default=0.95, help="Interval confidence"
+    )
+    parser.add_argument(
+        "--check_every", type=int, default=1000, help="Facts between checks"
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=None, help="Stems per forward pass"
+    )
+    args = parser.parse_args()
+
+    dataset = load_dataset(
+        "Polyglot-or-Not/Fact-Completion",
+        split=supported_languages[args.language].capitalize(),
+    )
+    log_fpath, sequential_report = sequential_compare_models(
+        args.model,
+        dataset,
+        target_half_width=args.target_half_width,
+        confidence_level=args.confidence_level,
+        check_every=args.check_every,
+        language=args.language,
+        batch_size=args.batch_size,
+    )
+    print(
+        f"Accuracy {np.round(sequential_report['accuracy'], 4)} +/- {np.round(sequential_report['half_width'], 4)} from {sequential_report['facts_used']} facts"
+    )
+    print(log_fpath)
@@ -0,0 +1,241 @@
+"""
+Process-pool sharded fact-completion runs on many-core CPU boxes
+
+A split is cut into N contiguous shards in dataset order (so every dataset_id
+lands in exactly one shard), and each shard is scored by compare_models in its
+own worker process, with its own model copy and a 1/N share of the cores. The
+shard logs are then merged back in dataset order into the usual json log, with
+the same score_dict_full and score_dict_summary as a single-process run.
+
+Probabilities only match a single-process run bit for bit when stems are
+scored one at a time (batch_size of None or 1), since batched stems are padded
+to the other stems of their batch, and batches are formed per shard.
+
+Example usage, reporting the scaling over shard counts:
+python sharded_run.py \
+    --model gpt2 \
+    --language en \
+    --shard_counts 1 2 4 8
+"""
+
+import datetime
+import json
+import multiprocessing
+import os
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+
+from compare_models import compare_models, get_score_summary, get_model_and_tokenizer
+from shared_weights import get_memory_usage
+from score_aggregation import accumulate_rows
+from columnar_logs import load_log, write_log
+
+# model loaded by the parent when sharing weights, inherited by forked workers
+shared_tokenizer_and_model = None
+
+
+# helper to cut num_rows rows into num_shards contiguous (start, end) ranges,
+# the first num_rows % num_shards shards taking one extra row
+def get_shard_ranges(num_rows, num_shards):
+    shard_sizes = [
+        num_rows // num_shards + (1 if shard_itr < num_rows % num_shards else 0)
+        for shard_itr in range(num_shards)
+    ]
+    shard_ends = np.cumsum(shard_sizes).tolist()
+    shard_starts = [0] + shard_ends[:-1]
+    return [(start, end) for start, end in zip(shard_starts, shard_ends) if end > start]
+
+
+# helper to slice a datasets dataset or a list of rows
+def get_shard(input_dataset, start, end):
+    if hasattr(input_dataset, "select"):
+        return input_dataset.select(range(start, end))
+    return list(input_dataset[start:end])
+
+
+# worker entry point, scoring one shard in its own process
+# returns the shard's log path and the worker's memory use
+def run_shard(model_name, shard_dataset, log_dir, compare_kwargs):
+    if shared_tokenizer_and_model is not None:
+        torch.set_num_threads(compare_kwargs["cpu_config"]["num_threads"])
+        compare_kwargs = dict(
+            compare_kwargs, tokenizer_and_model=shared_tokenizer_and_model
+        )
+    _, log_fpath = compare_models(
+        [model_name], shard_dataset, False, log_dir=log_dir, **compare_kwargs
+    )
+    return log_fpath, get_memory_usage()
+
+
+# helper to merge shard logs, in shard order, into one single-run log
+def merge_shard_logs(model_name, shard_log_fpaths, merged_log_fpath, run_report):
+    score_dict_full = []
+    for shard_log_fpath in shard_log_fpaths:
+        score_dict_full.extend(
+            load_log(shard_log_fpath)["score_dict_full"][model_name.lower()]
+        )
+
+    accumulator = accumulate_rows(score_dict_full)
+
+    score_dicts_logging = {}
+    score_dicts_logging["curr_datetime"] = str(datetime.datetime.now())
+    score_dicts_logging["model_name"] = [model_name]
+    score_dicts_logging["score_dict_summary"] = {
+        model_name.lower(): get_score_summary(accumulator)
+    }
+    score_dicts_logging["score_dict_full"] = {model_name.lower(): score_dict_full}
+    score_dicts_logging["score_aggregates"] = {model_name.lower(): accumulator.report()}
+    score_dicts_logging["run_report"] = {model_name.lower(): run_report}
+
+    write_log(score_dicts_logging, merged_log_fpath)
+    return score_dicts_logging
+
+
+def run_sharded(
+    model_name,
+    input_dataset,
+    num_shards,
+    cpu_config=None,
+    log_dir="logging",
+    **compare_kwargs,
+):
+    """
+    Score input_dataset with num_shards worker processes and merge their logs
+
+    Each worker gets the cpu_config with num_threads set to its share of the
+    cores (unless set to a number already); other keyword arguments go to compare_models.
+    With share_weights set in the cpu_config, the model is loaded once, onto
+    its memory-mapped checkpoint, and the workers are forked to share it.
+    Returns the merged log path and its run report, with each worker's memory
+    """
+    global shared_tokenizer_and_model
+
+    shard_ranges = get_shard_ranges(len(input_dataset), num_shards)
+    compare_kwargs["cpu_config"] = dict(cpu_config or {})
+    if compare_kwargs["cpu_config"].get("num_threads") is None:
+        compare_kwargs["cpu_config"]["num_threads"] = max(
+            1, os.cpu_count() // len(shard_ranges)
+        )
+
+    dt_string = datetime.datetime.now().strftime("%d-%m-%Y-%H-%M-%S")
+    shard_dir = os.path.join(log_dir, f"shards-{dt_string}")
+
+    start_time = time.perf_counter()
+    # workers are spawned, so no torch thread pool is inherited, unless they
+    # have to be forked to share the parent's model
+    mp_context = multiprocessing.get_context("spawn")
+    if compare_kwargs["cpu_config"].get("share_weights"):
+        shared_tokenizer_and_model = get_model_and_tokenizer(
+            model_name, compare_kwargs["cpu_config"]
+        )
+        mp_context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(
+        max_workers=len(shard_ranges), mp_context=mp_context
+    ) as executor:
+        futures = []
+        for shard_itr, (start, end) in enumerate(shard_ranges):
+            shard_kwargs = dict(compare_kwargs)
+            if shard_kwargs.get("stream_log_fpath"):
+                shard_kwargs["stream_log_fpath"] = shard_kwargs[
+                    "stream_log_fpath"
+                ].replace(".jsonl", f"-shard-{shard_itr}.jsonl")
+            futures.append(
+                executor.submit(
+                    run_shard,
+                    model_name,
+                    get_shard(input_dataset, start, end),
+                    os.path.join(shard_dir, f"shard-{shard_itr}"),
+                    shard_kwargs,
+                )
+            )
+        # results are collected in shard order, whatever order they finish in
+        shard_results = [future.result() for future in futures]
+    run_seconds = time.perf_counter() - start_time
+    shard_log_fpaths = [log_fpath for log_fpath, _ in shard_results]
+
+    run_report = {
+        "num_shards": len(shard_ranges),
+        "threads_per_shard": compare_kwargs["cpu_config"]["num_threads"],
+        "seconds": run_seconds,
+        "facts_per_second": len(input_dataset) / run_seconds if run_seconds else 0.0,
+        "shard_log_fpaths": shard_log_fpaths,
+        "worker_memory": [memory_usage for _, memory_usage in shard_results],
+        "parent_memory": get_memory_usage(),
+    }
+    shared_tokenizer_and_model = None
+    merged_log_fpath = os.path.join(log_dir, os.path.basename(shard_log_fpaths[0]))
+    merge_shard_logs(model_name, shard_log_fpaths, merged_log_fpath, run_report)
+    return merged_log_fpath, run_report
+
+
+def scaling_report(model_name, input_dataset, shard_counts, **run_kwargs):
+    """
+    Run the same split at each shard count and report facts/sec, speedup over
+    the smallest shard count and parallel efficiency
+    """
+    report = []
+    for num_shards in shard_counts:
+        _, run_report = run_sharded(model_name, input_dataset, num_shards, **run_kwargs)
+        report.append(
+            {
+                "num_shards": run_report["num_shards"],
+                "threads_per_shard": run_report["threads_per_shard"],
+                "seconds": run_report["seconds"],
+                "facts_per_second": run_report["facts_per_second"],
+            }
+        )
+
+    baseline = report[0]
+    for shard_report in report:
+        shard_report["speedup"] = (
+            shard_report["facts_per_second"] / baseline["facts_per_second"]
+        )
+        shard_report["efficiency"] = shard_report["speedup"] / (
+            shard_report["num_shards"] / baseline["num_shards"]
+        )
+    return report
+
+
+if __name__ == "__main__":
+    from datasets import load_dataset
+    from post_process_logs_folder import supported_languages
+
+    parser = ArgumentParser()
+    parser.add_argument("--model", type=str, default="gpt2", help="Model name")
+    parser.add_argument("--language", type=str, default="en", help="Language code")
+    parser.add_argument(
+        "--shard_counts",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4],
+        help="Shard counts to run and report the scaling of",
+    )
+    parser.add_argument(
+        "--num_facts", type=int, default=None, help="Only score the first facts"
+    )
+    parser.add_argument(
+        "--share_weights",
+        type=bool,
+        default=False,
+        help="Whether to fork the workers from one memory-mapped model",
+    )
+    args = parser.parse_args()
+
+    dataset = load_dataset(
+        "Polyglot-or-Not/Fact-Completion",
+        split=supported_languages[args.language].capitalize(),
+    )
+    if args.num_facts is not None:
+        dataset = dataset.select(range(min(args.num_facts, len(dataset))))
+
+    report = scaling_report(
+        args.model,
+        dataset,
+        args.shard_counts,
+        cpu_config={"share_weights": args.share_weights},
+        language=args.language,
+    )
+    print(json.dumps(report, indent=4))
@@ -0,0 +1,194 @@
+"""
+Copy-on-write sharing of model weights across worker processes
+
+A model's safetensors checkpoint is memory-mapped and the model is built with
+its parameters pointing at the mapped pages, so the weights live in the page
+cache rather than in each process's private memory, even while loading.
+Workers forked from the process that loaded the model (see sharded_run.py)
+then read the same physical pages; a page is only copied if a process writes
+to it, which inference doesn't. Per-process memory use can be read back to check the sharing.
+"""
+
+import json
+import os
+import numpy as np
+import torch
+from accelerate import init_empty_weights
+from transformers import AutoConfig
+from transformers.utils import cached_file
+
+# safetensors dtypes and their numpy storage types
+# (numpy has no bfloat16, so those are mapped as uint16 and viewed back)
+safetensors_dtypes = {
+    "F64": (np.float64, torch.float64),
+    "F32": (np.float32, torch.float32),
+    "F16": (np.float16, torch.float16),
+    "BF16": (np.uint16, torch.bfloat16),
+    "I64": (np.int64, torch.int64),
+    "I32": (np.int32, torch.int32),
+    "I16": (np.int16, torch.int16),
+    "I8": (np.int8, torch.int8),
+    "U8": (np.uint8, torch.uint8),
+    "BOOL": (np.bool_, torch.bool),
+}
+
+
+# helper to find the local safetensors file(s) of a model, downloading them
+# to the hub cache if needed
+def get_safetensors_files(model_name, revision=None):
+    index_fpath = cached_file(
+        model_name,
+        "model.safetensors.index.json",
+        revision=revision,
+        _raise_exceptions_for_missing_entries=False,
+    )
+    if index_fpath is not None:
+        with open(index_fpath, "r") as infile:
+            shard_fnames = sorted(set(json.load(infile)["weight_map"].values()))
+        return [
+            cached_file(model_name, shard_fname, revision=revision)
+            for shard_fname in shard_fnames
+        ]
+
+    fpath = cached_file(
+        model_name,
+        "model.safetensors",
+        revision=revision,
+        _raise_exceptions_for_missing_entries=False,
+    )
+    if fpath is None:
+        raise Exception(f"No safetensors checkpoint found for {model_name}.")
+    return [fpath]
+
+
+def mmap_safetensors(fpath):
+    """
+    Map every tensor of a safetensors file without reading it into memory
+
+    The file is mapped copy-on-write, so the tensors are writable but only the
+    pages actually written to get copied; returns a dict of tensors by name
+    """
+    with open(fpath, "rb") as infile:
+        header_length = int.from_bytes(infile.read(8), "little")
+        header = json.loads(infile.read(header_length))
+    header.pop("__metadata__", None)
+
+    file_buffer = np.memmap(fpath, dtype=np.uint8, mode="c")
+    data_start = 8 + header_length
+    tensors = {}
+    for name, tensor_info in header.items():
+        numpy_dtype, torch_dtype = safetensors_dtypes[tensor_info["dtype"]]
+        start, end = tensor_info["data_offsets"]
+        array = file_buffer[data_start + start : data_start + end].view(numpy_dtype)
+        tensor = torch.from_numpy(array.reshape(tensor_info["shape"]))
+        if torch_dtype == torch.bfloat16:
+            tensor = tensor.view(torch.bfloat16)
+        tensors[name] = tensor
+    return tensors
+
+
+def load_shared_model(
+    model_class, model_name, torch_dtype=None, trust_remote_code=False, revision=None
+):
+    """
+    Build a model directly on its memory-mapped safetensors checkpoint
+
+    The model's parameters are created on the meta device (its buffers, e.g.
+    rotary frequencies, as usual) and then pointed at the mapped tensors, so
+    no private copy of the weights is ever allocated. The weights keep the
+    checkpoint's dtype, which torch_dtype (if given) has to match. Returns the
+    model and a report of its mapped and private megabytes, with tied
+    parameters (e.g. lm_head and the input embeddings) counted once
+    """
+    mapped_tensors = {}
+    for fpath in get_safetensors_files(model_name, revision):
+        mapped_tensors.update(mmap_safetensors(fpath))
+    checkpoint_dtypes = sorted(
+        {str(tensor.dtype) for tensor in mapped_tensors.values()}
+    )
+    if (torch_dtype is not None) and (str(torch_dtype) not in checkpoint_dtypes):
+        raise Exception(
+            f"Shared weights keep the checkpoint's dtype ({', '.join(checkpoint_dtypes)}), not {torch_dtype}."
+        )
+
+    config = AutoConfig.from_pretrained(
+        model_name, revision=revision, trust_remote_code=trust_remote_code
+    )
+    with init_empty_weights(include_buffers=False):
+        if hasattr(model_class, "from_config"):
+            model = model_class.from_config(config, trust_remote_code=trust_remote_code)
+        else:
+            model = model_class(config)
+
+    # checkpoints may or may not include the base model prefix in their names
+    base_prefix = model.base_model_prefix + "."
+    mapped_data_ptrs = set()
+    for name, tensor in model.state_dict(keep_vars=True).items():
+        candidate_names = [name, base_prefix + name]
+        if name.startswith(base_prefix):
+            candidate_names.append(name[len(base_prefix) :])
+        for candidate_name in candidate_names:
+            mapped_tensor = mapped_tensors.get(candidate_name)
+            if (mapped_tensor is not None) and (mapped_tensor.shape == tensor.shape):
+                break
+        else:
+            # left to be tied below, or reported missing
+            continue
+
+        module_name, _, tensor_name = name.rpartition(".")
+        module = model.get_submodule(module_name)
+        if tensor_name in module._parameters:
+            module._parameters[tensor_name] = torch.nn.Parameter(
+                mapped_tensor, requires_grad=False
+            )
+        else:
+            module._buffers[tensor_name] = mapped_tensor
+        mapped_data_ptrs.add(mapped_tensor.data_ptr())
+    model.tie_weights()
+    model.eval()
+
+    report = {"shared_megabytes": 0.0, "unshared_megabytes": 0.0, "unshared": []}
+    seen_data_ptrs = set()
+    missing = []
+    for name, tensor in list(model.named_parameters()) + list(model.named_buffers()):
+        if tensor.is_meta:
+            missing.append(name)
+            continue
+        if tensor.data_ptr() in seen_data_ptrs:
+            continue
+        seen_data_ptrs.add(tensor.data_ptr())
+        megabytes = tensor.numel() * tensor.element_size() / 1024**2
+        if tensor.data_ptr() in mapped_data_ptrs:
+            report["shared_megabytes"] += megabytes
+        else:
+            report["unshared_megabytes"] += megabytes
+            report["unshared"].append(name)
+    if missing:
+        raise Exception(f"No checkpoint tensors for {', '.join(missing[:5])}.")
+    if report["shared_megabytes"] == 0:
+        raise Exception(f"No weights of {model_name} could be shared.")
+    return model, report
+
+
+# helper to read this process's memory use, in megabytes
+# rss counts every resident page, pss splits shared pages between the
+# processes mapping them, and private pages are this process's alone
+def get_memory_usage():
+    memory_usage = {"pid": os.getpid()}
+    fields = {
+        "Rss": "rss_megabytes",
+        "Pss": "pss_megabytes",
+        "Shared_Clean": "shared_clean_megabytes",
+        "Shared_Dirty": "shared_dirty_megabytes",
+        "Private_Clean": "private_clean_megabytes",
+        "Private_Dirty": "private_dirty_megabytes",
+    }
+    smaps_fpath = "/proc/self/smaps_rollup"
+    if not os.path.isfile(smaps_fpath):
+        return memory_usage
+    with open(smaps_fpath, "r") as infile:
+        for line in infile:
+            field = line.split(":")[0]
+            if field in fields:
+                memory_usage[fields[field]] = int(line.split()[1]) / 1024
+    return memory_usage
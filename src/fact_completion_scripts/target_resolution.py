@@ -0,0 +1,174 @@
+"""
+Target-id resolution for fact-completion probes
+
+Which vocab id gets scored for an entity depends on the model family: whether
+the entity is encoded with a leading space, how many special tokens (e.g. BOS)
+precede it, and whether T5's lone space token has to be stripped. Those rules
+are declared once per family below, and the target ids of a whole split are
+resolved from one batched tokenizer call, as a NumPy array.
+"""
+
+import numpy as np
+
+# per-family target rules, keyed by model prefix
+# leading_space: encode " " + entity rather than the bare entity
+# offset: position of the first target token in the encoding (after BOS etc.)
+# strip_space_token: skip a leading lone space token (sentencepiece)
+# truncate: encode with max_length=512 and truncation
+target_id_rules = {
+    "t5": {
+        "leading_space": True,
+        "offset": 0,
+        "strip_space_token": True,
+        "truncate": True,
+    },
+    "gpt": {
+        "leading_space": True,
+        "offset": 0,
+        "strip_space_token": False,
+        "truncate": False,
+    },
+    "eleutherai": {
+        "leading_space": True,
+        "offset": 0,
+        "strip_space_token": False,
+        "truncate": False,
+    },
+    "bloom": {
+        "leading_space": True,
+        "offset": 0,
+        "strip_space_token": False,
+        "truncate": False,
+    },
+    "stablelm": {
+        "leading_space": True,
+        "offset": 0,
+        "strip_space_token": False,
+        "truncate": False,
+    },
+    "mpt": {
+        "leading_space": True,
+        "offset": 0,
+        "strip_space_token": False,
+        "truncate": False,
+    },
+    "redpajama": {
+        "leading_space": True,
+        "offset": 0,
+        "strip_space_token": False,
+        "truncate": False,
+    },
+    "falcon": {
+        "leading_space": True,
+        "offset": 0,
+        "strip_space_token": False,
+        "truncate": False,
+    },
+    "opt": {
+        "leading_space": True,
+        "offset": 1,
+        "strip_space_token": False,
+        "truncate": False,
+    },
+    "roberta": {
+        "leading_space": True,
+        "offset": 1,
+        "strip_space_token": False,
+        "truncate": True,
+    },
+    "bert": {
+        "leading_space": False,
+        "offset": 1,
+        "strip_space_token": False,
+        "truncate": True,
+    },
+    "llama": {
+        "leading_space": True,
+        "offset": 2,
+        "strip_space_token": False,
+        "truncate": False,
+    },
+    "mistral": {
+        "leading_space": True,
+        "offset": 2,
+        "strip_space_token": False,
+        "truncate": False,
+    },
+}
+
+
+def get_target_rule(prefix):
+    try:
+        return target_id_rules[prefix]
+    except KeyError:
+        raise Exception(f"No target-id rule for model prefix {prefix}.")
+
+
+# helper to build the text that gets encoded for an entity
+def get_target_text(prefix, entity):
+    if get_target_rule(prefix)["leading_space"]:
+        return " " + entity
+    return entity
+
+
+# helper to encode a list of target texts in one batched tokenizer call
+def encode_targets(tokenizer, prefix, target_texts):
+    if not target_texts:
+        return []
+    if get_target_rule(prefix)["truncate"]:
+        return tokenizer(target_texts, max_length=512, truncation=True)["input_ids"]
+    return tokenizer(target_texts, return_token_type_ids=False)["input_ids"]
+
+
+# helper to find the token id to strip for the family, or None
+def get_space_only_token(tokenizer, prefix):
+    if get_target_rule(prefix)["strip_space_token"]:
+        return tokenizer.encode(" ")[0]
+    return None
+
+
+def resolve_first_target_ids(tokens, offsets, prefix, space_only_token=None):
+    """
+    Pick the scored (first) target id of every entity, without a python loop
+
+    tokens and offsets hold the flattened encodings of the entities, entity i
+    spanning tokens[offsets[i] : offsets[i + 1]]; returns an int64 array with
+    one target id per entity
+    """
+    rule = get_target_rule(prefix)
+    tokens = np.asarray(tokens)
+    offsets = np.asarray(offsets)
+    starts = offsets[:-1]
+    lengths = np.diff(offsets)
+    columns = np.full(len(starts), rule["offset"], dtype=np.int64)
+
+    # a lone space token in front of the entity is skipped over
+    if rule["strip_space_token"] and (space_only_token is not None):
+        has_tokens = lengths > columns
+        columns[has_tokens] += (
+            tokens[starts[has_tokens] + columns[has_tokens]] == space_only_token
+        )
+
+    if np.any(lengths <= columns):
+        short_entity = int(np.argmax(lengths <= columns))
+        raise Exception(
+            f"Entity {short_entity} has no target token under the {prefix} rule."
+        )
+    return tokens[starts + columns].astype(np.int64)
+
+
+# helper to pick every target id of each entity, starting from the scored one
+def resolve_full_target_ids(encoded_targets, prefix):
+    offset = get_target_rule(prefix)["offset"]
+    return [encoded_ids[offset:] for encoded_ids in encoded_targets]
+
+
+# helper to lay out per-entity target ids, flattened row after row, as a
+# (rows, entities) table aligned with the dataset
+# rows with fewer counterfacts are padded with -1
+def target_id_table(flat_target_ids, row_lengths):
+    row_lengths = np.asarray(row_lengths, dtype=np.int64)
+    max_length = int(row_lengths.max()) if len(row_lengths) else 0
+    table = np.full((len(row_lengths), max_length), -1, dtype=np.int64)
+    table[np.arange(max_length) < row_lengths[:, None]] = flat_target_ids
+    return table
@@ -0,0 +1,190 @@
+"""
+On-disk cache of pre-tokenized fact-completion splits
+
+Every run used to re-tokenize the stems of a split and encode each entity on
+its own. This cache stores the token ids of every stem and target for a given
+(split contents, model prefix, tokenizer) as flat int32 arrays with offsets,
+built with one batched call to the (fast) tokenizer. Later runs load the arrays
+memory-mapped. A cached split is rebuilt whenever the tokenizer fingerprint
+stored alongside it no longer matches.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+from probe_helpers import tokenize_batch_contexts
+from target_resolution import get_target_text, encode_targets, get_space_only_token
+
+# bump when the way splits get tokenized changes, to invalidate old caches
+tokenization_rules_version = 1
+
+
+# fingerprint of everything about a tokenizer that can change its output
+def tokenizer_fingerprint(tokenizer):
+    fingerprint = {
+        "class": type(tokenizer).__name__,
+        "name_or_path": tokenizer.name_or_path,
+        "revision": tokenizer.init_kwargs.get("_commit_hash")
+        or tokenizer.init_kwargs.get("revision"),
+        "vocab_size": len(tokenizer),
+        "special_tokens": tokenizer.special_tokens_map,
+        "rules_version": tokenization_rules_version,
+    }
+    if tokenizer.is_fast:
+        # truncation and padding are set per call, so they're left out
+        backend = json.loads(tokenizer.backend_tokenizer.to_str())
+        backend.pop("truncation", None)
+        backend.pop("padding", None)
+        fingerprint["backend"] = hashlib.sha256(
+            json.dumps(backend, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+    return hashlib.sha256(
+        json.dumps(fingerprint, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+# fingerprint of a split's contents, as the model prefix will see them
+def split_fingerprint(prefix, contexts, entities):
+    return hashlib.sha256(
+        json.dumps([prefix, contexts, entities]).encode("utf-8")
+    ).hexdigest()
+
+
+# helper to flatten token id lists into int32 tokens and int64 offsets
+def flatten(token_lists):
+    offsets = np.zeros(len(token_lists) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(token_ids) for token_ids in token_lists])
+    tokens = np.fromiter(
+        (token_id for token_ids in token_lists for token_id in token_ids),
+        dtype=np.int32,
+        count=int(offsets[-1]),
+    )
+    return tokens, offsets
+
+
+# helper to turn flat tokens and offsets back into token id lists
+def unflatten(tokens, offsets):
+    token_lists = np.split(np.asarray(tokens), np.asarray(offsets[1:-1]))
+    return [token_ids.tolist() for token_ids in token_lists]
+
+
+class FlatTokenLists:
+    """
+    Read-only sequence of token id lists over flat tokens and offsets (e.g.
+    the memory-mapped arrays of a cached split)
+
+    Each list is sliced out of the flat tokens when it's accessed, so only the
+    contexts of the batches being collated are ever read into memory
+    """
+
+    def __init__(self, tokens, offsets):
+        self.tokens = tokens
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, itr):
+        return self.tokens[self.offsets[itr] : self.offsets[itr + 1]].tolist()
+
+    def __iter__(self):
+        for itr in range(len(self)):
+            yield self[itr]
+
+    def lengths(self):
+        return np.diff(self.offsets).tolist()
+
+
+# helper to name a tokenizer's cache folders, e.g. "bert-base-uncased"
+def get_tokenizer_slug(tokenizer):
+    return os.path.basename(tokenizer.name_or_path.rstrip("/")) or "tokenizer"
+
+
+def build_tokenized_split(cache_path, tokenizer, prefix, contexts, entities):
+    if not tokenizer.is_fast:
+        print("Slow tokenizer, building the tokenization cache without parallelism")
+
+    # one batched call each for contexts and targets
+    context_tokens, context_offsets = flatten(
+        tokenize_batch_contexts(tokenizer, contexts, prefix) if contexts else []
+    )
+    target_texts = [get_target_text(prefix, entity) for entity in entities]
+    target_tokens, target_offsets = flatten(
+        encode_targets(tokenizer, prefix, target_texts)
+    )
+
+    if not os.path.isdir(cache_path):
+        os.makedirs(cache_path)
+    np.save(os.path.join(cache_path, "context_tokens.npy"), context_tokens)
+    np.save(os.path.join(cache_path, "context_offsets.npy"), context_offsets)
+    np.save(os.path.join(cache_path, "target_tokens.npy"), target_tokens)
+    np.save(os.path.join(cache_path, "target_offsets.npy"), target_offsets)
+
+    # metadata goes last, so a partially written cache is never picked up
+    metadata = {
+        "tokenizer_fingerprint": tokenizer_fingerprint(tokenizer),
+        "tokenizer_name": tokenizer.name_or_path,
+        "prefix": prefix,
+        "num_contexts": len(contexts),
+        "num_targets": len(entities),
+        "space_only_token": get_space_only_token(tokenizer, prefix),
+    }
+    with open(os.path.join(cache_path, "metadata.json"), "w") as outfile:
+        json.dump(metadata, outfile)
+
+
+def load_or_build_tokenized_split(cache_dir, tokenizer, prefix, contexts, entities):
+    """
+    Load the token ids of a split's contexts and entities from the cache,
+    building (or rebuilding) the cache first when needed
+
+    contexts and entities are flat lists of strings; returns a dict of
+    memory-mapped context/target tokens and offsets plus the cache metadata
+    (see FlatTokenLists to read the contexts without copying them all)
+    """
+    # keyed on the tokenizer (name, revision, vocab) as well as the split, so
+    # tokenizers of one family (e.g. bert-base-uncased and mBERT) don't evict
+    # each other's caches
+    fingerprint = tokenizer_fingerprint(tokenizer)
+    cache_path = os.path.join(
+        cache_dir,
+        f"{prefix}-{get_tokenizer_slug(tokenizer)}-{fingerprint[:12]}-{split_fingerprint(prefix, contexts, entities)[:16]}",
+    )
+    metadata_fpath = os.path.join(cache_path, "metadata.json")
+
+    metadata = None
+    if os.path.isfile(metadata_fpath):
+        with open(metadata_fpath, "r") as infile:
+            metadata = json.load(infile)
+    if (metadata is None) or (metadata["tokenizer_fingerprint"] != fingerprint):
+        print(f"Building tokenization cache at {cache_path}...")
+        # built in a folder of this process's own, then moved into place, so
+        # concurrent runs never read (or write) each other's partial arrays
+        build_path = f"{cache_path}.build-{os.getpid()}"
+        build_tokenized_split(build_path, tokenizer, prefix, contexts, entities)
+        if metadata is not None:
+            shutil.rmtree(cache_path, ignore_errors=True)
+        try:
+            os.rename(build_path, cache_path)
+        except OSError:
+            # another run moved its (identical) cache into place first
+            shutil.rmtree(build_path, ignore_errors=True)
+        with open(metadata_fpath, "r") as infile:
+            metadata = json.load(infile)
+    else:
+        print(f"Loading tokenization cache from {cache_path}...")
+
+    tokenized_split = {"metadata": metadata}
+    for name in [
+        "context_tokens",
+        "context_offsets",
+        "target_tokens",
+        "target_offsets",
+    ]:
+        tokenized_split[name] = np.load(
+            os.path.join(cache_path, f"{name}.npy"), mmap_mode="r"
+        )
+    return tokenized_split